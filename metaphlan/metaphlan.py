@@ -11,7 +11,7 @@ __date__ = '11 Mar 2024'
 
 import sys
 try:
-    from metaphlan import mybytes, plain_read_and_split, plain_read_and_split_line, read_and_split, read_and_split_line, check_and_install_database, remove_prefix
+    from metaphlan import mybytes, read_and_split_line, check_and_install_database, remove_prefix
 except ImportError:
     sys.exit("CRITICAL ERROR: Unable to find the MetaPhlAn python package. Please check your install.")
 
@@ -21,17 +21,15 @@ if float(sys.version_info[0]) < 3.0:
     sys.exit(1)
 import os
 import stat
-import re
 import time
-import random
+import queue
+import resource
+import threading
 from collections import defaultdict as defdict
 from distutils.version import LooseVersion
 from glob import glob
 from subprocess import DEVNULL
 import argparse as ap
-import bz2
-import gzip
-import pickle
 import subprocess as subp
 import tempfile as tf
 
@@ -40,9 +38,27 @@ from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 from collections import Counter
 try:
-    from .utils.parallelisation import execute_pool
+    from .utils.read_fastx import FastxFeeder, MultiplexedFeeder, split_sample_tag
+    from .utils.sam_filter import SamFilter
+    from .utils.threaded_io import MergedLineReader, QueuedWriter, RoundRobinWriter
+    from .utils.compression import CODECS, compressed_open, detect_codec
+    from .utils.bowtie2out import BinaryBowtie2outWriter, is_binary_bowtie2out, load_binary_bowtie2out
+    from .utils.subsampling import MappingSubsampler, ReadSubsampler, subsample_arrays
+    from .utils.prefilter import DEFAULT_MIN_HITS, Prefilter, build_database_prefilter, prefilter_path
+    from .utils.page_cache import database_files, format_residency, resident_pages, warm_file
+    from .utils.database_cache import load_database
+    from .utils.array_tree import ArrayTaxTree
 except ImportError:
-    from utils.parallelisation import execute_pool
+    from utils.read_fastx import FastxFeeder, MultiplexedFeeder, split_sample_tag
+    from utils.sam_filter import SamFilter
+    from utils.threaded_io import MergedLineReader, QueuedWriter, RoundRobinWriter
+    from utils.compression import CODECS, compressed_open, detect_codec
+    from utils.bowtie2out import BinaryBowtie2outWriter, is_binary_bowtie2out, load_binary_bowtie2out
+    from utils.subsampling import MappingSubsampler, ReadSubsampler, subsample_arrays
+    from utils.prefilter import DEFAULT_MIN_HITS, Prefilter, build_database_prefilter, prefilter_path
+    from utils.page_cache import database_files, format_residency, resident_pages, warm_file
+    from utils.database_cache import load_database
+    from utils.array_tree import ArrayTaxTree
 try:
     import pandas as pd
     import numpy as np
@@ -80,6 +96,12 @@ DEFAULT_DB_FOLDER= os.environ.get('METAPHLAN_DB_DIR', DEFAULT_DB_FOLDER)
 SGB_ANALYSIS = True
 INDEX = 'latest'
 tax_units = "kpcofgst"
+ANALYSIS_TYPES = ['rel_ab', 'rel_ab_w_read_stats', 'reads_map', 'clade_profiles', 'marker_ab_table', 'marker_counts',
+                  'marker_pres_table', 'clade_specific_strain_tracker']
+# approximate size in bytes of the batches of SAM lines passed between the mapping stages
+SAM_BATCH_SIZE = 1024 * 1024
+# the database and the tree kept loaded by `metaphlan serve`, reused by the jobs forked from the server
+WARM_DATABASE = {}
 
 def read_params(args):
     p = ap.ArgumentParser( description =
@@ -179,7 +201,7 @@ def read_params(args):
     g = p.add_argument_group('Required arguments')
     arg = g.add_argument
     input_type_choices = ['fastq','fasta','bowtie2out','sam']
-    arg( '--input_type', choices=input_type_choices, required = '--install' not in args, help =
+    arg( '--input_type', choices=input_type_choices, required = '--install' not in args and '--warm_index' not in args, help =
          "set whether the input is the FASTA file of metagenomic reads or \n"
          "the SAM file of the mapping of the reads against the MetaPhlAn db.\n"
         )
@@ -212,15 +234,58 @@ def read_params(args):
         help='Full path and name of the BowTie2 executable. This option allows'
              'MetaPhlAn to reach the executable even when it is not in the '
              'system PATH or the system PATH is unreachable')
+    arg('--bt2_mm', action='store_true',
+        help="Use the memory-mapped I/O of BowTie2 (--mm) to load the index. Concurrent runs on the same "
+             "node share a single copy of the index in the page cache, see also --warm_index")
+    arg('--bt2_shards', type=int, default=1,
+        help="The number of BowTie2 processes mapping the reads, each one with nproc/N threads. The reads are "
+             "split in turn across the processes, that share the memory-mapped index (--bt2_mm is implied), "
+             "and their SAM outputs are merged. It is meant for hosts where a single BowTie2 process does not "
+             "scale to all the available cores; the gain depends on the host and the splitting adds overhead "
+             "when the cores are few, check it with python -m metaphlan.utils.benchmark fanout before using it "
+             "[default 1]")
     arg('--bowtie2_build', type=str, default='bowtie2-build',
         help="Full path to the bowtie2-build command to use, deafult assumes "
              "that 'bowtie2-build is present in the system path")
     arg('--bowtie2out', metavar="FILE_NAME", type=str, default=None,
         help="The file for saving the output of BowTie2")
+    arg('--compression', type=str, default='auto', choices=['auto', 'none'] + CODECS,
+        help="The compression of the --bowtie2out and --samout files. The readers detect the compression "
+             "from the content of the files. zstd and lz4 require the zstandard and lz4 python packages "
+             "[default auto, from the file extension (.bz2, .gz, .zst, .lz4)]")
+    arg('--compression_level', type=int, default=None,
+        help="The compression level of the --bowtie2out and --samout files [default depends on the compression]")
     arg('--min_mapq_val', type=int, default=5,
         help="Minimum mapping quality value (MAPQ) [default 5]")
     arg('--no_map', action='store_true',
         help="Avoid storing the --bowtie2out map file")
+    arg('--bowtie2out_format', type=str, default='text', choices=['text', 'binary'],
+        help="The format of the --bowtie2out file. The binary format stores the IDs of the hit markers in the "
+             "order of the database and is loaded faster, it can only be profiled with the same database. "
+             "Both the formats are detected when using --input_type bowtie2out [default text]")
+    arg('--bowtie2out_ordinals', action='store_true',
+        help="Store the ordinals of the mapped reads in the binary --bowtie2out file, used to identify the reads "
+             "when subsampling the mapping results (--mapping_subsampling). The binary format does not store the "
+             "read names and cannot be used with -t reads_map")
+    arg('--prefilter', action='store_true',
+        help="Map only the reads sharing k-mer minimizers with the markers. The minimizers are stored in the "
+             "{index}.prefilter file next to the database, built from its BowTie2 index the first time the "
+             "option is used (or with python -m metaphlan.utils.prefilter). Reads mapping to regions diverging "
+             "from the markers can be lost, the recall can be assessed with python -m metaphlan.utils.benchmark prefilter")
+    arg('--prefilter_min_hits', type=int, default=DEFAULT_MIN_HITS,
+        help="The minimum number of distinct minimizers shared with the markers by the reads mapped with --prefilter. "
+             "With 1 more reads diverging from the markers are kept, but so are about 40%% of the unrelated reads "
+             "[default {}]".format(DEFAULT_MIN_HITS))
+    arg('--multiplex', metavar="MANIFEST", type=str, default=None,
+        help="Maps the samples listed in MANIFEST in a single BowTie2 run and writes their bowtie2out files, "
+             "without profiling them. MANIFEST is tab-separated with the sample name, its comma separated "
+             "input files and its bowtie2out file on each line. The index is loaded once for all the samples, "
+             "the exit status is 1 if any sample failed")
+    arg('--batch', metavar="MANIFEST", type=str, default=None,
+        help="Profiles the samples listed in MANIFEST loading the database once, the mapping of each sample "
+             "overlaps the profiling of the previous one. MANIFEST is tab-separated with the sample name, its "
+             "comma separated input files (of --input_type), the output file and optionally the bowtie2out "
+             "file on each line. A failed sample does not stop the others, the exit status is 1 if any failed")
     arg('--tmp_dir', metavar="", default=None, type=str,
         help="The folder used to store temporary files [default is the OS "
              "dependent tmp dir]")
@@ -283,15 +348,21 @@ def read_params(args):
          "'wavg_l' : winsorized average of length-normalized marker counts (at --stat_q)\n"
          "'med'    : median of length-normalized marker counts\n"
          "[default tavg_g]"   )
+    arg( '--abundance_engine', metavar="", choices=['objects', 'arrays'], default='objects', type=str, help =
+         "Implementation used to compute the clade abundances, both giving the same results\n"
+         "'objects' : recursively on the clades of the taxonomic tree\n"
+         "'arrays'  : with NumPy operations on the tree and the markers stored as index arrays,\n"
+         "            faster on large databases and many samples\n"
+         "[default objects]" )
 
     arg = p.add_argument
 
     g = p.add_argument_group('Additional analysis types and arguments')
     arg = g.add_argument
-    analysis_types = ['rel_ab', 'rel_ab_w_read_stats', 'reads_map', 'clade_profiles', 'marker_ab_table', 'marker_counts', 'marker_pres_table', 'clade_specific_strain_tracker']
-    arg( '-t', metavar='ANALYSIS TYPE', type=str, choices = analysis_types,
+    arg( '-t', metavar='ANALYSIS TYPE', type=str,
          default='rel_ab', help =
-         "Type of analysis to perform: \n"
+         "Type of analysis to perform, or a comma separated list of types written from a single profiling of the\n"
+         "sample, with one output file per type in -o (e.g. -t rel_ab,marker_ab_table -o profile.txt,markers.txt):\n"
          " * rel_ab: profiling a metagenomes in terms of relative abundances\n"
          " * rel_ab_w_read_stats: profiling a metagenomes in terms of relative abundances and estimate the number of reads coming from each clade.\n"
          " * reads_map: mapping from reads to clades (only reads hitting a marker)\n"
@@ -369,19 +440,30 @@ def read_params(args):
         help="Random seed to use in the selection of the subsampled reads. Choose \"random\r for a random behaviour") 
     arg('--install', action='store_true',
         help="Only checks if the MetaPhlAn DB is installed and installs it if not. All other parameters are ignored.")
+    arg('--warm_index', action='store_true',
+        help="Only loads the BowTie2 index, the pkl and the columnar cache of the MetaPhlAn DB (and its copy shared "
+             "with --shm_db, if published) into the page cache and reports how much of them is resident, to be run "
+             "before concurrent --bt2_mm runs. All other parameters are ignored.")
+    arg('--shm_db', action='store_true',
+        help="Share a single copy of the MetaPhlAn DB in memory (/dev/shm) with the concurrent runs on the node. "
+             "The first run publishes it and the last one to exit removes it. Only the database columns are "
+             "shared, each run still builds its own tree of the clades in its private memory. Setting "
+             "METAPHLAN_SHM_DB=1 enables it for all the runs, sample2markers.py included")
     arg('--offline', action='store_true',
         help="If used, MetaPhlAn will not check for new database updates.")
     arg('--force_download', action='store_true',
         help="Force the re-download of the latest MetaPhlAn database.")
+    arg('--verbose', action='store_true',
+        help="Print the time spent by each stage of the mapping")
     arg('--read_min_len', type=int, default=70,
-        help="Specify the minimum length of the reads to be considered when parsing the input file with "
-             "'read_fastx.py' script, default value is 70")
+        help="Specify the minimum length of the reads to be considered when parsing the input file, "
+             "default value is 70")
     arg('-v', '--version', action='version',
         version="MetaPhlAn version {} ({})".format(__version__, __date__),
         help="Prints the current MetaPhlAn version and exit")
     arg("-h", "--help", action="help", help="show this help message and exit")
 
-    return vars(p.parse_args())
+    return vars(p.parse_args(args[1:]))
 
 def set_mapping_arguments(index, bowtie2_db):
     mpa_pkl = 'mpa_pkl'
@@ -513,49 +595,167 @@ def vsc_bowtie2(profile_vsc_folder, nproc, file_format="fasta",
     return VSC_report
 
 
-def run_bowtie2(fna_in, outfmt6_out, bowtie2_db, preset, nproc, min_mapq_val, file_format="fasta",
-                exe=None, samout=None, min_alignment_len=None, read_min_len=0, profile_vsc_folder=False):
-    # checking read_fastx.py
-    read_fastx = "read_fastx.py"
+def warm_index(mpa_pkl, bowtie2db):
+    files = [f for f in database_files(bowtie2db, mpa_pkl) if os.path.isfile(f)]
+    if not files:
+        sys.stderr.write("Error: Unable to find the MetaPhlAn database at: {}\nExiting...\n\n".format(bowtie2db))
+        sys.exit(1)
+    t0 = time.time()
+    nbytes = 0
+    for f in files:
+        before = resident_pages(f)
+        nbytes += warm_file(f)
+        sys.stderr.write('{}: {} before, {} after\n'.format(f, format_residency(*before),
+                                                           format_residency(*resident_pages(f))))
+    sys.stderr.write('{:.1f} MB of the database read in {:.2f} s\n'.format(nbytes / 2 ** 20, time.time() - t0))
+
+
+def run_batch(pars, tree, mpa_pkl, db_markers, samples, prefilter=None):
+    """Profiles the samples of a --batch manifest with the database and the tree loaded once
+
+    Each sample is mapped on a separate thread while the previous one is profiled. A sample that fails
+    (mapping or profiling) is reported and its output removed, without stopping the other samples.
+
+    Args:
+        samples (list): the name, the comma separated inputs, the output and the bowtie2out file (None for
+            a temporary one) of each sample
+
+    Returns:
+        int: the exit status, 1 if any sample failed
+    """
+    mapping = pars['input_type'] in ['fastq', 'fasta']
+    mapped = queue.Queue(1)  # the samples mapped ahead of the profiling
+
+    def map_samples():
+        for sample, inputs, output, bowtie2out in samples:
+            spars = dict(pars, inp=inputs, output=output, output_file=None, sample_id=sample, bowtie2out=bowtie2out)
+            temporary, error = False, None
+            if mapping:
+                if bowtie2out is None:
+                    fd, spars['bowtie2out'] = tf.mkstemp(dir=pars['tmp_dir'])
+                    os.close(fd)
+                    temporary = True
+                try:
+                    subsampler = None
+                    if pars['subsampling'] is not None and not pars['mapping_subsampling']:
+                        subsampler = ReadSubsampler(inputs.split(','), pars['subsampling'], pars['subsampling_seed'],
+                                                    False, pars['tmp_dir'], None, int(pars['nproc']))
+                    run_bowtie2(inputs, spars['bowtie2out'], pars['bowtie2db'], pars['bt2_ps'], pars['nproc'],
+                                file_format=pars['input_type'], exe=pars['bowtie2_exe'],
+                                min_alignment_len=pars['min_alignment_len'], read_min_len=pars['read_min_len'],
+                                min_mapq_val=pars['min_mapq_val'], verbose=pars['verbose'],
+                                compression=pars['compression'], compression_level=pars['compression_level'],
+                                db_markers=db_markers if pars['bowtie2out_format'] == 'binary' else None,
+                                index=pars['index'], ordinals=pars['bowtie2out_ordinals'], subsampler=subsampler,
+                                prefilter=prefilter, mm=pars['bt2_mm'], shards=pars['bt2_shards'])
+                except (Exception, SystemExit) as e:  # run_bowtie2 reports its errors and exits
+                    error = e
+                spars['input_type'], spars['inp'] = 'bowtie2out', spars['bowtie2out']
+            mapped.put((spars, temporary, error))
+        mapped.put(None)
+
+    mapper = threading.Thread(target=map_samples, daemon=True)
+    mapper.start()
+    failed, profiled = 0, False
+    while True:
+        item = mapped.get()
+        if item is None:
+            break
+        spars, temporary, error = item
+        if error is None:
+            try:
+                if profiled:
+                    tree.reset()
+                profiled = True
+                read_ids = spars['t'] == 'reads_map'
+                markers2reads, n_metagenome_reads, avg_read_length = map2bbh(
+                    spars['inp'], spars['min_mapq_val'], spars['input_type'], spars['min_alignment_len'],
+                    spars['nreads'], spars['mapping_subsampling'], spars['subsampling'], spars['subsampling_seed'],
+                    db_markers=db_markers, read_ids=read_ids)
+                write_profile(spars, tree, mpa_pkl, markers2reads, n_metagenome_reads, avg_read_length, read_ids)
+            except (Exception, SystemExit) as e:
+                error = e
+        if temporary and os.path.exists(spars['inp']):
+            os.remove(spars['inp'])
+        if error is None:
+            sys.stderr.write('Sample {}: profile written to {}\n'.format(spars['sample_id'], spars['output']))
+        else:
+            failed += 1
+            if os.path.exists(spars['output']):
+                os.remove(spars['output'])
+            sys.stderr.write('Sample {}: failed{}\n'.format(
+                spars['sample_id'], '' if isinstance(error, SystemExit) else ' ({})'.format(str(error).strip())))
+    mapper.join()
+    sys.stderr.write('{} of {} samples profiled\n'.format(len(samples) - failed, len(samples)))
+    return 1 if failed else 0
 
-    try:
-        subp.check_call([read_fastx, "-h"], stdout=DEVNULL, stderr=DEVNULL)
-    except Exception as e:
-        try:
-            read_fastx = os.path.join(os.path.join(os.path.dirname(__file__), "utils"), read_fastx)
-            subp.check_call([read_fastx, "-h"], stdout=DEVNULL, stderr=DEVNULL)
-        except Exception as e:
-            sys.stderr.write("OSError: fatal error running '{}'. Is it in the system path?\n".format(read_fastx))
-            sys.exit(1)
 
-    # checking bowtie2
+def check_bowtie2(exe=None):
     try:
         subp.check_call([exe if exe else 'bowtie2', "-h"], stdout=DEVNULL)
     except Exception as e:
         sys.stderr.write('OSError: "{}"\nFatal error running BowTie2. Is BowTie2 in the system path?\n'.format(e))
         sys.exit(1)
 
-    try:    
-        if fna_in:
-            readin = subp.Popen([read_fastx, '-l', str(read_min_len), fna_in], stdout=subp.PIPE, stderr=subp.PIPE)
 
-        else:
-            readin = subp.Popen([read_fastx, '-l', str(read_min_len)], stdin=sys.stdin, stdout=subp.PIPE, stderr=subp.PIPE)
+def start_bowtie2(bowtie2_db, preset, nproc, file_format="fasta", exe=None, mm=False, shards=1):
+    """Starts the BowTie2 processes mapping the reads written to their standard input
+
+    Returns:
+        (list, file, file): the processes, the stream of the input reads and the stream of the output SAM lines
+    """
+    bowtie2_cmd = [exe if exe else 'bowtie2', "--seed", "1992", "--quiet", "--no-unal", "--{}".format(preset),
+                   "-S", "-", "-x", bowtie2_db]
+
+    # the threads are split across the BowTie2 processes, sharing the memory-mapped index
+    bt2_nproc = max(1, int(nproc) // shards)
+    if bt2_nproc > 1:
+        bowtie2_cmd += ["-p", str(bt2_nproc)]
+
+    if mm or shards > 1:
+        bowtie2_cmd += ["--mm"]
+
+    bowtie2_cmd += ["-U", "-"]  # if not stat.S_ISFIFO(os.stat(fna_in).st_mode) else []
+
+    if file_format == "fasta":
+        bowtie2_cmd += ["-f"]
+
+    procs = [subp.Popen(bowtie2_cmd, stdout=subp.PIPE, stdin=subp.PIPE) for _ in range(shards)]
+    if shards == 1:
+        return procs, procs[0].stdin, procs[0].stdout
+    # the chunks of reads go to the processes in turn and the SAM batches are merged as they come
+    return (procs, RoundRobinWriter([p.stdin for p in procs]),
+            MergedLineReader([p.stdout for p in procs], b'@', SAM_BATCH_SIZE))
 
-        bowtie2_cmd = [exe if exe else 'bowtie2', "--seed", "1992", "--quiet", "--no-unal", "--{}".format(preset),
-                       "-S", "-", "-x", bowtie2_db]
 
-        if int(nproc) > 1:
-            bowtie2_cmd += ["-p", str(nproc)]
+def check_bowtie2_returncode(returncode):
+    if returncode == 13:
+        sys.stderr.write("Permission Denied Error: fatal error running BowTie2."
+                         "Is the BowTie2 file in the path with execution and read permissions?\n")
+        sys.exit(1)
+    elif returncode != 0:
+        sys.stderr.write("Error while running bowtie2.\n")
+        sys.exit(1)
 
-        bowtie2_cmd += ["-U", "-"]  # if not stat.S_ISFIFO(os.stat(fna_in).st_mode) else []
 
-        if file_format == "fasta":
-            bowtie2_cmd += ["-f"]
+def run_bowtie2(fna_in, outfmt6_out, bowtie2_db, preset, nproc, min_mapq_val, file_format="fasta",
+                exe=None, samout=None, min_alignment_len=None, read_min_len=0, profile_vsc_folder=False, verbose=False,
+                compression='auto', compression_level=None, db_markers=None, index=None, ordinals=False,
+                subsampler=None, prefilter=None, mm=False, shards=1):
+    check_bowtie2(exe)
 
-        p = subp.Popen(bowtie2_cmd, stdout=subp.PIPE, stdin=readin.stdout)
-        readin.stdout.close()
-        lmybytes, outf = (mybytes, bz2.BZ2File(outfmt6_out, "w")) if outfmt6_out.endswith(".bz2") else (str, open(outfmt6_out, "w"))
+    try:
+        procs, bt2_in, bt2_out = start_bowtie2(bowtie2_db, preset, nproc, file_format, exe, mm, shards)
+        readin = FastxFeeder(fna_in, bt2_in, min_len=read_min_len, nproc=int(nproc), subsampler=subsampler,
+                             prefilter=prefilter)
+        readin.start()
+        codec = None if compression == 'none' else compression
+        if db_markers is not None:
+            outf = None
+            outb = BinaryBowtie2outWriter(outfmt6_out, db_markers, index, ordinals, codec, compression_level)
+        else:
+            outf = QueuedWriter(compressed_open(outfmt6_out, 'wb', codec, compression_level), 'bowtie2out')
+        sam_filter = SamFilter(min_mapq_val, min_alignment_len)
 
         if profile_vsc_folder:
             CREAD=[]
@@ -563,41 +763,52 @@ def run_bowtie2(fna_in, outfmt6_out, bowtie2_db, preset, nproc, min_mapq_val, fi
 
         try:
             if samout:
-                if samout[-4:] == '.bz2':
-                    sam_file = bz2.BZ2File(samout, 'w')
-                else:
-                    sam_file = open(samout, 'wb')
+                # independent blocks compressed on nproc threads: multi-stream bz2, BGZF, multi-frame zstd/lz4
+                sam_file = QueuedWriter(compressed_open(samout, 'wb', codec, compression_level, nthreads=int(nproc)),
+                                        'samout')
         except IOError as e:
             sys.stderr.write('IOError: "{}"\nUnable to open sam output file.\n'.format(e))
             sys.exit(1)
-        for line in p.stdout:
-            if samout:
-                sam_file.write(line)
-
-            o = read_and_split_line(line)
-            if not o[0].startswith('@'):
-                if not o[2].endswith('*'):
-                    if (hex(int(o[1]) & 0x100) == '0x0'): #no secondary
-                        if mapq_filter(o[2], int(o[4]), min_mapq_val) :  # filter low mapq reads
-                            if ((min_alignment_len is None) or
-                                    (max([int(x.strip('M')) for x in re.findall(r'(\d*M)', o[5]) if x]) >= min_alignment_len)):
-                                                                # Profile viral markers in a different way
-                                if profile_vsc_folder and o[2].startswith('VDB|'):
-
-                                    mCluster = o[2]
-                                    mGroup = o[2].split('|')[2].split('-')[0]
 
-                                    list_of_viral_markers.write(mGroup+'\t'+mCluster+'\n')
-
-                                    if (hex(int(o[1]) & 0x10) == '0x0'): #front read
-                                        rr=SeqRecord(Seq(o[9]),letter_annotations={'phred_quality':[ord(_)-33 for _ in o[10][::-1]]}, id=o[0])
-                                    else:
-                                        rr=SeqRecord(Seq(o[9]).reverse_complement(),letter_annotations={'phred_quality':[ord(_)-33 for _ in o[10][::-1]]}, id=o[0])
-
-                                    CREAD.append(rr)
-
-                                # normal route for non-viral markers
-                                outf.write(lmybytes("\t".join([ o[0], o[2].split('/')[0] ]) + "\n"))
+        # parser stage: the SAM is read in batches of lines and passed to the writer stages
+        parser_wait = 0.0
+        while True:
+            t0 = time.perf_counter()
+            lines = bt2_out.readlines(SAM_BATCH_SIZE)
+            parser_wait += time.perf_counter() - t0
+            if not lines:
+                break
+            if samout:
+                sam_file.write(b''.join(lines))
+
+            mapped = []
+            for line in lines:
+                o = sam_filter.filter(line)
+                if o is None:
+                    continue
+                # Profile viral markers in a different way
+                if profile_vsc_folder and o[2].startswith(b'VDB|'):
+                    v = read_and_split_line(line)
+
+                    mCluster = v[2]
+                    mGroup = v[2].split('|')[2].split('-')[0]
+
+                    list_of_viral_markers.write(mGroup+'\t'+mCluster+'\n')
+
+                    if not (int(v[1]) & SamFilter.REVERSE): #front read
+                        rr=SeqRecord(Seq(v[9]),letter_annotations={'phred_quality':[ord(_)-33 for _ in v[10][::-1]]}, id=v[0])
+                    else:
+                        rr=SeqRecord(Seq(v[9]).reverse_complement(),letter_annotations={'phred_quality':[ord(_)-33 for _ in v[10][::-1]]}, id=v[0])
+
+                    CREAD.append(rr)
+
+                # normal route for non-viral markers
+                mapped.append((o[0], sam_filter.marker(o[2])[0]))
+            if mapped:
+                if outf is None:
+                    outb.write_hits(*zip(*mapped))
+                else:
+                    outf.write(b''.join([b'%s\t%s\n' % m for m in mapped]))
 
         if profile_vsc_folder and os.path.isdir(profile_vsc_folder):
             SeqIO.write(CREAD,profile_vsc_folder+'/v_reads.fq','fastq')
@@ -606,26 +817,44 @@ def run_bowtie2(fna_in, outfmt6_out, bowtie2_db, preset, nproc, min_mapq_val, fi
         if samout:  
             sam_file.close()
 
-        p.communicate()
-        read_fastx_stderr = readin.stderr.readlines()
-        nreads = None
-        avg_read_length = None
-        try:
-            nreads, avg_read_length = list(map(float, read_fastx_stderr[0].decode().split()))
-            if not nreads:
-                sys.stderr.write('Fatal error running MetaPhlAn. Total metagenome size was not estimated.\nPlease check your input files.\n')
-                sys.exit(1)
-            if not avg_read_length:
-                sys.stderr.write('Fatal error running MetaPhlAn. The average read length was not estimated.\nPlease check your input files.\n')
-                sys.exit(1)
-            outf.write(lmybytes('#nreads\t{}\n'.format(int(nreads))))
-            outf.write(lmybytes('#avg_read_length\t{}'.format(avg_read_length)))
-            outf.close()
-        except ValueError:
-            sys.stderr.write(b''.join(read_fastx_stderr).decode())
-            outf.close()
-            os.unlink(outfmt6_out)
+        readin.join()
+        returncode = next((c for c in [p.wait() for p in procs] if c != 0), 0)
+        if returncode != 0 or readin.exception is not None:
+            # a failing BowTie2 breaks the pipe of the feeder, its exit status is the error to report
+            if outf is not None:
+                try:
+                    outf.close()
+                except OSError:
+                    pass
+            else:
+                outb.abort()
+            for path in [outfmt6_out, samout]:
+                if path and os.path.isfile(path):
+                    os.unlink(path)
+            check_bowtie2_returncode(returncode)
+            sys.stderr.write('{}\n'.format(readin.exception))
+            sys.exit(1)
+        nreads, avg_read_length = readin.nreads, readin.avg_read_length
+        if not nreads:
+            sys.stderr.write('Fatal error running MetaPhlAn. Total metagenome size was not estimated.\nPlease check your input files.\n')
             sys.exit(1)
+        if not avg_read_length:
+            sys.stderr.write('Fatal error running MetaPhlAn. The average read length was not estimated.\nPlease check your input files.\n')
+            sys.exit(1)
+        if outf is None:
+            outb.close(nreads, avg_read_length)
+        else:
+            outf.write(mybytes('#nreads\t{}\n'.format(int(nreads))))
+            outf.write(mybytes('#avg_read_length\t{}'.format(avg_read_length)))
+            outf.close()
+
+        if verbose:
+            if prefilter is not None:
+                sys.stderr.write('Prefilter: {} of {} reads fed to BowTie2 ({:.1%} of the minimizer bits set)\n'.format(
+                    prefilter.nkept, prefilter.nreads, prefilter.fill))
+            sys.stderr.write('SAM parser: waited {:.2f} s for the BowTie2 output\n'.format(parser_wait))
+            for writer in [outf if outf is not None else outb.out] + ([sam_file] if samout else []):
+                sys.stderr.write(writer.stats() + '\n')
 
     except OSError as e:
         sys.stderr.write('OSError: "{}"\nFatal error running BowTie2.\n'.format(e))
@@ -634,14 +863,139 @@ def run_bowtie2(fna_in, outfmt6_out, bowtie2_db, preset, nproc, min_mapq_val, fi
         sys.stderr.write('IOError: "{}"\nFatal error running BowTie2.\n'.format(e))
         sys.exit(1)
 
-    if p.returncode == 13:
-        sys.stderr.write("Permission Denied Error: fatal error running BowTie2."
-                         "Is the BowTie2 file in the path with execution and read permissions?\n")
+    check_bowtie2_returncode(returncode)
+
+
+def read_manifest(manifest, columns, optional=0):
+    """Reads a tab-separated manifest of samples, one per line starting with the sample name, lines starting
+    with # are skipped
+
+    Args:
+        manifest (str): the path to the manifest
+        columns (list): the descriptions of the columns, to report the malformed lines
+        optional (int): the number of trailing columns that can be omitted, set to None
+
+    Returns:
+        list[tuple]: the columns of each sample
+    """
+    samples = []
+    with open(manifest) as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\r\n').split('\t')
+            if not len(columns) - optional <= len(fields) <= len(columns) or not all(fields):
+                sys.stderr.write('Error: line {} of {} should contain {} separated by tabs. Exiting...\n\n'.format(
+                    n, manifest, ', '.join(columns)))
+                sys.exit(1)
+            samples.append(tuple(fields) + (None,) * (len(columns) - len(fields)))
+    if not samples:
+        sys.stderr.write('Error: no samples found in {}. Exiting...\n\n'.format(manifest))
         sys.exit(1)
-    elif p.returncode != 0:
-        sys.stderr.write("Error while running bowtie2.\n")
+    if len(set(s[0] for s in samples)) < len(samples):
+        sys.stderr.write('Error: the sample names of {} are not unique. Exiting...\n\n'.format(manifest))
+        sys.exit(1)
+    return samples
+
+
+def run_bowtie2_multiplexed(samples, outputs, bowtie2_db, preset, nproc, min_mapq_val, file_format="fasta",
+                            exe=None, min_alignment_len=None, read_min_len=0, verbose=False, compression='auto',
+                            compression_level=None, db_markers=None, index=None, ordinals=False, prefilter=None,
+                            mm=False, shards=1):
+    """Maps the reads of several samples in a single BowTie2 run and demultiplexes the mapped reads into a
+    bowtie2out file per sample, the read IDs are the same as when mapping each sample on its own
+
+    Returns:
+        list: None for the samples mapped successfully, the error of the others (their output is removed)
+    """
+    check_bowtie2(exe)
+
+    try:
+        procs, bt2_in, bt2_out = start_bowtie2(bowtie2_db, preset, nproc, file_format, exe, mm, shards)
+        readin = MultiplexedFeeder(samples, bt2_in, min_len=read_min_len, nproc=int(nproc), prefilter=prefilter)
+        readin.start()
+        codec = None if compression == 'none' else compression
+        if db_markers is not None:
+            outs = [BinaryBowtie2outWriter(outputs[0], db_markers, index, ordinals, codec, compression_level)]
+            outs += [BinaryBowtie2outWriter(o, db_markers, index, ordinals, codec, compression_level, outs[0].marker_ids)
+                     for o in outputs[1:]]
+        else:
+            outs = [QueuedWriter(compressed_open(o, 'wb', codec, compression_level), 'bowtie2out') for o in outputs]
+        sam_filter = SamFilter(min_mapq_val, min_alignment_len)
+
+        parser_wait = 0.0
+        while True:
+            t0 = time.perf_counter()
+            lines = bt2_out.readlines(SAM_BATCH_SIZE)
+            parser_wait += time.perf_counter() - t0
+            if not lines:
+                break
+            mapped = [[] for _ in outputs]
+            for line in lines:
+                o = sam_filter.filter(line)
+                if o is None:
+                    continue
+                sample, read_id = split_sample_tag(o[0])
+                mapped[sample].append((read_id, sam_filter.marker(o[2])[0]))
+            for out, hits in zip(outs, mapped):
+                if not hits:
+                    continue
+                if db_markers is not None:
+                    out.write_hits(*zip(*hits))
+                else:
+                    out.write(b''.join([b'%s\t%s\n' % m for m in hits]))
+
+        readin.join()
+        returncode = next((c for c in [p.wait() for p in procs] if c != 0), 0)
+        if returncode != 0 or readin.exception is not None:
+            # a failing BowTie2 breaks the pipe of the feeder, its exit status is the error to report
+            for out, output in zip(outs, outputs):
+                if db_markers is None:
+                    try:
+                        out.close()
+                    except OSError:
+                        pass
+                else:
+                    out.abort()
+                if os.path.isfile(output):
+                    os.unlink(output)
+            check_bowtie2_returncode(returncode)
+            sys.stderr.write('{}\n'.format(readin.exception))
+            sys.exit(1)
+
+        errors = []
+        for (nreads, avg_read_length), error, out, output in zip(
+                [s or (0, 0) for s in readin.stats], readin.errors, outs, outputs):
+            if error is None and not nreads:
+                error = ValueError('Total metagenome size was not estimated.\n')
+            if error is not None:
+                if db_markers is None:
+                    out.close()
+                else:
+                    out.abort()
+                if os.path.exists(output):
+                    os.unlink(output)
+            elif db_markers is not None:
+                out.close(nreads, avg_read_length)
+            else:
+                out.write(mybytes('#nreads\t{}\n'.format(int(nreads))))
+                out.write(mybytes('#avg_read_length\t{}'.format(avg_read_length)))
+                out.close()
+            errors.append(error)
+
+        if verbose:
+            if prefilter is not None:
+                sys.stderr.write('Prefilter: {} of {} reads fed to BowTie2 ({:.1%} of the minimizer bits set)\n'.format(
+                    prefilter.nkept, prefilter.nreads, prefilter.fill))
+            sys.stderr.write('SAM parser: waited {:.2f} s for the BowTie2 output\n'.format(parser_wait))
+
+    except OSError as e:
+        sys.stderr.write('OSError: "{}"\nFatal error running BowTie2.\n'.format(e))
         sys.exit(1)
 
+    check_bowtie2_returncode(returncode)
+    return errors
+
 class TaxClade:
     min_cu_len = -1
     markers2lens = None
@@ -650,6 +1004,7 @@ class TaxClade:
     quantile = None
     avoid_disqm = False
     avg_read_length = 1
+    misidentified = set()
 
     def __init__( self, name, tax_id, uncl = False):
         self.children, self.markers2nreads = {}, {}
@@ -658,6 +1013,7 @@ class TaxClade:
         self.abundance, self.uncl_abundance = None, 0
         self.nreads, self.uncl_nreads = 0, 0
         self.tax_id = tax_id
+        self.full_name, self.full_taxids = None, None
 
     def add_child( self, name, tax_id ):
         new_clade = TaxClade( name, tax_id )
@@ -675,6 +1031,8 @@ class TaxClade:
         return terms
 
     def get_full_taxids( self ):
+        if self.full_taxids is not None:
+            return self.full_taxids
         fullname = ['']
         if self.tax_id:
             fullname = [self.tax_id]
@@ -685,6 +1043,8 @@ class TaxClade:
         return "|".join(fullname[1:])
 
     def get_full_name( self ):
+        if self.full_name is not None:
+            return self.full_name
         fullname = [self.name]
         cl = self.father
         while cl:
@@ -698,7 +1058,8 @@ class TaxClade:
 
     def compute_mapped_reads( self ):    
         tax_level = 't__' if SGB_ANALYSIS else 's__'
-        if self.nreads != 0 or self.name.startswith(tax_level):
+        # the clades without abundance have no reads in their subtree
+        if self.nreads != 0 or self.name.startswith(tax_level) or not self.abundance:
             return self.nreads
         for c in self.children.values():
             self.nreads += c.compute_mapped_reads()
@@ -715,25 +1076,10 @@ class TaxClade:
 
         rat_nreads, removed = [], []
         for marker, n_reads in sorted(self.markers2nreads.items(),key=lambda x:x[0]):
-            misidentified = False
-
-            if not self.avoid_disqm:
-                for ext in self.markers2exts[marker]:
-                    ext_clade = self.taxa2clades[ext]
-                    m2nr = ext_clade.markers2nreads
-                    
-                    tocladetmp = ext_clade
-                    while len(tocladetmp.children) == 1:
-                        tocladetmp = list(tocladetmp.children.values())[0]
-                        m2nr = tocladetmp.markers2nreads
-
-                    nonzeros = sum([v>0 for v in m2nr.values()])
-                    if len(m2nr):
-                        if float(nonzeros) / len(m2nr) > self.perc_nonzero:
-                            misidentified = True
-                            removed.append( (self.markers2lens[marker],n_reads) )
-                            break
-            if not misidentified:
+            # the quasi-markers of an external clade present in the sample (see TaxTree.disambiguate)
+            if not self.avoid_disqm and marker in self.misidentified:
+                removed.append( (self.markers2lens[marker],n_reads) )
+            else:
                 rat_nreads.append( (self.markers2lens[marker],n_reads) )
 
         if not self.avoid_disqm and len(removed):
@@ -823,6 +1169,9 @@ class TaxTree:
         TaxClade.markers2exts = self.markers2exts
         TaxClade.taxa2clades = self.taxa2clades
         self.avg_read_length = 1
+        self.array_tree = None
+        self.mapped_markers = set()
+        self.abundance_entries, self.profiles = None, {}
 
         for clade, value in mpa['taxonomy'].items():
             clade = clade.strip().split("|")
@@ -861,6 +1210,23 @@ class TaxTree:
         
         add_lens(self.root)
 
+        # the lineage of each clade, as returned by get_full_name and get_full_taxids, computed once from the one of
+        # its father (the taxids are left to get_full_taxids when a father has none)
+        self.root.full_name, self.root.full_taxids = '', ''
+        stack = list(self.root.children.values())
+        while stack:
+            clade = stack.pop()
+            father = clade.father
+            taxid = clade.tax_id if clade.tax_id else ''
+            if father is self.root:
+                clade.full_name, clade.full_taxids = clade.name, taxid
+            else:
+                clade.full_name = father.full_name + '|' + clade.name
+                if father.full_taxids is not None and father.tax_id is not None:
+                    clade.full_taxids = father.full_taxids + '|' + taxid
+            stack.extend(clade.children.values())
+        self.ignored_clades = {}
+
         # for k,p in mpa_pkl['markers'].items():
         for k, p in mpa['markers'].items():
             if k in markers_to_ignore:
@@ -870,9 +1236,49 @@ class TaxTree:
             self.add_reads(k, 0)
             self.markers2exts[k] = p['ext']
 
+        # the clade whose markers are checked for each external clade of the quasi-markers, descending the clades
+        # with a single child, and the quasi-markers depending on each of these clades. The index is built with the
+        # tree rather than stored in the database cache: it maps to the TaxClade objects of this tree, and the
+        # marker->ext lists it is built from are already read from the cache (ext_offsets, ext_ids)
+        self.exts2clades, self.ext_clades2markers = {}, defdict(list)
+        for marker, exts in self.markers2exts.items():
+            for ext in exts:
+                if ext not in self.exts2clades:
+                    ext_clade = self.taxa2clades[ext]
+                    while len(ext_clade.children) == 1:
+                        ext_clade = list(ext_clade.children.values())[0]
+                    self.exts2clades[ext] = ext_clade
+                self.ext_clades2markers[self.exts2clades[ext]].append(marker)
+
+    def use_array_engine( self ):
+        """Computes the abundances of the clades with ArrayTaxTree instead of TaxClade.compute_abundance"""
+        self.array_tree = ArrayTaxTree(self, SGB_ANALYSIS)
+
     def set_min_cu_len( self, min_cu_len ):
         TaxClade.min_cu_len = min_cu_len
 
+    def reset( self ):
+        """Clears the reads and the abundances of the profiled sample, to profile another sample with the same tree"""
+        for clade in [self.root] + list(self.all_clades.values()):
+            for marker in clade.markers2nreads:
+                clade.markers2nreads[marker] = 0
+            clade.abundance, clade.uncl_abundance = None, 0
+            clade.nreads, clade.uncl_nreads = 0, 0
+            clade.subcl_uncl = False
+        self.mapped_markers.clear()
+        self.profiles.clear()
+
+    def disambiguate( self ):
+        """Finds the quasi-markers of an external clade with reads on more than perc_nonzero of its markers,
+        counting the reads of the mapped markers only"""
+        nonzeros = Counter(self.markers2clades[marker] for marker in self.mapped_markers)
+        misidentified = set()
+        for clade, n in nonzeros.items():
+            clade = self.all_clades[clade]
+            if clade in self.ext_clades2markers and float(n) / len(clade.markers2nreads) > TaxClade.perc_nonzero:
+                misidentified.update(self.ext_clades2markers[clade])
+        TaxClade.misidentified = misidentified
+
     def set_stat( self, stat, quantile, perc_nonzero, avg_read_length, avoid_disqm = False):
         TaxClade.stat = stat
         TaxClade.perc_nonzero = perc_nonzero
@@ -880,6 +1286,27 @@ class TaxTree:
         TaxClade.avoid_disqm = avoid_disqm
         TaxClade.avg_read_length = avg_read_length
 
+    def get_ignored_clades( self, add_viruses = False, ignore_eukaryotes = False, ignore_bacteria = False,
+                            ignore_archaea = False, ignore_ksgbs = False, ignore_usgbs = False ):
+        """Returns the names of the clades whose markers are discarded by the filters of add_reads, computed once
+        for each combination of the filters"""
+        filters = (SGB_ANALYSIS, add_viruses, ignore_eukaryotes, ignore_bacteria, ignore_archaea, ignore_ksgbs,
+                   ignore_usgbs)
+        if filters not in self.ignored_clades:
+            ignored = set()
+            for clade, cl in self.all_clades.items():
+                cn = cl.full_name
+                sgb = '_SGB' in cn.split('|')[-2] if '|' in cn else False
+                if ((ignore_archaea and cn.startswith("k__Archaea")) or
+                        (ignore_bacteria and cn.startswith("k__Bacteria")) or
+                        (ignore_eukaryotes and cn.startswith("k__Eukaryota")) or
+                        (not SGB_ANALYSIS and not add_viruses and cn.startswith("k__Vir")) or
+                        (SGB_ANALYSIS and ignore_ksgbs and not sgb) or
+                        (SGB_ANALYSIS and ignore_usgbs and sgb)):
+                    ignored.add(clade)
+            self.ignored_clades[filters] = ignored
+        return self.ignored_clades[filters]
+
     def add_reads(  self, marker, n,
                     add_viruses = False,
                     ignore_eukaryotes = False,
@@ -887,27 +1314,16 @@ class TaxTree:
                     ignore_ksgbs = False, ignore_usgbs = False  ):
         clade = self.markers2clades[marker]
         cl = self.all_clades[clade]
-        if ignore_bacteria or ignore_archaea or ignore_eukaryotes:
-            cn = cl.get_full_name()
-            if ignore_archaea and cn.startswith("k__Archaea"):
-                return (None, None)
-            if ignore_bacteria and cn.startswith("k__Bacteria"):
-                return (None, None)
-            if ignore_eukaryotes and cn.startswith("k__Eukaryota"):
-                return (None, None)
-        if not SGB_ANALYSIS and not add_viruses:
-            cn = cl.get_full_name()
-            if not add_viruses and cn.startswith("k__Vir"):
-                return (None, None)
-        if SGB_ANALYSIS and (ignore_ksgbs or ignore_usgbs):
-            cn = cl.get_full_name()
-            if ignore_ksgbs and not '_SGB' in cn.split('|')[-2]:
-                return (None, None)
-            if ignore_usgbs and '_SGB' in cn.split('|')[-2]:
-                return (None, None)
+        if clade in self.get_ignored_clades(add_viruses, ignore_eukaryotes, ignore_bacteria, ignore_archaea,
+                                            ignore_ksgbs, ignore_usgbs):
+            return (None, None)
         # while len(cl.children) == 1:
             # cl = list(cl.children.values())[0]
         cl.markers2nreads[marker] = n
+        if n > 0:
+            self.mapped_markers.add(marker)
+        else:
+            self.mapped_markers.discard(marker)
         return (cl.get_full_name(), cl.get_full_taxids(), )
 
 
@@ -929,133 +1345,252 @@ class TaxTree:
             cl2pr[v.get_full_name()] = prof
         return cl2pr
 
+    def get_abundance_entries( self ):
+        """Returns the entries of the profile of each kingdom, in the order of get_all_abundances sorted by name,
+        with their lineage and the clade of their estimated reads computed once for the tree
+
+        Each entry is the name, the taxid, the clade and the kind of abundance (the abundance of the clade, of its
+        unclassified subclades or of its unclassified lower rank), followed by the full name and the full taxids,
+        the clade whose reads are estimated from the abundance, and the clades of the estimated reads of the
+        entry with and without --tax_lev.
+        """
+        if self.abundance_entries is not None:
+            return self.abundance_entries
+        tax_level = 't__' if SGB_ANALYSIS else 's__'
+        est_clades = dict([((clade.get_full_name(), clade.get_full_taxids()), clade) for clade in self.all_clades.values()
+                           if SGB_ANALYSIS or clade.name[:3] != 't__'])
+        self.abundance_entries = []
+        for tax_label, kingdom in self.all_clades.items():
+            if not tax_label.startswith("k__") or kingdom.uncl:
+                continue
+            entries, stack = [], [kingdom]
+            while stack:
+                clade = stack.pop()
+                entries.append((clade.name, clade.tax_id, clade, 'abundance'))
+                if clade.children:
+                    lchild = list(clade.children.values())[0].name[:3]
+                    entries.append((lchild+clade.name[3:]+"_unclassified", "", clade, 'uncl_abundance'))
+                elif clade.name[0] not in tax_units[-2:]:
+                    cind = tax_units.index( clade.name[0] )
+                    entries.append((tax_units[cind+1]+clade.name[1:]+"_unclassified", "", clade, 'subcl_uncl'))
+                stack.extend(reversed(list(clade.children.values())))
+
+            for clade_label, tax_id, clade, kind in sorted(entries, key=lambda pars:pars[0]):
+                if not SGB_ANALYSIS and clade_label[:3] == 't__':
+                    continue
+                reads_clade = None
+                if clade_label not in self.all_clades:
+                    to = tax_units.index(clade_label[0])
+                    t = tax_units[to-1]
+                    full_label = t + clade_label.split("_unclassified")[0][1:]
+                    full_tax_id = self.all_clades[full_label].get_full_taxids()
+                    full_label = self.all_clades[full_label].get_full_name()
+                    spl = full_label.split("|")
+                    full_label = "|".join(spl+[tax_units[to]+spl[-1][1:]+"_unclassified"])
+                else:
+                    full_tax_id = self.all_clades[clade_label].get_full_taxids()
+                    if tax_level in clade_label:
+                        reads_clade = self.all_clades[clade_label]
+                    full_label = self.all_clades[clade_label].get_full_name()
+                self.abundance_entries.append((clade_label, tax_id, clade, kind, full_label, full_tax_id, reads_clade,
+                                               est_clades.get((full_label, full_tax_id)),
+                                               est_clades.get((clade_label, tax_id))))
+        return self.abundance_entries
+
     def relative_abundances( self, tax_lev  ):
+        """Returns the relative abundance of the clades at the tax_lev rank (all the ranks if None), the abundance
+        and the estimated reads of the clades and the total of the estimated reads
+
+        The profile is computed in a single pass on the entries of get_abundance_entries, estimating the reads of
+        the clades with abundance only, and kept until the tree is reset, so that the outputs and the estimation of
+        the unclassified reads of a sample share it.
+        """
+        if tax_lev in self.profiles:
+            return self.profiles[tax_lev]
         clade2abundance_n = dict([(tax_label, clade) for tax_label, clade in self.all_clades.items()
                     if tax_label.startswith("k__") and not clade.uncl])
 
-        clade2abundance, clade2est_nreads, tot_ab, tot_reads = {}, {}, 0.0, 0
+        clade2abundance, clade2est_nreads, tot_ab, tot_reads = {}, [], 0.0, 0
 
+        if any(clade.abundance is None for clade in clade2abundance_n.values()):
+            if self.array_tree is not None:
+                self.array_tree.set_abundances()
+            elif not TaxClade.avoid_disqm:
+                self.disambiguate()
         for tax_label, clade in clade2abundance_n.items():
             tot_ab += clade.compute_abundance()
 
-        for tax_label, clade in clade2abundance_n.items():
-            for clade_label, tax_id, abundance in sorted(clade.get_all_abundances(), key=lambda pars:pars[0]):
-                if SGB_ANALYSIS or clade_label[:3] != 't__':
-                    if not tax_lev:
-                        if clade_label not in self.all_clades:
-                            to = tax_units.index(clade_label[0])
-                            t = tax_units[to-1]
-                            clade_label = t + clade_label.split("_unclassified")[0][1:]
-                            tax_id = self.all_clades[clade_label].get_full_taxids()
-                            clade_label = self.all_clades[clade_label].get_full_name()
-                            spl = clade_label.split("|")
-                            clade_label = "|".join(spl+[tax_units[to]+spl[-1][1:]+"_unclassified"])
-                            glen = self.all_clades[spl[-1]].glen
-                        else:
-                            glen = self.all_clades[clade_label].glen
-                            tax_id = self.all_clades[clade_label].get_full_taxids()
-                            tax_level = 't__' if SGB_ANALYSIS else 's__' 
-                            if tax_level in clade_label and abundance > 0:
-                                self.all_clades[clade_label].nreads = int(np.floor(abundance*glen))
-
-                            clade_label = self.all_clades[clade_label].get_full_name()
-                    elif not clade_label.startswith(tax_lev):
-                        if clade_label in self.all_clades:
-                            glen = self.all_clades[clade_label].glen
-                        else:
-                            glen = 1.0
-                        continue
-                    clade2abundance[(clade_label, tax_id)] = abundance
-        
+        for (clade_label, tax_id, clade, kind, full_label, full_tax_id, reads_clade, est_clade,
+                lev_est_clade) in self.get_abundance_entries():
+            if kind == 'uncl_abundance':
+                if not clade.uncl_abundance > 0.0:
+                    continue
+                abundance = clade.uncl_abundance
+            elif kind == 'subcl_uncl' and not clade.subcl_uncl:
+                continue
+            else:
+                abundance = clade.abundance
+            if not tax_lev:
+                if reads_clade is not None and abundance > 0:
+                    reads_clade.nreads = int(np.floor(abundance*reads_clade.glen))
+                tax = (full_label, full_tax_id)
+            elif clade_label.startswith(tax_lev):
+                tax, est_clade = (clade_label, tax_id), lev_est_clade
+            else:
+                continue
+            clade2abundance[tax] = abundance
+            if est_clade is not None:
+                clade2est_nreads.append((tax, est_clade))
+
         for tax_label, clade in clade2abundance_n.items():
             tot_reads += clade.compute_mapped_reads()
 
-        for clade_label, clade in self.all_clades.items():
-            if SGB_ANALYSIS or clade.name[:3] != 't__':
-                nreads = clade.nreads
-                clade_label = clade.get_full_name()
-                tax_id = clade.get_full_taxids()
-                clade2est_nreads[(clade_label, tax_id)] = nreads
-
         ret_d = dict([( tax, float(abundance) / tot_ab if tot_ab else 0.0) for tax, abundance in clade2abundance.items()])
 
-        ret_r = dict([( tax, (abundance, clade2est_nreads[tax] )) for tax, abundance in clade2abundance.items() if tax in clade2est_nreads])
+        ret_r = dict([( tax, (clade2abundance[tax], clade.nreads )) for tax, clade in clade2est_nreads])
 
         if tax_lev:
             ret_d[("UNCLASSIFIED", '-1')] = 1.0 - sum(ret_d.values())
-        return ret_d, ret_r, tot_reads
-
-def mapq_filter(marker_name, mapq_value, min_mapq_val):
-    ##if 'GeneID:' in marker_name:
-    if 'GeneID:' in marker_name or 'VDB' in marker_name:
-        return True
-    else:
-        if mapq_value > min_mapq_val:
-            return True
-    return False
-
-
-def separate_reads2markers(reads2markers):
+        if not tax_lev:
+            # the reads estimated for all the ranks change the profiles of the single ranks
+            self.profiles.clear()
+        self.profiles[tax_lev] = ret_d, ret_r, tot_reads
+        return self.profiles[tax_lev]
+
+def mapping_class(marker):
+    """Returns the class of a marker whose mapped reads are subsampled proportionally, None if they are not sampled"""
     if not SGB_ANALYSIS:
-        return reads2markers, {}
-    else:
-        return {r: m for r, m in reads2markers.items() if ('SGB' in m or 'EUK' in m) and not 'VDB' in m}, {r: m for r, m in reads2markers.items() if 'VDB' in m and not ('SGB' in m or 'EUK' in m)}
-
-def map2bbh(mapping_f, min_mapq_val, input_type='bowtie2out', min_alignment_len=None, nreads=None, mapping_subsampling=False, subsampling=None, subsampling_seed='1992', remove_input=False):
-    if not mapping_f:
-        ras, ras_line, inpf = plain_read_and_split, plain_read_and_split_line, sys.stdin
-    else:
-        if mapping_f.endswith(".bz2"):
-            ras, ras_line, inpf = read_and_split, read_and_split_line, bz2.BZ2File(mapping_f, "r")
-        else:
-            ras, ras_line, inpf = plain_read_and_split, plain_read_and_split_line, open(mapping_f)
+        return 'all'
+    if ('SGB' in marker or 'EUK' in marker) and not 'VDB' in marker:
+        return 'SGB'
+    if 'VDB' in marker and not ('SGB' in marker or 'EUK' in marker):
+        return 'VDB'
+    return None
+
+def peak_rss_mb():
+    """Returns the peak resident set size of the process in MB"""
+    if os.path.exists('/proc/self/status'):  # ru_maxrss on Linux also accounts the parent of a spawned process
+        with open('/proc/self/status') as rf:
+            for line in rf:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KB on Linux
+
+def read_bowtie2out_batches(inpf, trailer):
+    """Yields the lines of the mapped reads of a text bowtie2out file in batches, collecting the trailer lines"""
+    while True:
+        lines = inpf.readlines(SAM_BATCH_SIZE)
+        if not lines:
+            break
+        while lines and lines[-1][:1] == b'#':  # the #nreads and #avg_read_length lines end the file
+            trailer.append(lines.pop())
+        yield lines
+
+def parse_bowtie2out_trailer(trailer):
+    """Returns the number of reads and the average read length stored in the trailer lines of a text bowtie2out file"""
+    n_metagenome_reads, avg_read_length = None, 1
+    for line in trailer:
+        r, c = read_and_split_line(line)[:2]
+        if 'nreads' in r:
+            n_metagenome_reads = int(c)
+        elif 'avg_read_length' in r:
+            avg_read_length = float(c)
+    return n_metagenome_reads, avg_read_length
+
+def peek_bowtie2out_nreads(mapping_f):
+    """Returns the number of reads stored at the end of an uncompressed text bowtie2out file, None if it cannot be read in advance"""
+    if not mapping_f or not os.path.isfile(mapping_f) or detect_codec(mapping_f) is not None:
+        return None
+    with open(mapping_f, 'rb') as rf:
+        rf.seek(max(0, os.path.getsize(mapping_f) - 1024))
+        return parse_bowtie2out_trailer([l for l in rf.read().split(b'\n') if l[:1] == b'#'])[0]
+
+def count_bowtie2out(inpf):
+    """Counts the reads mapped to each marker in a text bowtie2out file without keeping the read IDs"""
+    counts = Counter()
+    trailer = []
+    for lines in read_bowtie2out_batches(inpf, trailer):
+        counts.update([l[l.rfind(b'\t') + 1:].rstrip() for l in lines])
+    return ({m.decode(): c for m, c in counts.items()},) + parse_bowtie2out_trailer(trailer)
+
+def map2bbh(mapping_f, min_mapq_val, input_type='bowtie2out', min_alignment_len=None, nreads=None, mapping_subsampling=False, subsampling=None, subsampling_seed='1992', remove_input=False, db_markers=None, read_ids=False):
+    """Returns the reads mapped to each marker, or only their number when the read IDs are not needed (read_ids=False)
+    and the mapping results are not subsampled"""
+    inpf = compressed_open(mapping_f if mapping_f else sys.stdin.buffer, 'rb')
+    subsample = subsampling is not None and mapping_subsampling
 
     reads2markers = {}
+    markers2reads = None  # set when the hits are directly grouped by marker
+    sampler = None  # the one-pass subsampler of the text and SAM mapping results
     n_metagenome_reads = None
     avg_read_length = 1 #Set to 1 if it is not calculated from read_fastx
 
-    if input_type == 'bowtie2out':
-        for r, c in ras(inpf):
-            if r.startswith('#') and 'nreads' in r:
-                n_metagenome_reads = int(c)
-            if r.startswith('#') and 'avg_read_length' in r:
-                avg_read_length = float(c)
-            else:
-                reads2markers[r] = c
+    if input_type == 'bowtie2out' and is_binary_bowtie2out(inpf):
+        try:
+            header, marker_ids, ordinals, marker_names = load_binary_bowtie2out(mapping_f if mapping_f else inpf, db_markers)
+        except ValueError as e:
+            sys.stderr.write('Error: {}\n'.format(e))
+            sys.exit(1)
+        inpf.close()
+        if read_ids:
+            sys.stderr.write('Error: the binary bowtie2out file does not store the read names needed by -t reads_map, '
+                             'generate it with --bowtie2out_format text. Exiting...\n\n')
+            sys.exit(1)
+        n_metagenome_reads, avg_read_length = header['nreads'], header['avg_read_length']
+        # the reads are identified by their ordinals, or by their position when not stored
+        reads = ordinals if ordinals is not None else np.arange(len(marker_ids))
+        if subsample and subsampling < n_metagenome_reads:
+            selected = subsample_arrays(reads, marker_ids, marker_names, subsampling, subsampling_seed, mapping_class, n_metagenome_reads)
+            reads, marker_ids = reads[selected], marker_ids[selected]
+        counts = np.bincount(marker_ids, minlength=len(marker_names))
+        markers2reads = {marker_names[i]: c for i, c in enumerate(counts.tolist()) if c}
+    elif input_type == 'bowtie2out' and not (read_ids or subsample):
+        markers2reads, n_metagenome_reads, avg_read_length = count_bowtie2out(inpf)
+        inpf.close()
+    elif input_type == 'bowtie2out' and subsample:
+        sampler = MappingSubsampler(subsampling, subsampling_seed, mapping_class, peek_bowtie2out_nreads(mapping_f))
+        trailer = []
+        for lines in read_bowtie2out_batches(inpf, trailer):
+            hits = [l.split() for l in lines]
+            sampler.add_hits([h[0] for h in hits], [h[1] for h in hits])
+        n_metagenome_reads, avg_read_length = parse_bowtie2out_trailer(trailer)
+    elif input_type == 'bowtie2out':
+        trailer = []
+        for lines in read_bowtie2out_batches(inpf, trailer):
+            reads2markers.update(map(read_and_split_line, lines))
+        n_metagenome_reads, avg_read_length = parse_bowtie2out_trailer(trailer)
     elif input_type == 'sam':
         n_metagenome_reads = nreads 
+        if subsample:
+            sampler = MappingSubsampler(subsampling, subsampling_seed, mapping_class, n_metagenome_reads)
+        sam_filter = SamFilter(min_mapq_val, min_alignment_len)
         for line in inpf:
-            o = ras_line(line)
-            if ((o[0][0] != '@') and #no header
-                (o[2][-1] != '*') and # no unmapped reads
-                (hex(int(o[1]) & 0x100) == '0x0') and #no secondary
-                mapq_filter(o[2], int(o[4]), min_mapq_val) and # filter low mapq reads
-                ( (min_alignment_len is None) or ( max(int(x.strip('M')) for x in re.findall(r'(\d*M)', o[5]) if x) >= min_alignment_len ) )
-            ):
-                    reads2markers[o[0]] = o[2].split('/')[0]
+            o = sam_filter.filter(line)
+            if o is None:
+                continue
+            if sampler is not None:
+                sampler.add(o[0], sam_filter.marker(o[2])[0])
+            else:
+                reads2markers[o[0].decode()] = sam_filter.marker(o[2])[0].decode()
     inpf.close()
+    if sampler is not None:
+        reads2markers = sampler.sample(n_metagenome_reads)
     
-    if subsampling is not None and mapping_subsampling:
+    if subsample:
         if subsampling >= n_metagenome_reads:
             sys.stderr.write("WARNING: The specified subsampling ({}) is equal or higher than the original number of reads ({}). Subsampling will be skipped.\n".format(subsampling, n_metagenome_reads))
         else:
-            reads2markers =  dict(sorted(reads2markers.items()))
-            if subsampling_seed.lower() != 'random':
-                random.seed(int(subsampling_seed))
-            reads2filtmarkers = {}
-            sgb_reads2markers, viral_reads2markers = separate_reads2markers(reads2markers)            
-            n_sgb_mapped_reads = int((len(sgb_reads2markers) * subsampling) / n_metagenome_reads)
-            reads2filtmarkers = { r:sgb_reads2markers[r] for r in random.sample(list(sgb_reads2markers.keys()), n_sgb_mapped_reads) }     
-            if SGB_ANALYSIS:       
-                n_viral_mapped_reads = int((len(viral_reads2markers) * subsampling) / n_metagenome_reads)
-                reads2filtmarkers.update({ r:viral_reads2markers[r] for r in random.sample(list(viral_reads2markers.keys()), n_viral_mapped_reads) })            
-            reads2markers = reads2filtmarkers
-            sgb_reads2markers.clear()
-            viral_reads2markers.clear()
             n_metagenome_reads = subsampling
     elif subsampling is None and n_metagenome_reads < 10000:
         sys.stderr.write("WARNING: The number of reads in the sample ({}) is below the recommended minimum of 10,000 reads.\n".format(n_metagenome_reads))
-        
+
+    if markers2reads is not None:
+        return (markers2reads, n_metagenome_reads, avg_read_length)
+
+    if not read_ids:
+        return (dict(Counter(reads2markers.values())), n_metagenome_reads, avg_read_length)
+
     markers2reads = defdict(set)   
     for r, m in reads2markers.items():
         markers2reads[m].add(r)
@@ -1147,201 +1682,422 @@ def maybe_generate_biom_file(tree, pars, abundance_predictions):
 
     return True
 
-def _make_gen_fastq(reader):
-    b = reader(1024 * 1024) 
-    while (b):
-        yield b
-        b = reader(1024 * 1024)
-
-def rawpycount(filename):
-    f = bz2.BZ2File(filename, 'rb') if filename.endswith(".bz2") else gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')
-    f_gen = _make_gen_fastq(f.read)
-    n_metagenome_reads = sum( buf.count(b'\n') for buf in f_gen)
-    f.close()
-    return n_metagenome_reads
-
-def subsample_file(inp, paired, subsampling, out, sample):         
-    length, read_num = 0, -1
-    counter=0
-    out_l = out
-    for inp_f in inp.split(','):
-        if paired:
-            length, read_num = 0, -1  
-            out=out_l[counter]
-            counter+=1
-        line = 1
-        reader = bz2.open(inp_f, 'rt') if inp_f.endswith(".bz2") else gzip.open(inp_f, 'rt') if inp_f.endswith('.gz') else open(inp_f, 'r')
-        while (line and length < subsampling):
-            line = reader.readline()
-            read_num += 1
-            if read_num in sample:
-                length += 1
-                out.write(line)       
-                for _ in range(3):
-                    out.write(reader.readline())
-            else:
-                for _ in range(3):
-                    reader.readline()
-        reader.close()
-    out.close()
-    
-def subsample_reads(inp, subsampling, subsampling_seed, subsampling_output, tmp_dir, paired):
-
-    n_metagenome_reads = execute_pool(((rawpycount, inp_f) for inp_f in inp.split(',')), 2)
-    n_metagenome_reads = [int(n/4) for n in n_metagenome_reads]
-
-    if subsampling >= sum(n_metagenome_reads):
-        sys.stderr.write("WARNING: The specified subsampling ({}) is equal or higher than the original number of reads ({}). Subsampling will be skipped.\n".format(subsampling, sum(n_metagenome_reads))) 
-        return inp, None
-
-    if paired:
-        subsampling //= 2
-        if n_metagenome_reads[0] != n_metagenome_reads[1]:
-            sys.stderr.write("Error: The specified reads file are not the same length! Make sure the forward and reverse reads are files are not damaged and reads are in the same order. Exiting ...\n\n") 
-            sys.exit(1)
-        n_metagenome_reads = n_metagenome_reads[0]
-    else:
-        n_metagenome_reads = sum(n_metagenome_reads)
+def add_marker_reads(pars, tree, markers2reads, read_ids=False):
+    """Adds the reads mapped to each marker to the tree, returning the reads_map lines when the read IDs are kept"""
+    map_out = []
+    for marker,reads in sorted(markers2reads.items(), key=lambda pars: pars[0]):
+        if marker not in tree.markers2lens:
+            continue
+        tax_seq, ids_seq = tree.add_reads( marker, len(reads) if read_ids else reads,
+                                  add_viruses = pars['add_viruses'],
+                                  ignore_eukaryotes = pars['ignore_eukaryotes'],
+                                  ignore_bacteria = pars['ignore_bacteria'],
+                                  ignore_archaea = pars['ignore_archaea'],
+                                  ignore_ksgbs = pars['ignore_ksgbs'],
+                                  ignore_usgbs = pars['ignore_usgbs']
+                                  )
+        if tax_seq and read_ids:
+            map_out +=["\t".join([r, tax_seq, ids_seq]) for r in sorted(reads)]
+    return map_out
+
+
+def mapped_fraction(tree, tax_lev, n_metagenome_reads):
+    """Estimates the fraction of the reads of the metagenome coming from the detected clades (--unclassified_estimation)"""
+    mapped_reads = 0
+    cl2pr = tree.clade_profiles( tax_lev )
+    cl2ab, _, _ = tree.relative_abundances( tax_lev )
+    confident_taxa = [taxstr for (taxstr, _),relab in cl2ab.items() if relab > 0.0]
+    for c, m in cl2pr.items():
+        if c in confident_taxa:
+            markers_cov = [a  / 1000 for _, a in m if a > 0]
+            mapped_reads += np.mean(markers_cov) * tree.all_clades[c.split('|')[-1]].glen
+    # If the mapped reads are over-estimated, set the ratio at 1
+    return min(mapped_reads/float(n_metagenome_reads), 1.0)
+
+
+def write_profile(pars, tree, mpa_pkl, markers2reads, n_metagenome_reads, avg_read_length, read_ids=False):
+    """Computes the profile of a sample from its reads mapped to each marker and writes the outputs (-t) of pars,
+    the types of a comma separated -t sharing the profile and written to the files of the comma separated -o"""
+    tree.set_stat( pars['stat'], pars['stat_q'], pars['perc_nonzero'], avg_read_length, pars['avoid_disqm'])
+    map_out = add_marker_reads(pars, tree, markers2reads, read_ids)
 
+    if pars['output'] is None and pars['output_file'] is not None:
+        pars['output'] = pars['output_file']
+    analyses = pars['t'].split(',')
+    outputs = pars['output'].split(',') if len(analyses) > 1 else [pars['output']]
 
-    if subsampling_seed.lower() != 'random':
-        random.seed(int(subsampling_seed))
-        
-    sample = set(random.sample(range(n_metagenome_reads), subsampling))
-    
-    if subsampling_output is None:
-        if paired:
-            subsampling_output = list()
-            out=list()
-            for _ in inp.split(','):
-                out_f = tf.NamedTemporaryFile(dir=tmp_dir, mode='w', delete=False)
-                out.append(out_f)
-                subsampling_output.append(out_f.name)
-        else:
-            out = tf.NamedTemporaryFile(dir=tmp_dir, mode='w', delete=False)
-            subsampling_output=out.name
+    if pars['unclassified_estimation']:
+        fraction_mapped_reads = mapped_fraction(tree, pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None,
+                                                n_metagenome_reads)
     else:
-        if paired:
-            r, ext = os.path.splitext(subsampling_output)
-
-            subsampling_output = list()
-            out = list()
-
-            subsampling_output.append('.'.join([r, 'R1'+ext]))
-            subsampling_output.append('.'.join([r, 'R2'+ext]))
-
-            for s in subsampling_output:
-                out.append(bz2.open(s, 'wt') if s.endswith(".bz2") else gzip.open(s, 'wt') if s.endswith('.gz') else open(s, 'w'))
-        else:
-            out = bz2.open(subsampling_output, 'wt') if subsampling_output.endswith(".bz2") else gzip.open(subsampling_output, 'wt') if subsampling_output.endswith('.gz') else open(subsampling_output, 'w')
-            
-    subsample_file(inp, paired, subsampling, out, sample)
-
-    if isinstance(subsampling_output, list):
-        subsampling_output = ','.join(subsampling_output)
-        subsampling = subsampling*2
+        fraction_mapped_reads = 1.0
 
+    # the biom file is written from the first relative abundance output
+    biom_analysis = next((t for t in analyses if t in ['rel_ab', 'rel_ab_w_read_stats']), None)
+    # the strain tracker estimates the reads of all the ranks (see TaxTree.relative_abundances), so it goes last
+    for t, output in sorted(zip(analyses, outputs), key=lambda x: x[0] == 'clade_specific_strain_tracker'):
+        write_output(dict(pars, t=t, output=output, biom=pars['biom'] if t == biom_analysis else None), tree,
+                     mpa_pkl, map_out, n_metagenome_reads, avg_read_length, fraction_mapped_reads)
 
-    return subsampling_output, subsampling
 
-def main():
+def write_output(pars, tree, mpa_pkl, map_out, n_metagenome_reads, avg_read_length, fraction_mapped_reads):
+    """Writes the output of the analysis type (-t) of pars from the profile of a sample computed by write_profile"""
     ranks2code = { 'k' : 'superkingdom', 'p' : 'phylum', 'c':'class',
                    'o' : 'order', 'f' : 'family', 'g' : 'genus', 's' : 'species'}
-    pars = read_params(sys.argv)
-
-    #Set SGB- / species- analysis
-    global SGB_ANALYSIS
-    SGB_ANALYSIS = not pars['mpa3']
-
     ESTIMATE_UNK = pars['unclassified_estimation']
+    REPORT_MERGED = mpa_pkl.get('merged_taxon',False)
 
-    if pars['subsampling'] and pars['subsampling_paired']:
-        sys.stderr.write("Error: You specified both --subsampling and --subsampling_paired. Choose only one of the two options. Exiting...")
-        sys.exit(1)
-
-    if pars['subsampling']:
-        sys.stderr.write("WARNING: If you use --subsampling the reads will be subsampled NOT taking into account paired information. Use --subsampling_paired if you have paired ends reads.\n".format(pars['subsampling']))
-    
-    if pars['mapping_subsampling'] and pars['subsampling'] is None:
-        sys.stderr.write("Error: The --mapping_subsampling parameter should be used together with the --subsampling parameter. Exiting...\n\n")
-        sys.exit(1)
-
-    if pars['subsampling_paired']:
-        subsampling_paired=True
-        pars['subsampling']=pars['subsampling_paired']
-    else:
-        subsampling_paired=False
-
-    if subsampling_paired and (pars['1'] is None or pars['2'] is None):
-        sys.stderr.write("Error: If you specify --subsampling_paired you have to provide forward and reverse reads as -1 and -2 respectively. Reads are assumed to be in the same order in the two files.\n Exiting...\n\n".format(pars['subsampling']))
-        sys.exit(1)
-    
-    if pars['subsampling'] is not None and pars['subsampling'] < 10000:
-        sys.stderr.write("WARNING: The specified subsampling ({}) is below the recommended minimum of 10,000 reads.\n".format(pars['subsampling']))
-    
-    if not (pars['subsampling_seed'].lower() == 'random' or pars['subsampling_seed'].isdigit()):
-        sys.stderr.write("Error: The --subsampling_seed parameter is not accepted. It should contain an integer number or \"random\". Exiting...\n\n")
-        sys.exit(1)
-        
-    if not pars['mapping_subsampling'] and pars['subsampling'] is not None:
-        if pars['input_type'] != 'fastq':
-            sys.stderr.write("Error: The reads' subsampling procedure requires fastq input! Exiting...\n\n")
-            sys.exit(1)
-        elif (not pars['inp']) and (not subsampling_paired):
-            sys.stderr.write("Error: Input reads for the subsampling must be provided as parameter. Stdin input is not allowed! Exiting...\n\n")
-            sys.exit(1)
-        
-        if subsampling_paired:
-            if not os.path.exists(pars['2']) or not os.path.exists(pars['1']):
-                sys.stderr.write("Error: Files passed with -1 ({}) or -2 ({}) not found. Exiting...\n\n".format(pars['1'],pars['2']))
-                sys.exit(1)
-
-            if pars['inp']:
-                sys.stderr.write("WARNING: since --subsampling_paired has been specified, reads are taken from -1 ({}) and -2 ({}), not from -inp.\n".format(pars['1'],pars['2']))
-            pars['inp'] = pars['1']+','+pars['2']
-
-        pars['inp'], pars['subsampling'] = subsample_reads(pars['inp'], pars['subsampling'], pars['subsampling_seed'], pars['subsampling_output'], pars['tmp_dir'], paired=subsampling_paired)
-        
-    # check if the database is installed, if not then install
-    pars['index'] = check_and_install_database(pars['index'], pars['bowtie2db'], pars['bowtie2_build'], pars['nproc'], pars['force_download'], pars['offline'])
-
-    if pars['install']:
-        sys.stderr.write('The database is installed\n')
-        return
-
-    #if we are to profile viral clusters:
-
-    if pars['profile_vsc']:
-        #TODO: comply to other input types
-        if pars['input_type'] != 'fastq':
-            sys.stderr.write("The Viral Sequence Clusters mode requires fastq input!\n")
-            sys.exit(1)
-        
-        if not pars['vsc_out']:
-            sys.stderr.write("The Viral Sequence Clusters mode requires to specify an output file with the --vsc_out parameter\n")
-            sys.exit(1)
+    out_stream = open(pars['output'],"w") if pars['output'] else sys.stdout
+    MPA2_OUTPUT = pars['legacy_output']
+    CAMI_OUTPUT = pars['CAMI_format_output']
 
-        tmpvirdir=tf.TemporaryDirectory(dir=pars['tmp_dir'])
-        viralTempFolder=tmpvirdir.name
+    with out_stream as outf:
+        if not MPA2_OUTPUT:
+            outf.write('#{}\n'.format(pars['index']))
+            outf.write('#{}\n'.format(' '.join(sys.argv)))
+            outf.write('#{} reads processed\n'.format(n_metagenome_reads))
         
-        # Uncomment to preserve tmp dir
-        #tmpvirdir=tf.mkdtemp(dir=pars['tmp_dir'])
-        #viralTempFolder=tmpvirdir
-        #print("VF: ",viralTempFolder)
-
-        vsc_fna, vsc_vinfo = set_vsc_parameters(pars['index'], pars['bowtie2db'])
-
-        # implies SGBs (uses the same database with SGBs, so this is needed to avoid
-        # the need to specify --sgb when using --profile_vscs)
-        SGB_ANALYSIS = True
+        if pars['t'] == 'rel_ab_w_read_stats':
+            outf.write('#Average read length {}\n'.format(avg_read_length))           
 
+        if not CAMI_OUTPUT:
+            outf.write('#' + '\t'.join((pars["sample_id_key"], pars["sample_id"])) + '\n')
 
-    else:
-        viralTempFolder = None
+        if pars['t'] == 'reads_map':
+            if not MPA2_OUTPUT:
+               outf.write('#read_id\tNCBI_taxlineage_str\tNCBI_taxlineage_ids\n')
+            outf.write( "\n".join( map_out ) + "\n" )
 
+        elif pars['t'] == 'rel_ab':
+            if CAMI_OUTPUT:
+                outf.write('''@SampleID:{}\n@Version:0.10.0\n@Ranks:superkingdom|phylum|class|order|family|genus|species|strain\n@@TAXID\tRANK\tTAXPATH\tTAXPATHSN\tPERCENTAGE\n'''.format(pars["sample_id"]))
+            if not MPA2_OUTPUT and not CAMI_OUTPUT:
+                if not pars['use_group_representative']:
+                    outf.write('#clade_name\tNCBI_tax_id\trelative_abundance\tadditional_species\n')
+                else:
+                    outf.write('#clade_name\tNCBI_tax_id\trelative_abundance\n')
 
-    # set correct map_pkl and bowtie2db variables
-    pars['mpa_pkl'], pars['bowtie2db'] = set_mapping_arguments(pars['index'], pars['bowtie2db'])
+            cl2ab, _, tot_nreads = tree.relative_abundances(
+                        pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
+            
+            outpred = [(taxstr, taxid,round(relab*100.0,5)) for (taxstr, taxid), relab in cl2ab.items() if relab > 0.0]
+            has_repr = False
+            
+            if outpred:
+                if CAMI_OUTPUT:
+                    for clade, taxid, relab in sorted(  outpred, reverse=True,
+                                        key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
+                        if taxid and clade.split('|')[-1][0] != 't':
+                            rank = ranks2code[clade.split('|')[-1][0]]
+                            leaf_taxid = taxid.split('|')[-1]
+                            taxpathsh = '|'.join([remove_prefix(name) if '_unclassified' not in name else '' for name in clade.split('|')])
+                            outf.write( '\t'.join( [ leaf_taxid, rank, taxid, taxpathsh, str(relab*fraction_mapped_reads) ] ) + '\n' )
+                else:
+                    if ESTIMATE_UNK:
+                        outf.write( "\t".join( [    "UNCLASSIFIED",
+                                                    "-1",
+                                                    str(round((1-fraction_mapped_reads)*100,5)),""]) + "\n" )
+                                                    
+                    for clade, taxid, relab in sorted(  outpred, reverse=True,
+                                        key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
+                        add_repr = ''
+                        if REPORT_MERGED and (clade, taxid) in mpa_pkl['merged_taxon']:
+                            if pars['use_group_representative'] and not SGB_ANALYSIS:
+                                if '_group' in clade:
+                                    clade, taxid, _ = sorted(mpa_pkl['merged_taxon'][(clade, taxid)], key=lambda x:x[2], reverse=True)[0]
+                            elif not pars['use_group_representative']:
+                                add_repr = '{}'.format(','.join( [ n[0] for n in mpa_pkl['merged_taxon'][(clade, taxid)]] ))
+                                has_repr = True
+                        if not MPA2_OUTPUT:
+                            outf.write( "\t".join( [clade, 
+                                                    taxid, 
+                                                    str(relab*fraction_mapped_reads), 
+                                                    add_repr
+                                                ] ) + "\n" )
+                        else:
+                            outf.write( "\t".join( [clade, 
+                                                    str(relab*fraction_mapped_reads)] ) + "\n" )
+                if REPORT_MERGED and has_repr:
+                    sys.stderr.write("WARNING: The metagenome profile contains clades that represent multiple species merged into a single representant.\n"
+                                     "An additional column listing the merged species is added to the MetaPhlAn output.\n"
+                                    )
+            else:
+                if not MPA2_OUTPUT:
+                    outf.write( "UNCLASSIFIED\t-1\t100.0\t\n" )
+                else:
+                    outf.write( "UNCLASSIFIED\t100.0\n" )
+                sys.stderr.write("WARNING: MetaPhlAn did not detect any microbial taxa in the sample.\n")
+            maybe_generate_biom_file(tree, pars, outpred)
+
+        elif pars['t'] == 'rel_ab_w_read_stats':
+            cl2ab, rr, tot_nreads = tree.relative_abundances(
+                        pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
+
+            unmapped_reads = max(n_metagenome_reads - tot_nreads, 0)
+
+            outpred = [(taxstr, taxid,round(relab*100.0*fraction_mapped_reads,5)) for (taxstr, taxid),relab in cl2ab.items() if relab > 0.0]
+
+            if outpred:
+                outf.write( "#estimated_reads_mapped_to_known_clades:{}\n".format(round(tot_nreads)) )
+                outf.write( "\t".join( [    "#clade_name",
+                                            "clade_taxid",
+                                            "relative_abundance",
+                                            "coverage",
+                                            "estimated_number_of_reads_from_the_clade" ]) +"\n" )
+                if ESTIMATE_UNK:
+                    outf.write( "\t".join( [    "UNCLASSIFIED",
+                                                "-1",
+                                                str(round((1-fraction_mapped_reads)*100,5)),
+                                                "-",
+                                                str(round(unmapped_reads)) ]) + "\n" )
+                                                
+                for taxstr, taxid, relab in sorted(  outpred, reverse=True,
+                                    key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
+                    outf.write( "\t".join( [    taxstr,
+                                                taxid,
+                                                str(relab),
+                                                str(round(rr[(taxstr, taxid)][0],5)) if (taxstr, taxid) in rr else '-',          #coverage
+                                                str( int( round( rr[(taxstr, taxid)][1], 0) )  if (taxstr, taxid) in rr else '-')       #estimated_number_of_reads_from_the_clade
+                                                ] ) + "\n" )
+            else:
+                if not MPA2_OUTPUT:
+                    outf.write( "#estimated_reads_mapped_to_known_clades:0\n")
+                    outf.write( "\t".join( [    "#clade_name",
+                                                "clade_taxid",
+                                                "relative_abundance",
+                                                "coverage",
+                                                "estimated_number_of_reads_from_the_clade" ]) +"\n" )
+                    outf.write( "UNCLASSIFIED\t-1\t100.0\t0\t0\n" )
+                else:
+                    outf.write( "UNCLASSIFIED\t100.0\n" )
+            maybe_generate_biom_file(tree, pars, outpred)
+
+        elif pars['t'] == 'clade_profiles':
+            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
+            for c,p in cl2pr.items():
+                mn,n = zip(*p)
+                outf.write( "\t".join( [""]+[str(s) for s in mn] ) + "\n" )
+                outf.write( "\t".join( [c]+[str(s) for s in n] ) + "\n" )
+
+        elif pars['t'] == 'marker_ab_table':
+            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
+            for v in cl2pr.values():
+                outf.write( "\n".join(["\t".join([str(a),str(b/float(pars['nreads'])) if pars['nreads'] else str(b)])
+                                for a,b in v if b > 0.0]) + "\n" )
+
+        elif pars['t'] == 'marker_pres_table':
+            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
+            for v in cl2pr.values():
+                strout = ["\t".join([str(a),"1"]) for a,b in v if b > pars['pres_th']]
+                if strout:
+                    outf.write( "\n".join(strout) + "\n" )
+
+        elif pars['t'] == 'marker_counts':
+            outf.write( "\n".join( ["\t".join([m,str(c)]) for m,c in tree.markers2counts().items() ]) +"\n" )
+
+        elif pars['t'] == 'clade_specific_strain_tracker':
+            cl2pr = tree.clade_profiles( None, get_all = True  )
+            cl2ab, _, _ = tree.relative_abundances( None )
+            strout = []
+            for (taxstr, taxid), relab in cl2ab.items():
+                clade = taxstr
+                if clade.endswith(pars['clade']) and relab*100.0 < pars['min_ab']:
+                    strout = []
+                    break
+                if pars['clade'] in clade:
+                    strout += ["\t".join([str(a),str(int(b > pars['pres_th']))]) for a,b in cl2pr[clade]]
+            if strout:
+                strout = sorted(strout,key=lambda x:x[0])
+                outf.write( "\n".join(strout) + "\n" )
+            else:
+                sys.stderr.write("Clade "+pars['clade']+" not present at an abundance >"+str(round(pars['min_ab'],2))+"%, "
+                                 "so no clade specific markers are reported\n")
+
+
+
+def main():
+    if sys.argv[1:2] == ['serve']:
+        try:
+            from .server import serve_main
+        except ImportError:
+            from server import serve_main
+        serve_main(sys.argv[2:])
+        return
+
+    pars = read_params(sys.argv)
+
+    #Set SGB- / species- analysis
+    global SGB_ANALYSIS
+    SGB_ANALYSIS = not pars['mpa3']
+
+    analyses = pars['t'].split(',')
+    if any(t not in ANALYSIS_TYPES for t in analyses) or len(set(analyses)) < len(analyses):
+        sys.stderr.write("Error: The -t parameter should be one or more distinct analysis types among {}, separated "
+                         "by commas. Exiting...\n\n".format(', '.join(ANALYSIS_TYPES)))
+        sys.exit(1)
+    if len(analyses) > 1:
+        output = pars['output'] if pars['output'] is not None else pars['output_file']
+        if pars['batch']:
+            sys.stderr.write("Error: The --batch mode writes a single output per sample and cannot be used with "
+                             "multiple analysis types (-t). Exiting...\n\n")
+            sys.exit(1)
+        if output is None or len(output.split(',')) != len(analyses):
+            sys.stderr.write("Error: Multiple analysis types (-t) need one output file per type, as a comma "
+                             "separated list in the same order. Exiting...\n\n")
+            sys.exit(1)
+
+    if 'reads_map' in analyses and pars['bowtie2out_format'] == 'binary':
+        sys.stderr.write("Error: The binary --bowtie2out format does not store the read names reported by "
+                         "-t reads_map, use --bowtie2out_format text. Exiting...\n\n")
+        sys.exit(1)
+
+    if pars['bt2_shards'] < 1:
+        sys.stderr.write("Error: The --bt2_shards parameter should be a positive number of BowTie2 processes. Exiting...\n\n")
+        sys.exit(1)
+
+    if pars['multiplex']:
+        if pars['input_type'] not in ['fastq', 'fasta']:
+            sys.stderr.write("Error: The --multiplex mode maps FASTQ or FASTA input files. Exiting...\n\n")
+            sys.exit(1)
+        if pars['inp'] or pars['subsampling'] or pars['subsampling_paired'] or pars['samout'] or \
+                pars['profile_vsc'] or pars['bowtie2out']:
+            sys.stderr.write("Error: The --multiplex mode reads the input and the bowtie2out files from the manifest "
+                             "and cannot be used with --subsampling, --samout and --profile_vsc. "
+                             "Exiting...\n\n")
+            sys.exit(1)
+
+    multiplexed = batch = None
+    if pars['multiplex']:
+        multiplexed = read_manifest(pars['multiplex'], ['the sample name', 'the input files', 'the bowtie2out file'])
+
+    if pars['batch']:
+        if pars['input_type'] not in ['fastq', 'fasta', 'bowtie2out']:
+            sys.stderr.write("Error: The --batch mode profiles FASTQ, FASTA or bowtie2out input files. Exiting...\n\n")
+            sys.exit(1)
+        if pars['inp'] or pars['output'] or pars['output_file'] or pars['bowtie2out'] or pars['multiplex'] or \
+                pars['samout'] or pars['profile_vsc'] or pars['biom'] or pars['subsampling_paired'] or \
+                pars['subsampling_output']:
+            sys.stderr.write("Error: The --batch mode reads the input, output and bowtie2out files from the manifest "
+                             "and cannot be used with --multiplex, --samout, --profile_vsc, --biom and "
+                             "--subsampling_paired. Exiting...\n\n")
+            sys.exit(1)
+        batch = read_manifest(pars['batch'], ['the sample name', 'the input files', 'the output file',
+                                              'optionally the bowtie2out file'], optional=1)
+
+    for samples, bowtie2out in [(multiplexed, 2), (batch, 3)]:
+        for sample in samples or []:
+            if sample[bowtie2out] and os.path.exists(sample[bowtie2out]) and not pars['force'] and \
+                    pars['input_type'] in ['fastq', 'fasta']:
+                sys.stderr.write("BowTie2 output file detected: " + sample[bowtie2out] + "\n"
+                                 "Please remove it or use --force to re-perform the BowTie2 run.\n"
+                                 "Exiting...\n\n")
+                sys.exit(1)
+
+    for option in ['subsampling', 'subsampling_paired']:
+        if pars[option] is not None and pars[option] <= 0:
+            sys.stderr.write("Error: The --{} parameter should be a positive number of reads. "
+                             "Exiting...\n\n".format(option))
+            sys.exit(1)
+
+    if pars['subsampling'] and pars['subsampling_paired']:
+        sys.stderr.write("Error: You specified both --subsampling and --subsampling_paired. Choose only one of the two options. Exiting...")
+        sys.exit(1)
+
+    if pars['subsampling']:
+        sys.stderr.write("WARNING: If you use --subsampling the reads will be subsampled NOT taking into account paired information. Use --subsampling_paired if you have paired ends reads.\n".format(pars['subsampling']))
+    
+    if pars['mapping_subsampling'] and pars['subsampling'] is None:
+        sys.stderr.write("Error: The --mapping_subsampling parameter should be used together with the --subsampling parameter. Exiting...\n\n")
+        sys.exit(1)
+
+    if pars['subsampling_paired']:
+        subsampling_paired=True
+        pars['subsampling']=pars['subsampling_paired']
+    else:
+        subsampling_paired=False
+
+    if subsampling_paired and (pars['1'] is None or pars['2'] is None):
+        sys.stderr.write("Error: If you specify --subsampling_paired you have to provide forward and reverse reads as -1 and -2 respectively. Reads are assumed to be in the same order in the two files.\n Exiting...\n\n".format(pars['subsampling']))
+        sys.exit(1)
+    
+    if pars['subsampling'] is not None and pars['subsampling'] < 10000:
+        sys.stderr.write("WARNING: The specified subsampling ({}) is below the recommended minimum of 10,000 reads.\n".format(pars['subsampling']))
+    
+    if not (pars['subsampling_seed'].lower() == 'random' or pars['subsampling_seed'].isdigit()):
+        sys.stderr.write("Error: The --subsampling_seed parameter is not accepted. It should contain an integer number or \"random\". Exiting...\n\n")
+        sys.exit(1)
+        
+    if not pars['mapping_subsampling'] and pars['subsampling'] is not None:
+        if pars['input_type'] != 'fastq':
+            sys.stderr.write("Error: The reads' subsampling procedure requires fastq input! Exiting...\n\n")
+            sys.exit(1)
+        elif (not pars['inp']) and (not subsampling_paired) and (not pars['batch']):
+            sys.stderr.write("Error: Input reads for the subsampling must be provided as parameter. Stdin input is not allowed! Exiting...\n\n")
+            sys.exit(1)
+        
+        if subsampling_paired:
+            if not os.path.exists(pars['2']) or not os.path.exists(pars['1']):
+                sys.stderr.write("Error: Files passed with -1 ({}) or -2 ({}) not found. Exiting...\n\n".format(pars['1'],pars['2']))
+                sys.exit(1)
+
+            if pars['inp']:
+                sys.stderr.write("WARNING: since --subsampling_paired has been specified, reads are taken from -1 ({}) and -2 ({}), not from -inp.\n".format(pars['1'],pars['2']))
+            pars['inp'] = pars['1']+','+pars['2']
+
+        # the reads are subsampled in a single pass while feeding BowTie2, per sample in --batch mode
+        read_subsampler = None if pars['batch'] else \
+            ReadSubsampler(pars['inp'].split(','), pars['subsampling'], pars['subsampling_seed'], subsampling_paired,
+                           pars['tmp_dir'], pars['subsampling_output'], int(pars['nproc']))
+    else:
+        read_subsampler = None
+        
+    # check if the database is installed, if not then install
+    if WARM_DATABASE.get('database') == (pars['index'], pars['bowtie2db']) and not pars['force_download'] and not pars['install']:
+        pars['index'] = WARM_DATABASE['index']
+    else:
+        pars['index'] = check_and_install_database(pars['index'], pars['bowtie2db'], pars['bowtie2_build'], pars['nproc'], pars['force_download'], pars['offline'])
+
+    if pars['install']:
+        sys.stderr.write('The database is installed\n')
+        return
+
+    if pars['warm_index']:
+        warm_index(*set_mapping_arguments(pars['index'], pars['bowtie2db']))
+        return
+
+    #if we are to profile viral clusters:
+
+    if pars['profile_vsc']:
+        #TODO: comply to other input types
+        if pars['input_type'] != 'fastq':
+            sys.stderr.write("The Viral Sequence Clusters mode requires fastq input!\n")
+            sys.exit(1)
+        
+        if not pars['vsc_out']:
+            sys.stderr.write("The Viral Sequence Clusters mode requires to specify an output file with the --vsc_out parameter\n")
+            sys.exit(1)
+
+        tmpvirdir=tf.TemporaryDirectory(dir=pars['tmp_dir'])
+        viralTempFolder=tmpvirdir.name
+        
+        # Uncomment to preserve tmp dir
+        #tmpvirdir=tf.mkdtemp(dir=pars['tmp_dir'])
+        #viralTempFolder=tmpvirdir
+        #print("VF: ",viralTempFolder)
+
+        vsc_fna, vsc_vinfo = set_vsc_parameters(pars['index'], pars['bowtie2db'])
+
+        # implies SGBs (uses the same database with SGBs, so this is needed to avoid
+        # the need to specify --sgb when using --profile_vscs)
+        SGB_ANALYSIS = True
+
+
+    else:
+        viralTempFolder = None
+
+
+    # set correct map_pkl and bowtie2db variables
+    pars['mpa_pkl'], pars['bowtie2db'] = set_mapping_arguments(pars['index'], pars['bowtie2db'])
 
     if (pars['bt2_ps'] in ["sensitive-local", "very-sensitive-local"]) and (pars['min_alignment_len'] is None):
             pars['min_alignment_len'] = 100
@@ -1361,7 +2117,17 @@ def main():
     else:
         ignore_markers = set()
 
-    no_map = False
+    if WARM_DATABASE.get('mpa_pkl') == pars['mpa_pkl']:
+        mpa_pkl, db_markers = WARM_DATABASE['db'], WARM_DATABASE['db_markers']
+    elif pars['bowtie2out_format'] == 'binary' or pars['batch']:
+        # the binary bowtie2out files written by the mapping index the markers in the order of the database
+        mpa_pkl = load_database( pars['mpa_pkl'], shared=pars['shm_db'] or None )
+        db_markers = list(mpa_pkl['markers'])
+    else:
+        # loaded after the mapping, not to hold the database in memory while BowTie2 runs
+        mpa_pkl, db_markers = None, None
+
+    no_map, prefilter = False, None
     if pars['input_type'] == 'fasta' or pars['input_type'] == 'fastq':
         bow = pars['bowtie2db'] is not None
 
@@ -1371,7 +2137,9 @@ def main():
                               "Exiting...\n\n" )
             sys.exit(1)
 
-        if pars['no_map']:
+        if pars['multiplex'] or pars['batch']:
+            pass  # the bowtie2out files of the samples are listed in the manifest
+        elif pars['no_map']:
             pars['bowtie2out'] = tf.NamedTemporaryFile(dir=pars['tmp_dir']).name
             no_map = True
         else:
@@ -1411,24 +2179,64 @@ def main():
                              .format(pars['bowtie2db']))
             sys.exit(1)
 
-        if bow:
+        if bow and pars['prefilter']:
+            if not os.path.exists(prefilter_path(pars['bowtie2db'])):
+                sys.stderr.write('Building the prefilter of the database, it is done only once\n')
+                build_database_prefilter(pars['mpa_pkl'], prefilter_path(pars['bowtie2db']), pars['tmp_dir'])
+            try:
+                prefilter = Prefilter(prefilter_path(pars['bowtie2db']), pars['prefilter_min_hits'])
+            except ValueError as e:
+                sys.stderr.write('Error: {}\n'.format(e))
+                sys.exit(1)
+
+        if bow and pars['multiplex']:
+            errors = run_bowtie2_multiplexed([inputs for _, inputs, _ in multiplexed],
+                                             [bowtie2out for _, _, bowtie2out in multiplexed], pars['bowtie2db'],
+                                             pars['bt2_ps'], pars['nproc'], pars['min_mapq_val'],
+                                             file_format=pars['input_type'], exe=pars['bowtie2_exe'],
+                                             min_alignment_len=pars['min_alignment_len'],
+                                             read_min_len=pars['read_min_len'], verbose=pars['verbose'],
+                                             compression=pars['compression'],
+                                             compression_level=pars['compression_level'],
+                                             db_markers=db_markers if pars['bowtie2out_format'] == 'binary' else None,
+                                             index=pars['index'], ordinals=pars['bowtie2out_ordinals'],
+                                             prefilter=prefilter, mm=pars['bt2_mm'], shards=pars['bt2_shards'])
+            for (sample, _, _), error in zip(multiplexed, errors):
+                if error is not None:
+                    sys.stderr.write('Error mapping sample {}: {}\n'.format(sample, str(error).strip()))
+            sys.exit(1 if any(e is not None for e in errors) else 0)
+
+        if bow and not pars['batch']:
             run_bowtie2(pars['inp'], pars['bowtie2out'], pars['bowtie2db'],
                                 pars['bt2_ps'], pars['nproc'], file_format=pars['input_type'],
                                 exe=pars['bowtie2_exe'], samout=pars['samout'],
 
-                                min_alignment_len=pars['min_alignment_len'], read_min_len=pars['read_min_len'], min_mapq_val=pars['min_mapq_val'],profile_vsc_folder=viralTempFolder)
-            if pars['subsampling_output'] is None and not pars['mapping_subsampling'] and pars['subsampling'] is not None:
-                for inp_f in pars['inp'].split(','):
-                    os.remove(inp_f)
+                                min_alignment_len=pars['min_alignment_len'], read_min_len=pars['read_min_len'], min_mapq_val=pars['min_mapq_val'],profile_vsc_folder=viralTempFolder,
+                                verbose=pars['verbose'], compression=pars['compression'],
+                                compression_level=pars['compression_level'],
+                                db_markers=db_markers if pars['bowtie2out_format'] == 'binary' else None,
+                                index=pars['index'], ordinals=pars['bowtie2out_ordinals'], subsampler=read_subsampler,
+                                prefilter=prefilter, mm=pars['bt2_mm'], shards=pars['bt2_shards'])
             pars['input_type'] = 'bowtie2out'
         pars['inp'] = pars['bowtie2out'] # !!!
-    with bz2.BZ2File( pars['mpa_pkl'], 'r' ) as a:
-        mpa_pkl = pickle.load( a )
 
-    REPORT_MERGED = mpa_pkl.get('merged_taxon',False)
-    tree = TaxTree( mpa_pkl, ignore_markers )
+    if mpa_pkl is None:
+        mpa_pkl = load_database( pars['mpa_pkl'], shared=pars['shm_db'] or None )
+        # the order of the markers indexed by the binary bowtie2out files
+        db_markers = list(mpa_pkl['markers'])
+
+    if mpa_pkl is WARM_DATABASE.get('db') and not ignore_markers and WARM_DATABASE['sgb_analysis'] == SGB_ANALYSIS:
+        # each job runs in its own forked process, so the tree of the server is never modified
+        tree = WARM_DATABASE['tree']
+    else:
+        tree = TaxTree( mpa_pkl, ignore_markers )
+    if pars['abundance_engine'] == 'arrays' and tree.array_tree is None:
+        tree.use_array_engine()
     tree.set_min_cu_len( pars['min_cu_len'] )
 
+    if pars['batch']:
+        sys.exit(run_batch(pars, tree, mpa_pkl, db_markers, batch, prefilter))
+
     if pars['input_type'] == 'sam' and not pars['nreads']:
         sys.stderr.write(
                 "Please provide the size of the metagenome using the "
@@ -1436,7 +2244,13 @@ def main():
                 "\nExiting...\n\n" )
         sys.exit(1)
 
-    markers2reads, n_metagenome_reads, avg_read_length = map2bbh(pars['inp'], pars['min_mapq_val'], pars['input_type'], pars['min_alignment_len'], pars['nreads'], pars['mapping_subsampling'], pars['subsampling'], pars['subsampling_seed'])
+    # the read IDs are only kept to report them, otherwise only the number of reads per marker is loaded
+    read_ids = 'reads_map' in pars['t'].split(',')
+    t0 = time.time()
+    markers2reads, n_metagenome_reads, avg_read_length = map2bbh(pars['inp'], pars['min_mapq_val'], pars['input_type'], pars['min_alignment_len'], pars['nreads'], pars['mapping_subsampling'], pars['subsampling'], pars['subsampling_seed'], db_markers=db_markers, read_ids=read_ids)
+    if pars['verbose']:
+        sys.stderr.write('Mapping results loaded ({}) in {:.2f} s, peak RSS {:.1f} MB\n'.format(
+            'read IDs' if read_ids else 'read counts', time.time() - t0, peak_rss_mb()))
 
     if pars['profile_vsc']:
         
@@ -1489,209 +2303,10 @@ def main():
                     vsc_out_df.to_csv(outf,sep='\t',na_rep='-')
 
 
-    tree.set_stat( pars['stat'], pars['stat_q'], pars['perc_nonzero'], avg_read_length, pars['avoid_disqm'])
-
     if no_map:
         os.remove( pars['inp'] )
 
-    map_out = []
-    for marker,reads in sorted(markers2reads.items(), key=lambda pars: pars[0]):
-        if marker not in tree.markers2lens:
-            continue
-        tax_seq, ids_seq = tree.add_reads( marker, len(reads),
-                                  add_viruses = pars['add_viruses'],
-                                  ignore_eukaryotes = pars['ignore_eukaryotes'],
-                                  ignore_bacteria = pars['ignore_bacteria'],
-                                  ignore_archaea = pars['ignore_archaea'],
-                                  ignore_ksgbs = pars['ignore_ksgbs'],
-                                  ignore_usgbs = pars['ignore_usgbs']
-                                  )
-        if tax_seq:
-            map_out +=["\t".join([r,tax_seq, ids_seq]) for r in sorted(reads)]
-
-    if pars['output'] is None and pars['output_file'] is not None:
-        pars['output'] = pars['output_file']
-
-    out_stream = open(pars['output'],"w") if pars['output'] else sys.stdout
-    MPA2_OUTPUT = pars['legacy_output']
-    CAMI_OUTPUT = pars['CAMI_format_output']
-
-    with out_stream as outf:
-        if not MPA2_OUTPUT:
-            outf.write('#{}\n'.format(pars['index']))
-            outf.write('#{}\n'.format(' '.join(sys.argv)))
-            outf.write('#{} reads processed\n'.format(n_metagenome_reads))
-        
-        if pars['t'] == 'rel_ab_w_read_stats':
-            outf.write('#Average read length {}\n'.format(avg_read_length))           
-
-        if not CAMI_OUTPUT:
-            outf.write('#' + '\t'.join((pars["sample_id_key"], pars["sample_id"])) + '\n')
-
-        if ESTIMATE_UNK:
-            mapped_reads = 0
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
-            cl2ab, _, _ = tree.relative_abundances( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
-            confident_taxa = [taxstr for (taxstr, _),relab in cl2ab.items() if relab > 0.0]
-            for c, m in cl2pr.items():
-                if c in confident_taxa:
-                    markers_cov = [a  / 1000 for _, a in m if a > 0]
-                    mapped_reads += np.mean(markers_cov) * tree.all_clades[c.split('|')[-1]].glen
-            # If the mapped reads are over-estimated, set the ratio at 1
-            fraction_mapped_reads = min(mapped_reads/float(n_metagenome_reads), 1.0)
-        else:
-            fraction_mapped_reads = 1.0
-      
-        if pars['t'] == 'reads_map':
-            if not MPA2_OUTPUT:
-               outf.write('#read_id\tNCBI_taxlineage_str\tNCBI_taxlineage_ids\n')
-            outf.write( "\n".join( map_out ) + "\n" )
-
-        elif pars['t'] == 'rel_ab':
-            if CAMI_OUTPUT:
-                outf.write('''@SampleID:{}\n@Version:0.10.0\n@Ranks:superkingdom|phylum|class|order|family|genus|species|strain\n@@TAXID\tRANK\tTAXPATH\tTAXPATHSN\tPERCENTAGE\n'''.format(pars["sample_id"]))
-            if not MPA2_OUTPUT and not CAMI_OUTPUT:
-                if not pars['use_group_representative']:
-                    outf.write('#clade_name\tNCBI_tax_id\trelative_abundance\tadditional_species\n')
-                else:
-                    outf.write('#clade_name\tNCBI_tax_id\trelative_abundance\n')
-
-            cl2ab, _, tot_nreads = tree.relative_abundances(
-                        pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
-            
-            outpred = [(taxstr, taxid,round(relab*100.0,5)) for (taxstr, taxid), relab in cl2ab.items() if relab > 0.0]
-            has_repr = False
-            
-            if outpred:
-                if CAMI_OUTPUT:
-                    for clade, taxid, relab in sorted(  outpred, reverse=True,
-                                        key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
-                        if taxid and clade.split('|')[-1][0] != 't':
-                            rank = ranks2code[clade.split('|')[-1][0]]
-                            leaf_taxid = taxid.split('|')[-1]
-                            taxpathsh = '|'.join([remove_prefix(name) if '_unclassified' not in name else '' for name in clade.split('|')])
-                            outf.write( '\t'.join( [ leaf_taxid, rank, taxid, taxpathsh, str(relab*fraction_mapped_reads) ] ) + '\n' )
-                else:
-                    if ESTIMATE_UNK:
-                        outf.write( "\t".join( [    "UNCLASSIFIED",
-                                                    "-1",
-                                                    str(round((1-fraction_mapped_reads)*100,5)),""]) + "\n" )
-                                                    
-                    for clade, taxid, relab in sorted(  outpred, reverse=True,
-                                        key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
-                        add_repr = ''
-                        if REPORT_MERGED and (clade, taxid) in mpa_pkl['merged_taxon']:
-                            if pars['use_group_representative'] and not SGB_ANALYSIS:
-                                if '_group' in clade:
-                                    clade, taxid, _ = sorted(mpa_pkl['merged_taxon'][(clade, taxid)], key=lambda x:x[2], reverse=True)[0]
-                            elif not pars['use_group_representative']:
-                                add_repr = '{}'.format(','.join( [ n[0] for n in mpa_pkl['merged_taxon'][(clade, taxid)]] ))
-                                has_repr = True
-                        if not MPA2_OUTPUT:
-                            outf.write( "\t".join( [clade, 
-                                                    taxid, 
-                                                    str(relab*fraction_mapped_reads), 
-                                                    add_repr
-                                                ] ) + "\n" )
-                        else:
-                            outf.write( "\t".join( [clade, 
-                                                    str(relab*fraction_mapped_reads)] ) + "\n" )
-                if REPORT_MERGED and has_repr:
-                    sys.stderr.write("WARNING: The metagenome profile contains clades that represent multiple species merged into a single representant.\n"
-                                     "An additional column listing the merged species is added to the MetaPhlAn output.\n"
-                                    )
-            else:
-                if not MPA2_OUTPUT:
-                    outf.write( "UNCLASSIFIED\t-1\t100.0\t\n" )
-                else:
-                    outf.write( "UNCLASSIFIED\t100.0\n" )
-                sys.stderr.write("WARNING: MetaPhlAn did not detect any microbial taxa in the sample.\n")
-            maybe_generate_biom_file(tree, pars, outpred)
-
-        elif pars['t'] == 'rel_ab_w_read_stats':
-            cl2ab, rr, tot_nreads = tree.relative_abundances(
-                        pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None )
-
-            unmapped_reads = max(n_metagenome_reads - tot_nreads, 0)
-
-            outpred = [(taxstr, taxid,round(relab*100.0*fraction_mapped_reads,5)) for (taxstr, taxid),relab in cl2ab.items() if relab > 0.0]
-
-            if outpred:
-                outf.write( "#estimated_reads_mapped_to_known_clades:{}\n".format(round(tot_nreads)) )
-                outf.write( "\t".join( [    "#clade_name",
-                                            "clade_taxid",
-                                            "relative_abundance",
-                                            "coverage",
-                                            "estimated_number_of_reads_from_the_clade" ]) +"\n" )
-                if ESTIMATE_UNK:
-                    outf.write( "\t".join( [    "UNCLASSIFIED",
-                                                "-1",
-                                                str(round((1-fraction_mapped_reads)*100,5)),
-                                                "-",
-                                                str(round(unmapped_reads)) ]) + "\n" )
-                                                
-                for taxstr, taxid, relab in sorted(  outpred, reverse=True,
-                                    key=lambda x:x[2]+(100.0*(8-(x[0].count("|"))))):
-                    outf.write( "\t".join( [    taxstr,
-                                                taxid,
-                                                str(relab),
-                                                str(round(rr[(taxstr, taxid)][0],5)) if (taxstr, taxid) in rr else '-',          #coverage
-                                                str( int( round( rr[(taxstr, taxid)][1], 0) )  if (taxstr, taxid) in rr else '-')       #estimated_number_of_reads_from_the_clade
-                                                ] ) + "\n" )
-            else:
-                if not MPA2_OUTPUT:
-                    outf.write( "#estimated_reads_mapped_to_known_clades:0\n")
-                    outf.write( "\t".join( [    "#clade_name",
-                                                "clade_taxid",
-                                                "relative_abundance",
-                                                "coverage",
-                                                "estimated_number_of_reads_from_the_clade" ]) +"\n" )
-                    outf.write( "UNCLASSIFIED\t-1\t100.0\t0\t0\n" )
-                else:
-                    outf.write( "UNCLASSIFIED\t100.0\n" )
-            maybe_generate_biom_file(tree, pars, outpred)
-
-        elif pars['t'] == 'clade_profiles':
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
-            for c,p in cl2pr.items():
-                mn,n = zip(*p)
-                outf.write( "\t".join( [""]+[str(s) for s in mn] ) + "\n" )
-                outf.write( "\t".join( [c]+[str(s) for s in n] ) + "\n" )
-
-        elif pars['t'] == 'marker_ab_table':
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
-            for v in cl2pr.values():
-                outf.write( "\n".join(["\t".join([str(a),str(b/float(pars['nreads'])) if pars['nreads'] else str(b)])
-                                for a,b in v if b > 0.0]) + "\n" )
-
-        elif pars['t'] == 'marker_pres_table':
-            cl2pr = tree.clade_profiles( pars['tax_lev']+"__" if pars['tax_lev'] != 'a' else None  )
-            for v in cl2pr.values():
-                strout = ["\t".join([str(a),"1"]) for a,b in v if b > pars['pres_th']]
-                if strout:
-                    outf.write( "\n".join(strout) + "\n" )
-
-        elif pars['t'] == 'marker_counts':
-            outf.write( "\n".join( ["\t".join([m,str(c)]) for m,c in tree.markers2counts().items() ]) +"\n" )
-
-        elif pars['t'] == 'clade_specific_strain_tracker':
-            cl2pr = tree.clade_profiles( None, get_all = True  )
-            cl2ab, _, _ = tree.relative_abundances( None )
-            strout = []
-            for (taxstr, taxid), relab in cl2ab.items():
-                clade = taxstr
-                if clade.endswith(pars['clade']) and relab*100.0 < pars['min_ab']:
-                    strout = []
-                    break
-                if pars['clade'] in clade:
-                    strout += ["\t".join([str(a),str(int(b > pars['pres_th']))]) for a,b in cl2pr[clade]]
-            if strout:
-                strout = sorted(strout,key=lambda x:x[0])
-                outf.write( "\n".join(strout) + "\n" )
-            else:
-                sys.stderr.write("Clade "+pars['clade']+" not present at an abundance >"+str(round(pars['min_ab'],2))+"%, "
-                                 "so no clade specific markers are reported\n")
-
+    write_profile(pars, tree, mpa_pkl, markers2reads, n_metagenome_reads, avg_read_length, read_ids)
 
 if __name__ == '__main__':
     t0 = time.time()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import pandas as pd
+
+from . import metaphlan as mpa
+
+
+PROFILE_COLUMNS = ['clade_name', 'taxid', 'rel_ab', 'coverage', 'est_reads']
+
+
+class Profiler:
+    """Profiles samples in the current process with a MetaPhlAn database loaded once
+
+    The options are those of the metaphlan command line, named as in its parameters (e.g. tax_lev='s',
+    stat='tavg_g', unclassified_estimation=True, min_mapq_val=5), with the metaphlan defaults for the
+    ones not given. The profiles are returned as DataFrames with one row per detected clade, sorted
+    as in the metaphlan output, and nothing is written to disk.
+
+    The Profiler is not thread-safe: the samples of a Profiler are profiled one at a time, on its
+    single tree.
+
+    Example:
+        profiler = Profiler(index='mpa_vJun23_CHOCOPhlAnSGB_202403', offline=True, tax_lev='s')
+        profile = profiler.profile_bowtie2out('sample.bowtie2.bz2')
+    """
+
+    def __init__(self, index=mpa.INDEX, bowtie2db=mpa.DEFAULT_DB_FOLDER, offline=False, mpa3=False,
+                 ignore_markers=None, **options):
+        """
+        Args:
+            index (str): the database version, 'latest' for the most recent one
+            bowtie2db (str): the folder containing the database
+            offline (bool): whether to skip the online check of the database updates
+            mpa3 (bool): whether to profile with the MetaPhlAn 3 algorithm
+            ignore_markers (iterable): the markers to ignore
+            **options: the other metaphlan parameters
+
+        Raises:
+            TypeError: if an option is not a metaphlan parameter
+        """
+        self.pars = mpa.read_params(['metaphlan', '--input_type', 'bowtie2out'])
+        unknown = set(options) - set(self.pars)
+        if unknown:
+            raise TypeError('Unknown MetaPhlAn options: {}'.format(', '.join(sorted(unknown))))
+        self.pars.update(options)
+        self.sgb_analysis = not mpa3
+
+        mpa.SGB_ANALYSIS = self.sgb_analysis
+        self.index = mpa.check_and_install_database(index, bowtie2db, self.pars['bowtie2_build'],
+                                                    self.pars['nproc'], False, offline)
+        self.mpa_pkl, _ = mpa.set_mapping_arguments(self.index, bowtie2db)
+        self.db = mpa.load_database(self.mpa_pkl, shared=self.pars['shm_db'] or None)
+        self.db_markers = list(self.db['markers'])
+        self.tree = mpa.TaxTree(self.db, set(ignore_markers) if ignore_markers else set())
+        if self.pars['abundance_engine'] == 'arrays':
+            self.tree.use_array_engine()
+        self.profiled = False
+
+    def profile_bowtie2out(self, path):
+        """Profiles a sample from its bowtie2out file (text or binary)
+
+        Args:
+            path (str): the path to the bowtie2out file
+
+        Returns:
+            pandas.DataFrame: the profile
+        """
+        markers2reads, nreads, avg_read_length = mpa.map2bbh(
+            path, self.pars['min_mapq_val'], 'bowtie2out', self.pars['min_alignment_len'], self.pars['nreads'],
+            db_markers=self.db_markers)
+        return self.profile_counts(markers2reads, nreads, avg_read_length)
+
+    def profile_sam(self, stream, nreads):
+        """Profiles a sample from the SAM file of its reads mapped against the database
+
+        Args:
+            stream (str | file): the path to the SAM file or a binary stream (e.g. io.BytesIO, optionally
+                compressed), which is consumed and closed
+            nreads (int): the number of reads of the metagenome
+
+        Returns:
+            pandas.DataFrame: the profile
+        """
+        markers2reads, nreads, avg_read_length = mpa.map2bbh(
+            stream, self.pars['min_mapq_val'], 'sam', self.pars['min_alignment_len'], nreads,
+            db_markers=self.db_markers)
+        return self.profile_counts(markers2reads, nreads, avg_read_length)
+
+    def profile_counts(self, marker_counts, nreads=None, avg_read_length=1):
+        """Profiles a sample from the number of reads mapped to each marker
+
+        Args:
+            marker_counts (dict | pandas.Series): the number of reads mapped to each marker, the markers not in
+                the database are ignored
+            nreads (int): the number of reads of the metagenome, needed for the unclassified estimation
+            avg_read_length (float): the average length of the reads
+
+        Returns:
+            pandas.DataFrame: the profile, with the number of reads of the metagenome and the estimated number of
+                reads mapped to the known clades in its attrs
+        """
+        if self.pars['unclassified_estimation'] and not nreads:
+            raise ValueError('The number of reads of the metagenome is needed for the unclassified estimation')
+        mpa.SGB_ANALYSIS = self.sgb_analysis
+        if self.profiled:
+            self.tree.reset()
+        self.profiled = True
+        self.tree.set_min_cu_len(self.pars['min_cu_len'])
+        self.tree.set_stat(self.pars['stat'], self.pars['stat_q'], self.pars['perc_nonzero'], avg_read_length,
+                           self.pars['avoid_disqm'])
+        mpa.add_marker_reads(self.pars, self.tree, {m: int(c) for m, c in marker_counts.items()})
+
+        tax_lev = self.pars['tax_lev'] + '__' if self.pars['tax_lev'] != 'a' else None
+        fraction_mapped_reads = 1.0
+        if self.pars['unclassified_estimation']:
+            fraction_mapped_reads = mpa.mapped_fraction(self.tree, tax_lev, nreads)
+        cl2ab, rr, tot_nreads = self.tree.relative_abundances(tax_lev)
+
+        rows = []
+        if self.pars['unclassified_estimation']:
+            rows.append(('UNCLASSIFIED', '-1', (1 - fraction_mapped_reads) * 100, None, None))
+        for (clade, taxid), relab in sorted(cl2ab.items(), reverse=True,
+                                            key=lambda x: x[1] * 100.0 + 100.0 * (8 - x[0][0].count('|'))):
+            if relab > 0.0:
+                coverage, est_reads = rr.get((clade, taxid), (None, None))
+                rows.append((clade, taxid, relab * 100.0 * fraction_mapped_reads, coverage, est_reads))
+        profile = pd.DataFrame(rows, columns=PROFILE_COLUMNS)
+        profile.attrs['nreads'] = nreads
+        profile.attrs['est_mapped_reads'] = tot_nreads
+        return profile
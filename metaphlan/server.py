@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import argparse as ap
+import gc
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+
+# the environment variable with the socket used by the client when --socket is not given
+SOCKET_ENV = 'METAPHLAN_SOCKET'
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'metaphlan-{}.sock'.format(os.getuid()))
+HEADER = struct.Struct('<I')
+STATUS = struct.Struct('<i')
+# the variables of the client environment passed to the jobs, the others are those of the server
+ENV_PREFIX = 'METAPHLAN_'
+ENV_FORWARDED = ('TMPDIR', 'PATH')
+# seconds between the collections of the exited jobs while no job is received
+REAP_INTERVAL = 1.0
+
+
+def read_params(args):
+    p = ap.ArgumentParser(prog='metaphlan serve', formatter_class=ap.RawTextHelpFormatter,
+                          description="Runs MetaPhlAn as a local server keeping the database and the tree loaded.\n"
+                                      "The jobs are sent with metaphlan_client.py using the metaphlan arguments, "
+                                      "the input and output paths are resolved from the working directory of the "
+                                      "client, which receives the standard output, the standard error and the exit "
+                                      "status of the job.\n")
+    p.add_argument('--socket', type=str, default=os.environ.get(SOCKET_ENV, DEFAULT_SOCKET),
+                   help="The Unix socket to listen on [default {}]".format(DEFAULT_SOCKET))
+    p.add_argument('--bowtie2db', metavar="METAPHLAN_BOWTIE2_DB", type=str, default=None,
+                   help="Folder containing the MetaPhlAn database [default the metaphlan default]")
+    p.add_argument('-x', '--index', type=str, default=None,
+                   help="The id of the database version to keep loaded [default the metaphlan default]")
+    p.add_argument('--offline', action='store_true',
+                   help="If used, MetaPhlAn will not check for new database updates")
+    p.add_argument('--mpa3', action='store_true',
+                   help="Keep the tree loaded for the MetaPhlAn 3 algorithm")
+    p.add_argument('--jobs', type=int, default=max(1, os.cpu_count() // 4),
+                   help="The maximum number of jobs run at the same time, the others wait for a free slot "
+                        "[default {}]".format(max(1, os.cpu_count() // 4)))
+    p.add_argument('--warm_index', action='store_true',
+                   help="Read the database files into the page cache when the server starts")
+    return p.parse_args(args)
+
+
+def recv_exactly(sock, n):
+    """Reads a fixed number of bytes from a socket
+
+    Args:
+        sock (socket.socket): the socket
+        n (int): the number of bytes
+
+    Returns:
+        bytes: the data, shorter than n if the connection was closed
+    """
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def peer_uid(sock):
+    """Returns the user ID of the process at the other end of a Unix socket
+
+    Args:
+        sock (socket.socket): the connected socket
+
+    Returns:
+        int: the user ID, None if the platform does not provide the credentials of the peer (SO_PEERCRED)
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+def forwarded_env(env):
+    """Returns the variables of an environment passed to the jobs: METAPHLAN_*, TMPDIR and PATH"""
+    return {k: v for k, v in env.items() if k.startswith(ENV_PREFIX) or k in ENV_FORWARDED}
+
+
+def send_job(sock, argv, fds=(0, 1, 2)):
+    """Sends a job to the server, passing the standard streams of the client
+
+    Args:
+        sock (socket.socket): the socket connected to the server
+        argv (list): the metaphlan command line
+        fds (tuple): the file descriptors used as standard input, output and error of the job
+    """
+    request = json.dumps({'argv': argv, 'cwd': os.getcwd(), 'env': forwarded_env(os.environ)}).encode()
+    socket.send_fds(sock, [HEADER.pack(len(request))], list(fds))
+    sock.sendall(request)
+
+
+def recv_job(sock):
+    """Receives a job sent with send_job
+
+    Args:
+        sock (socket.socket): the connection with the client
+
+    Returns:
+        tuple: the request and the file descriptors of the standard streams of the client
+    """
+    header, fds, _, _ = socket.recv_fds(sock, HEADER.size, 3)
+    if len(header) < HEADER.size:
+        raise ConnectionError('Incomplete request')
+    request = recv_exactly(sock, HEADER.unpack(header)[0])
+    return json.loads(request.decode()), fds
+
+
+def run_job(conn):
+    """Runs a job in the forked process of its connection and sends back its exit status
+
+    Args:
+        conn (socket.socket): the connection with the client
+    """
+    try:
+        from .metaphlan import main
+    except ImportError:
+        from metaphlan import main
+
+    request, fds = recv_job(conn)
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(request['cwd'])
+    for k in forwarded_env(os.environ):
+        del os.environ[k]
+    os.environ.update(forwarded_env(request['env']))
+    sys.argv = request['argv']
+
+    try:
+        main()
+        status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            sys.stderr.write('{}\n'.format(e.code))
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            status = status or 1
+    conn.sendall(STATUS.pack(status))
+
+
+def warm_database(pars):
+    """Loads the database and builds the tree shared by the jobs
+
+    Args:
+        pars (argparse.Namespace): the server parameters
+    """
+    try:
+        from . import metaphlan as mpa
+    except ImportError:
+        import metaphlan as mpa
+    mpa.SGB_ANALYSIS = not pars.mpa3
+    index = pars.index if pars.index is not None else mpa.INDEX
+    bowtie2db = pars.bowtie2db if pars.bowtie2db is not None else mpa.DEFAULT_DB_FOLDER
+    t0 = time.time()
+    resolved = mpa.check_and_install_database(index, bowtie2db, 'bowtie2-build', 4, False, pars.offline)
+    mpa_pkl, bowtie2_prefix = mpa.set_mapping_arguments(resolved, bowtie2db)
+    if not os.path.isfile(mpa_pkl):
+        sys.stderr.write("Error: Unable to find the mpa_pkl file at: {}\nExiting...\n\n".format(mpa_pkl))
+        sys.exit(1)
+    if pars.warm_index:
+        mpa.warm_index(mpa_pkl, bowtie2_prefix)
+    db = mpa.load_database(mpa_pkl)
+    tree = mpa.TaxTree(db, set())
+    tree.get_abundance_entries()
+    mpa.WARM_DATABASE.update({
+        'database': (index, bowtie2db),
+        'index': resolved,
+        'mpa_pkl': mpa_pkl,
+        'db': db,
+        'db_markers': list(db['markers']),
+        'sgb_analysis': mpa.SGB_ANALYSIS,
+        'tree': tree,
+    })
+    # the loaded objects are never collected, keeping the pages shared with the jobs untouched by the collector
+    gc.collect()
+    gc.freeze()
+    sys.stderr.write('Database {} loaded in {:.2f} s\n'.format(mpa_pkl, time.time() - t0))
+
+
+def reap_jobs(jobs, wait=False):
+    """Collects the exited jobs
+
+    Args:
+        jobs (set): the process IDs of the running jobs, updated
+        wait (bool): whether to wait for a job to exit
+    """
+    while jobs:
+        pid, _ = os.waitpid(-1, 0 if wait else os.WNOHANG)
+        if not pid:
+            break
+        jobs.discard(pid)
+        wait = False
+
+
+def serve(pars):
+    """Accepts the jobs on the socket, running each one in a process forked from the server
+
+    Only the connections of the user running the server are accepted. The exited jobs are collected when a
+    job is received and every REAP_INTERVAL seconds.
+
+    Args:
+        pars (argparse.Namespace): the server parameters
+    """
+    if os.path.exists(pars.socket):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(pars.socket)
+            sys.stderr.write("Error: A server is already listening on {}. Exiting...\n\n".format(pars.socket))
+            sys.exit(1)
+        except OSError:
+            os.unlink(pars.socket)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(pars.socket)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    server.settimeout(REAP_INTERVAL)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop)
+    jobs = set()
+    sys.stderr.write('Listening on {} ({} jobs at a time)\n'.format(pars.socket, pars.jobs))
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                reap_jobs(jobs)
+                continue
+            uid = peer_uid(conn)
+            if uid is not None and uid != os.getuid():
+                sys.stderr.write('Refused a job from the user {}\n'.format(uid))
+                conn.close()
+                continue
+            reap_jobs(jobs, wait=len(jobs) >= pars.jobs)
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    server.close()
+                    run_job(conn)
+                    status = 0
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(status)
+            conn.close()
+            jobs.add(pid)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(pars.socket)
+        sys.stderr.write('Server stopped\n')
+
+
+def serve_main(args):
+    pars = read_params(args)
+    if pars.jobs < 1:
+        sys.stderr.write("Error: The --jobs parameter should be a positive number. Exiting...\n\n")
+        sys.exit(1)
+    if not hasattr(socket, 'send_fds'):
+        sys.stderr.write("Error: metaphlan serve requires Python 3.9 or later. Exiting...\n\n")
+        sys.exit(1)
+    warm_database(pars)
+    serve(pars)
+
+
+def client_main():
+    """Runs metaphlan through a running server with the same arguments, streams and exit status
+
+    The socket is given with --socket as the first argument or with the METAPHLAN_SOCKET variable.
+    """
+    args = sys.argv[1:]
+    path = os.environ.get(SOCKET_ENV, DEFAULT_SOCKET)
+    if args[:1] == ['--socket']:
+        if len(args) < 2:
+            sys.stderr.write("Error: --socket requires the path to the socket of the server. Exiting...\n\n")
+            sys.exit(1)
+        path, args = args[1], args[2:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        sys.stderr.write("Error: Unable to connect to the MetaPhlAn server at {} ({}). "
+                         "Start it with: metaphlan serve\n".format(path, e.strerror))
+        sys.exit(1)
+    uid = peer_uid(sock)
+    if uid is not None and uid != os.getuid():
+        sock.close()
+        sys.stderr.write("Error: The MetaPhlAn server at {} is run by another user ({}). Exiting...\n\n".format(
+            path, uid))
+        sys.exit(1)
+    with sock:
+        send_job(sock, ['metaphlan'] + args)
+        status = recv_exactly(sock, STATUS.size)
+    if len(status) < STATUS.size:
+        sys.stderr.write("Error: The MetaPhlAn server closed the connection before the end of the job\n")
+        sys.exit(1)
+    sys.exit(STATUS.unpack(status)[0])
+
+
+if __name__ == '__main__':
+    client_main()
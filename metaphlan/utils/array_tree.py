@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+from itertools import chain
+
+import numpy as np
+
+
+# the number of markers of the clades whose misidentified markers are added back (see TaxClade.compute_abundance)
+N_RIPR = 10
+# the minimum fraction of markers with reads of the t__ clades of the species-level analysis
+MIN_NONZERO_STRAINS = 0.7
+
+
+def segment_sums(values, starts, lengths):
+    """Sums the segments of an array, adding the values of each segment in order as the Python sum does
+
+    Args:
+        values (numpy.ndarray): the values
+        starts (numpy.ndarray): the start of each segment
+        lengths (numpy.ndarray): the length of each segment
+
+    Returns:
+        numpy.ndarray: the sum of each segment, 0 for the empty ones
+    """
+    sums = np.zeros(len(starts), dtype=np.float64 if values.dtype.kind == 'f' else np.int64)
+    if not len(starts):
+        return sums
+    order = np.argsort(-lengths, kind='stable')
+    # the number of segments longer than k, for each position k
+    longer = np.searchsorted(-lengths[order], -np.arange(lengths.max()), side='left')
+    for k, n in enumerate(longer):
+        active = order[:n]
+        sums[active] += values[starts[active] + k]
+    return sums
+
+
+def segment_starts(lengths):
+    """Returns the start of each segment of a CSR array from the segment lengths"""
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return starts
+
+
+class ArrayTaxTree:
+    """The clades and the markers of a TaxTree as index arrays, computing the abundance of all the clades with
+    NumPy segment operations
+
+    The clades are indexed in depth-first order, with the children of each clade stored as a CSR array in their
+    insertion order, and the markers as a CSR array of the clades, sorted by name. The abundances are the same
+    as the ones computed by TaxClade.compute_abundance, which stays the reference implementation: the values of
+    each clade are sorted and summed in the same order.
+    """
+
+    def __init__(self, tree, sgb_analysis=True):
+        """
+        Args:
+            tree (TaxTree): the tree
+            sgb_analysis (bool): whether the tree is built for the SGB-level analysis
+        """
+        self.tree = tree
+        clades, parents, stack = [], [], [(tree.root, -1)]
+        while stack:
+            clade, parent = stack.pop()
+            if clade is not tree.root:
+                parents.append(parent)
+                clades.append(clade)
+            index = len(clades) - 1
+            stack.extend((c, index) for c in reversed(list(clade.children.values())))
+        self.clades = clades
+        index = {id(c): i for i, c in enumerate(clades)}
+        n = len(clades)
+        self.parents = np.array(parents, dtype=np.int64)
+        self.depths = np.zeros(n, dtype=np.int64)
+        for i, p in enumerate(parents):
+            self.depths[i] = self.depths[p] + 1 if p >= 0 else 0
+
+        nchildren = np.array([len(c.children) for c in clades], dtype=np.int64)
+        self.has_children = nchildren > 0
+        self.child_starts = segment_starts(nchildren)
+        self.nchildren = nchildren
+        self.children = np.array([index[id(ch)] for c in clades for ch in c.children.values()], dtype=np.int64)
+
+        nterminals = np.where(self.has_children, 0, 1)
+        for i in np.argsort(-self.depths, kind='stable'):
+            if parents[i] >= 0:
+                nterminals[parents[i]] += nterminals[i]
+        viruses = np.array(['k__Viruses' in c.get_full_name() for c in clades])
+        self.n_ripr = np.where((nterminals < 2) | viruses, 0, N_RIPR)
+        self.subcl_uncl = ~self.has_children & np.array([c.name[0] not in 'st' for c in clades])
+        # the t__ clades of the species-level analysis required to have reads on most of their markers
+        self.strain_check = np.array([not sgb_analysis and c.name[0] == 't' and
+                                      (len(c.father.children) > 1 or '_sp' in c.father.name or v)
+                                      for c, v in zip(clades, viruses)], dtype=bool)
+
+        # the markers in the order of the dicts of the clades, gathered for each sample
+        self.marker_clades = [c for c in clades if c.markers2nreads]
+        names = list(chain.from_iterable(c.markers2nreads for c in self.marker_clades))
+        clade_ids = np.repeat([index[id(c)] for c in self.marker_clades],
+                              [len(c.markers2nreads) for c in self.marker_clades])
+        # sorted by clade and name
+        self.gather = np.lexsort((np.argsort(np.argsort(names, kind='stable'), kind='stable'), clade_ids))
+        names = [names[i] for i in self.gather]
+        self.m_clades = clade_ids[self.gather]
+        self.m_lens = np.array([tree.markers2lens[m] for m in names], dtype=np.int64)
+        self.m_starts = np.searchsorted(self.m_clades, np.arange(n), side='left')
+        self.m_counts = np.bincount(self.m_clades, minlength=n)
+        exts = [[index[id(tree.exts2clades[e])] for e in tree.markers2exts[m]] for m in names]
+        self.ext_markers = np.repeat(np.arange(len(names)), [len(e) for e in exts])
+        self.ext_clades = np.array(list(chain.from_iterable(exts)), dtype=np.int64)
+
+    def gather_counts(self):
+        """Returns the number of reads of each marker, sorted by clade and name"""
+        counts = np.fromiter(chain.from_iterable(c.markers2nreads.values() for c in self.marker_clades),
+                             dtype=np.int64, count=len(self.gather))
+        return counts[self.gather]
+
+    def compute_abundances(self, counts, stat, quantile, perc_nonzero, avg_read_length, avoid_disqm, min_cu_len):
+        """Computes the abundance of all the clades from the number of reads of their markers
+
+        Args:
+            counts (numpy.ndarray): the number of reads of each marker, sorted by clade and name
+            stat (str): the statistic of the abundance of the clades (--stat)
+            quantile (float): the quantile of the truncated statistics (--stat_q)
+            perc_nonzero (float): the fraction of markers with reads of an external clade to consider a marker
+                misidentified (--perc_nonzero)
+            avg_read_length (float): the average read length
+            avoid_disqm (bool): whether to keep the misidentified markers (--avoid_disqm)
+            min_cu_len (int): the minimum total length of the markers of a clade (--min_cu_len)
+
+        Returns:
+            tuple: the abundance, the abundance of the unclassified subclades and whether the clade abundance was
+                set without the rest of the computation (t__ clades of the species-level analysis), for each clade
+        """
+        n_clades, n_markers = len(self.clades), len(counts)
+        m_clades, m_starts, m_counts = self.m_clades, self.m_starts, self.m_counts
+        positions = np.arange(n_markers)
+
+        # the markers hit by a clade whose markers have reads (perc_nonzero) are misidentified
+        if avoid_disqm:
+            included = np.ones(n_markers, dtype=bool)
+        else:
+            nonzeros = np.bincount(m_clades[counts > 0], minlength=n_clades)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                present = (m_counts > 0) & (nonzeros / np.maximum(m_counts, 1) > perc_nonzero)
+            removed = np.zeros(n_markers, dtype=bool)
+            removed[self.ext_markers[present[self.ext_clades]]] = True
+            n_removed = np.bincount(m_clades[removed], minlength=n_clades)
+            n_kept = m_counts - n_removed
+            # the first removed markers are added back to the clades with few markers left
+            readd = np.where((n_removed > 0) & (n_kept < self.n_ripr), self.n_ripr - n_kept, 0)
+            removed_rank = np.cumsum(removed) - removed
+            removed_rank -= removed_rank[m_starts[m_clades]]
+            readded = removed & (removed_rank < readd[m_clades])
+            included = ~removed | readded
+            # the markers added back follow the kept ones
+            positions = positions + readded * n_markers
+
+        clades, n, lens, positions = m_clades[included], counts[included], self.m_lens[included], positions[included]
+        lengths = np.bincount(clades, minlength=n_clades)
+        starts = segment_starts(lengths)
+        rat = np.bincount(clades, weights=lens, minlength=n_clades)
+        rat[rat == 0] = -1.0
+        nrawreads = np.bincount(clades, weights=n, minlength=n_clades)
+        quant = (quantile * lengths).astype(np.int64)
+
+        den = np.abs(lens - avg_read_length) + 1
+        norm = n / den
+        by_norm = np.lexsort((positions, n, norm, clades))
+        by_nreads = np.lexsort((positions, n, clades))
+
+        loc_ab = np.zeros(n_clades)
+        valid = rat >= 0
+        if stat in ['avg_g', 'wavg_g', 'tavg_g']:
+            simple = valid & ((quant == 0) | (stat == 'avg_g'))
+            loc_ab[simple] = nrawreads[simple] / rat[simple]
+        elif stat in ['avg_l', 'wavg_l', 'tavg_l']:
+            simple = valid & ((quant == 0) | (stat == 'avg_l'))
+            for c in np.flatnonzero(simple):
+                loc_ab[c] = np.mean(norm[by_nreads[starts[c]:starts[c] + lengths[c]]])
+        else:
+            simple = np.zeros(n_clades, dtype=bool)
+        trimmed = valid & ~simple
+        t_starts, t_lengths = starts[trimmed] + quant[trimmed], lengths[trimmed] - 2 * quant[trimmed]
+        if stat == 'tavg_g':
+            num = segment_sums(n[by_norm], t_starts, t_lengths)
+            loc_ab[trimmed] = num / segment_sums(den[by_norm], t_starts, t_lengths)
+        elif stat == 'wavg_g':
+            sorted_n, q = n[by_nreads], quant[trimmed]
+            wnreads = segment_sums(sorted_n, t_starts, t_lengths) + q * (sorted_n[t_starts] + sorted_n[t_starts + t_lengths])
+            loc_ab[trimmed] = wnreads / rat[trimmed]
+        elif stat in ['tavg_l', 'wavg_l', 'med']:
+            sorted_norm = norm[by_norm]
+            for c, s, l, q in zip(np.flatnonzero(trimmed), t_starts, t_lengths, quant[trimmed]):
+                if stat == 'tavg_l':
+                    loc_ab[c] = np.mean(sorted_norm[s:s + l])
+                elif stat == 'wavg_l':
+                    loc_ab[c] = np.mean(np.concatenate([np.repeat(sorted_norm[s], q), sorted_norm[s:s + l],
+                                                        np.repeat(sorted_norm[s + l], q)]))
+                else:
+                    loc_ab[c] = np.median(sorted_norm[s:s + l])
+
+        # the t__ clades of the species-level analysis with reads on few markers are absent
+        nonzeros = np.bincount(clades[n > 0], minlength=n_clades)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            absent = self.strain_check & ((lengths == 0) | (nonzeros / np.maximum(lengths, 1) < MIN_NONZERO_STRAINS))
+
+        abundance, uncl_abundance = np.zeros(n_clades), np.zeros(n_clades)
+        for depth in range(self.depths.max(), -1, -1) if n_clades else []:
+            level = np.flatnonzero(self.depths == depth)
+            sum_ab = segment_sums(abundance[self.children], self.child_starts[level], self.nchildren[level])
+            children, ab = self.has_children[level], loc_ab[level]
+            ab = np.where((rat[level] < min_cu_len) & children, sum_ab, np.where(ab < sum_ab, sum_ab, ab))
+            uncl = np.where((ab > sum_ab) & children, ab - sum_ab, 0.0)
+            lost = absent[level]
+            abundance[level] = np.where(lost, 0.0, ab)
+            uncl_abundance[level] = np.where(lost, 0.0, uncl)
+        return abundance, uncl_abundance, absent
+
+    def set_abundances(self):
+        """Computes the abundance of all the clades of the tree with the current reads and statistics, setting them
+        to the clades as TaxClade.compute_abundance does"""
+        cls = type(self.tree.root)
+        abundance, uncl_abundance, absent = self.compute_abundances(
+            self.gather_counts(), cls.stat, cls.quantile, cls.perc_nonzero, cls.avg_read_length, cls.avoid_disqm,
+            cls.min_cu_len)
+        for clade, ab, uncl, lost, subcl_uncl in zip(self.clades, abundance.tolist(), uncl_abundance.tolist(),
+                                                     absent.tolist(), self.subcl_uncl.tolist()):
+            clade.abundance = ab
+            if uncl > 0.0:
+                clade.uncl_abundance = uncl
+            clade.subcl_uncl = subcl_uncl and not lost
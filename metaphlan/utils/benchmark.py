@@ -0,0 +1,1086 @@
+#!/usr/bin/env python
+__author__ = 'Aitor Blanco Miguez (aitor.blancomiguez@unitn.it)'
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import argparse as ap
+import bz2
+import glob
+import gzip
+import io
+import multiprocessing as mp
+import os
+import pickle
+import shutil
+import random
+import re
+import subprocess as subp
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from .util_fun import info
+    from .read_fastx import FastxFeeder, read_and_write
+    from .sam_filter import SamFilter
+    from .compression import available_codecs, compressed_open
+    from .bowtie2out import BinaryBowtie2outWriter
+    from .subsampling import ReadSubsampler
+    from .prefilter import BITS_PER_MINIMIZER, DEFAULT_K, DEFAULT_W, Prefilter, build_prefilter
+    from .threaded_io import MergedLineReader, RoundRobinWriter
+    from .database_cache import ColumnarDatabase, build_cache, cache_path, load_database, read_cache_meta
+except ImportError:
+    from util_fun import info
+    from read_fastx import FastxFeeder, read_and_write
+    from sam_filter import SamFilter
+    from compression import available_codecs, compressed_open
+    from bowtie2out import BinaryBowtie2outWriter
+    from subsampling import ReadSubsampler
+    from prefilter import BITS_PER_MINIMIZER, DEFAULT_K, DEFAULT_W, Prefilter, build_prefilter
+    from threaded_io import MergedLineReader, RoundRobinWriter
+    from database_cache import ColumnarDatabase, build_cache, cache_path, load_database, read_cache_meta
+
+
+def generate_fastq(path, nreads, read_len=150, seed=1992):
+    """Writes a synthetic FASTQ file
+
+    Args:
+        path (str): the output file
+        nreads (int): the number of reads to generate
+        read_len (int): the maximum read length
+        seed (int): the random seed
+    """
+    rnd = random.Random(seed)
+    pool = [''.join(rnd.choice('ACGT') for _ in range(read_len)) for _ in range(1000)]
+    qual = 'I' * read_len
+    with open(path, 'w') as wf:
+        for i in range(nreads):
+            s = pool[i % len(pool)][:rnd.randint(read_len // 2, read_len)]
+            wf.write('@read{} sample\n{}\n+\n{}\n'.format(i, s, qual[:len(s)]))
+
+
+def benchmark_feeder(args):
+    """Reads/s of the in-process FASTQ feeder against the read_fastx.py subprocess it replaced, both streaming the
+    reads into the stdin of a consumer process as they did into BowTie2"""
+    path = args.input
+    if path is None:
+        path = os.path.join(args.tmp_dir, 'benchmark_reads.fastq')
+        info('Generating {} synthetic reads...'.format(args.nreads))
+        generate_fastq(path, args.nreads)
+
+    # the pipeline of run_bowtie2 before the in-process feeder: read_fastx.py -l min_len input | bowtie2 -U -
+    t0 = time.time()
+    legacy = subp.Popen([sys.executable, args.legacy_read_fastx, '-l', str(args.min_len), path], stdout=subp.PIPE,
+                        stderr=subp.PIPE)
+    consumer = subp.Popen(['cat'], stdin=legacy.stdout, stdout=subp.DEVNULL)
+    legacy.stdout.close()
+    stats = legacy.stderr.read().decode()
+    if legacy.wait() or consumer.wait():
+        raise RuntimeError('{} failed: {}'.format(args.legacy_read_fastx, stats))
+    legacy_time = time.time() - t0
+    nreads = int(stats.split('\t')[0])
+
+    t0 = time.time()
+    consumer = subp.Popen(['cat'], stdin=subp.PIPE, stdout=subp.DEVNULL)
+    feeder = FastxFeeder(path, consumer.stdin, min_len=args.min_len)
+    feeder.start()
+    feeder.join()
+    consumer.wait()
+    feeder_time = time.time() - t0
+
+    if feeder.exception is not None:
+        raise feeder.exception
+    print('path\treads\tseconds\treads/s')
+    print('read_fastx.py (legacy)\t{}\t{:.2f}\t{:.0f}'.format(nreads, legacy_time, nreads / legacy_time))
+    print('FastxFeeder\t{}\t{:.2f}\t{:.0f}'.format(feeder.nreads, feeder_time, feeder.nreads / feeder_time))
+
+
+def benchmark_decompression(args):
+    """Reads/s of the serial and parallel decompression of several compressed input files"""
+    inputs = args.input
+    if inputs is None:
+        plain = os.path.join(args.tmp_dir, 'benchmark_reads.fastq')
+        info('Generating {} gzip-compressed files of {} synthetic reads...'.format(args.nfiles, args.nreads))
+        generate_fastq(plain, args.nreads)
+        inputs = []
+        for i in range(args.nfiles):
+            inputs.append(os.path.join(args.tmp_dir, 'benchmark_reads_{}.fastq.gz'.format(i)))
+            with open(plain, 'rb') as rf, gzip.open(inputs[-1], 'wb') as wf:
+                shutil.copyfileobj(rf, wf)
+        inputs = ','.join(inputs)
+
+    print('nproc\treads\tseconds\treads/s')
+    for nproc in sorted({1, args.nproc}):
+        with open(os.devnull, 'wb') as out:
+            t0 = time.time()
+            nreads, _ = read_and_write([inputs], out, min_len=args.min_len, nproc=nproc)
+            elapsed = time.time() - t0
+        print('{}\t{}\t{:.2f}\t{:.0f}'.format(nproc, nreads, elapsed, nreads / elapsed))
+
+
+def legacy_read_subsampling(inputs, subsampling, seed, tmp_dir, out, min_len):
+    """The paired reads subsampling previously performed before the mapping: the inputs are counted, the sampled
+    reads are written to temporary files, which are then parsed by the feeder"""
+    n = []
+    for f in inputs:
+        with compressed_open(f, 'rb') as rf:
+            n.append(sum(buf.count(b'\n') for buf in iter(lambda: rf.read(1024 * 1024), b'')) // 4)
+    random.seed(int(seed))
+    sample = set(random.sample(range(n[0]), subsampling // 2))
+    tmp = []
+    for f in inputs:
+        tmp.append(tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False).name)
+        with compressed_open(f, 'rb') as rf, open(tmp[-1], 'wb') as wf:
+            for i in range(n[0]):
+                record = b''.join(rf.readline() for _ in range(4))
+                if i in sample:
+                    wf.write(record)
+    nreads, _ = read_and_write([','.join(tmp)], out, min_len=min_len)
+    for f in tmp:
+        os.remove(f)
+    return nreads
+
+
+def benchmark_read_subsampling(args):
+    """Seconds to subsample paired reads and feed them to the mapping, with the legacy count-then-sample passes
+    and with the single-pass reservoir sampling"""
+    plain = os.path.join(args.tmp_dir, 'benchmark_reads.fastq')
+    info('Generating two gzip-compressed files of {} synthetic reads...'.format(args.nreads))
+    generate_fastq(plain, args.nreads)
+    inputs = []
+    for mate in (1, 2):
+        inputs.append(os.path.join(args.tmp_dir, 'benchmark_reads_R{}.fastq.gz'.format(mate)))
+        with open(plain, 'rb') as rf, gzip.open(inputs[-1], 'wb', compresslevel=1) as wf:
+            shutil.copyfileobj(rf, wf)
+    os.remove(plain)
+
+    print('method\tsubsampling\treads\tseconds')
+    for subsampling in args.subsampling:
+        with open(os.devnull, 'wb') as out:
+            t0 = time.time()
+            nreads = legacy_read_subsampling(inputs, subsampling, '1992', args.tmp_dir, out, args.min_len)
+            print('count and sample\t{}\t{}\t{:.2f}'.format(subsampling, nreads, time.time() - t0))
+            t0 = time.time()
+            nreads, _ = ReadSubsampler(inputs, subsampling, '1992', True, args.tmp_dir).feed(out, args.min_len)
+            print('single pass\t{}\t{}\t{:.2f}'.format(subsampling, nreads, time.time() - t0))
+    for f in inputs:
+        os.remove(f)
+
+
+def random_sequence(rnd, length):
+    """Returns a random DNA sequence"""
+    return rnd.randbytes(length).translate(bytes.maketrans(bytes(range(256)), b'ACGT' * 64))
+
+
+def mutate(seq, divergence, rnd):
+    """Returns a copy of a sequence with a fraction of substituted bases, and one indel every ten substitutions"""
+    seq = bytearray(seq)
+    for pos in rnd.sample(range(len(seq)), int(round(len(seq) * divergence))):
+        seq[pos] = rnd.choice([b for b in b'ACGT' if b != seq[pos]])
+    for _ in range(int(round(len(seq) * divergence / 10))):
+        pos = rnd.randrange(len(seq))
+        if rnd.random() < 0.5:
+            del seq[pos]
+        else:
+            seq.insert(pos, rnd.choice(b'ACGT'))
+    return bytes(seq)
+
+
+def generate_prefilter_reads(path, markers, nreads, on_target, divergence, read_len=150, seed=1992):
+    """Writes synthetic reads, a fraction of which are drawn from the markers (IDs starting with on) and
+    the others are random (IDs starting with off)"""
+    rnd = random.Random(seed)
+    complement = bytes.maketrans(b'ACGT', b'TGCA')
+    with open(path, 'wb') as wf:
+        for i in range(nreads):
+            if rnd.random() < on_target:
+                marker = rnd.choice(markers)
+                start = rnd.randrange(len(marker) - read_len)
+                s = mutate(marker[start:start + read_len], divergence, rnd)
+                if rnd.random() < 0.5:
+                    s = s.translate(complement)[::-1]
+                name = b'on%d' % i
+            else:
+                s, name = random_sequence(rnd, read_len), b'off%d' % i
+            wf.write(b'@%s\n%s\n+\n%s\n' % (name, s, b'I' * len(s)))
+
+
+def count_prefilter_reads(path):
+    """Returns the number of reads drawn from the markers and of random reads in a FASTQ file"""
+    on, off = 0, 0
+    with open(path, 'rb') as rf:
+        for i, line in enumerate(rf):
+            if i % 4 == 0:
+                if line.startswith(b'@on'):
+                    on += 1
+                else:
+                    off += 1
+    return on, off
+
+
+def map_reads(args, index, path):
+    """Returns the number of reads mapped by BowTie2 and the mapping time"""
+    with open(path, 'rb') as rf:
+        t0 = time.time()
+        p = subp.Popen([args.bowtie2_exe, '--seed', '1992', '--quiet', '--no-unal', '--very-sensitive', '-S', '-',
+                        '-x', index, '-p', str(args.nproc), '-U', '-'], stdin=rf, stdout=subp.PIPE)
+        mapped = sum(1 for line in p.stdout if line[:1] != b'@' and not int(line.split(b'\t', 2)[1]) & 256)
+        p.wait()
+        return mapped, time.time() - t0
+
+
+def benchmark_prefilter(args):
+    """Recall and speed of the minimizer prefilter of the reads (--prefilter) on synthetic markers and reads
+
+    The recall is the fraction of the reads drawn from the markers kept by the prefilter and, when BowTie2 is
+    run, the fraction of the reads mapped without the prefilter still mapped with it."""
+    rnd = random.Random(1992)
+    markers = [random_sequence(rnd, rnd.randint(args.marker_len // 2, args.marker_len * 3 // 2))
+               for _ in range(args.nmarkers)]
+    fasta = os.path.join(args.tmp_dir, 'benchmark_markers.fna')
+    with open(fasta, 'wb') as wf:
+        wf.writelines(b'>marker%d\n%s\n' % (i, m) for i, m in enumerate(markers))
+    path = os.path.join(args.tmp_dir, 'benchmark_markers.prefilter')
+    t0 = time.time()
+    stats = build_prefilter(fasta, path, args.k, args.w, args.bits_per_minimizer)
+    info('Prefilter of {} minimizers built in {:.2f} s, {:.2%} of the bits set'.format(
+        stats['minimizers'], time.time() - t0, stats['fill']))
+    index = None
+    if args.bowtie2:
+        index = os.path.join(args.tmp_dir, 'benchmark_markers')
+        subp.check_call([args.bowtie2_build_exe, '--quiet', '-f', fasta, index], stdout=subp.DEVNULL)
+
+    print('divergence\tmin hits\treads\tfed reads\ton-target kept\toff-target kept\tfeeder seconds'
+          '\tmapped reads\tmapping recall\tbowtie2 seconds')
+    reads = os.path.join(args.tmp_dir, 'benchmark_reads.fastq')
+    fed = os.path.join(args.tmp_dir, 'benchmark_fed.fastq')
+    for divergence in args.divergence:
+        generate_prefilter_reads(reads, markers, args.nreads, args.on_target, divergence, seed=1993)
+        mapped_all = None
+        for min_hits in [None] + args.min_hits:
+            prefilter = Prefilter(path, min_hits) if min_hits is not None else None
+            with open(fed, 'wb') as out:
+                t0 = time.time()
+                feeder = FastxFeeder(reads, out, min_len=args.min_len, prefilter=prefilter)
+                feeder.start()
+                feeder.join()
+                feeder_time = time.time() - t0
+            if feeder.exception is not None:
+                raise feeder.exception
+            on, off = count_prefilter_reads(fed)
+            if min_hits is None:
+                on_total, off_total = on, off
+            mapped, bowtie2_time, recall = float('nan'), float('nan'), float('nan')
+            if index is not None:
+                mapped, bowtie2_time = map_reads(args, index, fed)
+                if min_hits is None:
+                    mapped_all = mapped
+                recall = mapped / mapped_all if mapped_all else float('nan')
+            print('{:.2f}\t{}\t{}\t{}\t{:.4f}\t{:.4f}\t{:.2f}\t{}\t{:.4f}\t{:.2f}'.format(
+                divergence, min_hits if min_hits is not None else 'no prefilter', feeder.nreads, on + off,
+                on / on_total if on_total else float('nan'), off / off_total if off_total else float('nan'),
+                feeder_time, mapped, recall, bowtie2_time))
+    for f in [fasta, path, reads, fed] + glob.glob(os.path.join(args.tmp_dir, 'benchmark_markers.*.bt2')):
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def benchmark_fanout(args):
+    """Mapping throughput of the reads split across several BowTie2 processes (--bt2_shards) sharing the
+    memory-mapped index, for each number of cores"""
+    path = args.input
+    if path is None:
+        path = os.path.join(args.tmp_dir, 'benchmark_reads.fastq')
+        info('Generating {} synthetic reads...'.format(args.nreads))
+        generate_fastq(path, args.nreads)
+    if max(args.cores) > os.cpu_count():
+        info('Only {} cores available, the larger runs are oversubscribed'.format(os.cpu_count()))
+
+    print('cores	bowtie2 processes	threads per process	reads	SAM lines	seconds	reads/s')
+    for cores in args.cores:
+        for shards in [s for s in args.shards if s <= cores]:
+            t0 = time.time()
+            procs = [subp.Popen([args.bowtie2_exe, '--seed', '1992', '--quiet', '--no-unal', '--very-sensitive',
+                                 '-S', '-', '-x', args.bowtie2db, '-p', str(cores // shards), '--mm', '-U', '-'],
+                                stdin=subp.PIPE, stdout=subp.PIPE) for _ in range(shards)]
+            if shards > 1:
+                bt2_in = RoundRobinWriter([p.stdin for p in procs])
+                bt2_out = MergedLineReader([p.stdout for p in procs], b'@', 1 << 20)
+            else:
+                bt2_in, bt2_out = procs[0].stdin, procs[0].stdout
+            feeder = FastxFeeder(path, bt2_in, min_len=args.min_len, nproc=cores)
+            feeder.start()
+            nlines = 0
+            while True:
+                lines = bt2_out.readlines(1 << 20)
+                if not lines:
+                    break
+                nlines += sum(1 for line in lines if line[:1] != b'@')
+            feeder.join()
+            if any(p.wait() for p in procs):
+                raise RuntimeError('BowTie2 failed with {} processes of {} threads'.format(shards, cores // shards))
+            if feeder.exception is not None:
+                raise feeder.exception
+            seconds = time.time() - t0
+            print('{}\t{}\t{}\t{}\t{}\t{:.2f}\t{:.0f}'.format(cores, shards, cores // shards, feeder.nreads, nlines,
+                                                          seconds, feeder.nreads / seconds))
+    if args.input is None:
+        os.remove(path)
+
+
+def benchmark_batch(args):
+    """Wall time of profiling a cohort with a single metaphlan --batch run against a loop of single runs"""
+    inputs = args.input
+    if not inputs:
+        inputs = [os.path.join(args.tmp_dir, 'benchmark_sample_{}.fastq'.format(i)) for i in range(args.nsamples)]
+        info('Generating {} samples of {} synthetic reads...'.format(args.nsamples, args.nreads))
+        for i, path in enumerate(inputs):
+            generate_fastq(path, args.nreads, seed=1992 + i)
+    metaphlan = [sys.executable, '-m', 'metaphlan.metaphlan', '--input_type', args.input_type, '--bowtie2db',
+                 args.bowtie2db, '--offline', '--nproc', str(args.nproc)] + (['-x', args.index] if args.index else [])
+    outputs = {mode: [os.path.join(args.tmp_dir, 'benchmark_{}_{}.txt'.format(mode, i)) for i in range(len(inputs))]
+               for mode in ('single', 'batch')}
+
+    t0 = time.time()
+    for path, output in zip(inputs, outputs['single']):
+        subp.check_call(metaphlan + [path, '--no_map', '-o', output], stderr=subp.DEVNULL)
+    single_time = time.time() - t0
+
+    manifest = os.path.join(args.tmp_dir, 'benchmark_manifest.tsv')
+    with open(manifest, 'w') as wf:
+        wf.write(''.join('sample{}\t{}\t{}\n'.format(i, path, output)
+                         for i, (path, output) in enumerate(zip(inputs, outputs['batch']))))
+    t0 = time.time()
+    subp.check_call(metaphlan + ['--batch', manifest], stderr=subp.DEVNULL)
+    batch_time = time.time() - t0
+
+    def profile(path):
+        with open(path) as rf:  # the command line and the sample name differ between the modes
+            return [line for line in rf if not line.startswith(('#/', '#SampleID'))]
+    same = all(profile(a) == profile(b) for a, b in zip(outputs['single'], outputs['batch']))
+    print('mode\tsamples\tseconds\tseconds/sample\tsame profiles')
+    print('single runs\t{}\t{:.2f}\t{:.2f}\t-'.format(len(inputs), single_time, single_time / len(inputs)))
+    print('--batch\t{}\t{:.2f}\t{:.2f}\t{}'.format(len(inputs), batch_time, batch_time / len(inputs),
+                                                  'yes' if same else 'no'))
+    for path in outputs['single'] + outputs['batch'] + [manifest] + (inputs if not args.input else []):
+        os.remove(path)
+
+
+def benchmark_outputs(args):
+    """Wall time of several analysis types written by a single metaphlan run (comma separated -t) against one run
+    per type"""
+    path = args.input
+    if path is None:
+        path = os.path.join(args.tmp_dir, 'benchmark_outputs.bowtie2out.txt')
+        info('Generating {} mapped reads against the markers of {}...'.format(args.nreads, args.index))
+        markers = list(load_database(os.path.join(args.bowtie2db, args.index + '.pkl'))['markers'])
+        rnd = random.Random(1992)
+        hit = rnd.sample(markers, min(len(markers), args.nmarkers))
+        with open(path, 'w') as wf:
+            wf.write(''.join('read{}\t{}\n'.format(i, rnd.choice(hit)) for i in range(args.nreads)))
+            wf.write('#nreads\t{}\n#avg_read_length\t150.0'.format(args.nreads * 10))
+    metaphlan = [sys.executable, '-m', 'metaphlan.metaphlan', path, '--input_type', 'bowtie2out', '--bowtie2db',
+                 args.bowtie2db, '--offline'] + (['-x', args.index] if args.index else [])
+    outputs = {mode: [os.path.join(args.tmp_dir, 'benchmark_{}_{}.txt'.format(mode, t)) for t in args.types]
+               for mode in ('single', 'combined')}
+
+    t0 = time.time()
+    for t, output in zip(args.types, outputs['single']):
+        subp.check_call(metaphlan + ['-t', t, '-o', output], stderr=subp.DEVNULL)
+    single_time = time.time() - t0
+    t0 = time.time()
+    subp.check_call(metaphlan + ['-t', ','.join(args.types), '-o', ','.join(outputs['combined'])],
+                    stderr=subp.DEVNULL)
+    combined_time = time.time() - t0
+
+    def output(path):
+        with open(path) as rf:  # the command line differs between the modes
+            return [line for line in rf if not line.startswith('#/')]
+    same = all(output(a) == output(b) for a, b in zip(outputs['single'], outputs['combined']))
+    print('mode\tanalysis types\tseconds\tsame outputs')
+    print('one run per type\t{}\t{:.2f}\t-'.format(len(args.types), single_time))
+    print('single run\t{}\t{:.2f}\t{}'.format(len(args.types), combined_time, 'yes' if same else 'no'))
+    for p in outputs['single'] + outputs['combined'] + ([path] if args.input is None else []):
+        os.remove(p)
+
+
+def benchmark_profiler(args):
+    """Time of Profiler.profile_sam with the SAM file given as a path and as the binary streams of a library
+    caller (io.BytesIO, compressed or not, and an unbuffered pipe), checking that the profiles are the same"""
+    try:
+        from ..profiler import Profiler
+    except ImportError:
+        from metaphlan.profiler import Profiler
+    info('Loading the database...')
+    profiler = Profiler(index=args.index, bowtie2db=args.bowtie2db, offline=True)
+    with compressed_open(args.input, 'rb') as rf:
+        sam = rf.read()
+
+    def pipe():
+        r, w = os.pipe()
+
+        def write():
+            with open(w, 'wb', buffering=0) as wf:
+                for i in range(0, len(sam), 1 << 16):
+                    wf.write(sam[i:i + (1 << 16)])
+        threading.Thread(target=write, daemon=True).start()
+        return open(r, 'rb', buffering=0)
+
+    sources = [('path', lambda: args.input), ('io.BytesIO', lambda: io.BytesIO(sam)),
+               ('io.BytesIO bz2', lambda: io.BytesIO(bz2.compress(sam, 1))),
+               ('io.BytesIO gzip', lambda: io.BytesIO(gzip.compress(sam, 1))), ('unbuffered pipe', pipe)]
+    print('source\tseconds\tclades\tsame profile')
+    reference = None
+    for name, source in sources:
+        stream = source()
+        t0 = time.time()
+        profile = profiler.profile_sam(stream, args.nreads)
+        seconds = time.time() - t0
+        if reference is None:
+            reference = profile
+        print('{}\t{:.2f}\t{}\t{}'.format(name, seconds, len(profile), 'yes' if profile.equals(reference) else 'no'))
+
+
+def generate_sam(nlines, seed=1992):
+    """Returns a list of synthetic BowTie2 SAM lines against MetaPhlAn-like markers"""
+    rnd = random.Random(seed)
+    markers = ['{}|SGB{}|g{}'.format('VDB' if i % 50 == 0 else 'UniRef90_{}'.format(i), i % 3000, i) for i in range(20000)]
+    seq = ''.join(rnd.choice('ACGT') for _ in range(150))
+    lines = []
+    for i in range(nlines):
+        flag = rnd.choice([0, 16, 256, 272, 0, 16])
+        cigar = rnd.choice(['150M', '20S130M', '60M2I88M', '100M50S'])
+        lines.append('read{}__1.{}\t{}\t{}\t1\t{}\t{}\t*\t0\t0\t{}\t{}\tAS:i:-5\n'.format(
+            i, i, flag, rnd.choice(markers), rnd.randint(0, 42), cigar, seq, 'I' * 150).encode())
+    return lines
+
+
+def legacy_sam_filter(lines, min_mapq_val, min_alignment_len):
+    """The per-line string processing previously performed by run_bowtie2 and map2bbh"""
+    def mapq_filter(marker_name, mapq_value, min_mapq_val):
+        if 'GeneID:' in marker_name or 'VDB' in marker_name:
+            return True
+        else:
+            if mapq_value > min_mapq_val:
+                return True
+        return False
+
+    kept = 0
+    for line in lines:
+        o = line.decode('utf-8').strip().split('\t')
+        if not o[0].startswith('@'):
+            if not o[2].endswith('*'):
+                if (hex(int(o[1]) & 0x100) == '0x0'):
+                    if mapq_filter(o[2], int(o[4]), min_mapq_val):
+                        if ((min_alignment_len is None) or
+                                (max([int(x.strip('M')) for x in re.findall(r'(\d*M)', o[5]) if x]) >= min_alignment_len)):
+                            kept += 1
+    return kept
+
+
+def benchmark_sam_filter(args):
+    """Lines/s of the byte-level SAM filter against the legacy string processing"""
+    lines = generate_sam(args.nlines)
+    print('filter\tlines\tkept\tseconds\tlines/s')
+
+    t0 = time.time()
+    kept = legacy_sam_filter(lines, args.min_mapq_val, args.min_alignment_len)
+    elapsed = time.time() - t0
+    print('legacy\t{}\t{}\t{:.2f}\t{:.0f}'.format(len(lines), kept, elapsed, len(lines) / elapsed))
+
+    sam_filter = SamFilter(args.min_mapq_val, args.min_alignment_len)
+    t0 = time.time()
+    kept = sum(1 for line in lines if sam_filter.filter(line) is not None)
+    elapsed = time.time() - t0
+    print('SamFilter\t{}\t{}\t{:.2f}\t{:.0f}'.format(len(lines), kept, elapsed, len(lines) / elapsed))
+
+
+def benchmark_codecs(args):
+    """Write MB/s, read MB/s and compression ratio of the codecs of the bowtie2out files"""
+    if args.input is not None:
+        with compressed_open(args.input, 'rb') as rf:
+            data = rf.read()
+    else:
+        sam_filter = SamFilter(5)
+        mapped = (sam_filter.filter(line) for line in generate_sam(args.nlines))
+        data = b''.join(b'%s\t%s\n' % (o[0], sam_filter.marker(o[2])[0]) for o in mapped if o is not None)
+    mb = len(data) / 1024 ** 2
+    path = os.path.join(args.tmp_dir, 'benchmark_codec')
+
+    print('codec\tlevel\tthreads\twrite MB/s\tread MB/s\tratio')
+    for codec, level, nthreads in ((c, l, n) for c in [None] + available_codecs()
+                                   for l in ([None] if c is None else args.levels.get(c, [None]))
+                                   for n in ([1] if c is None else sorted({1, args.nproc}))):
+        t0 = time.time()
+        with compressed_open(path, 'wb', codec, level, nthreads=nthreads) as wf:
+            for i in range(0, len(data), 1024 * 1024):
+                wf.write(data[i:i + 1024 * 1024])
+        write_time = time.time() - t0
+        size = os.path.getsize(path)
+        t0 = time.time()
+        with compressed_open(path, 'rb') as rf:
+            while rf.read(1024 * 1024):
+                pass
+        read_time = time.time() - t0
+        print('{}\t{}\t{}\t{:.1f}\t{:.1f}\t{:.2f}'.format(codec or 'none', '-' if level is None else level,
+                                                         nthreads, mb / write_time, mb / read_time,
+                                                         len(data) / size))
+    os.remove(path)
+
+
+def load_bowtie2out(path, markers, read_ids, results):
+    """Loads a bowtie2out file with map2bbh in a child process, reporting the time and the peak RSS"""
+    try:
+        from ..metaphlan import map2bbh, peak_rss_mb
+    except ImportError:
+        from metaphlan.metaphlan import map2bbh, peak_rss_mb
+    t0 = time.time()
+    map2bbh(path, 5, db_markers=markers, read_ids=read_ids)
+    results.put((time.time() - t0, peak_rss_mb()))
+
+
+def benchmark_bowtie2out(args):
+    """Seconds and peak RSS to load the text and binary bowtie2out files with map2bbh, with and without the read IDs
+    for the text files"""
+    rnd = random.Random(1992)
+    markers = ['UniRef90_{}|1__{}|SGB{}'.format(i, rnd.randint(1, 20), i % 5000) for i in range(args.nmarkers)]
+    reads = [b'read%d__1.%d' % (i, i) for i in range(args.nhits)]
+    hits = [markers[rnd.randrange(len(markers))].encode() for _ in range(args.nhits)]
+    nreads = 2 * args.nhits
+
+    paths = []
+    for ext in ['', '.bz2']:
+        paths.append(('text', os.path.join(args.tmp_dir, 'benchmark.bowtie2out.txt' + ext)))
+        with compressed_open(paths[-1][1], 'wb') as wf:
+            wf.write(b''.join(b'%s\t%s\n' % h for h in zip(reads, hits)))
+            wf.write('#nreads\t{}\n#avg_read_length\t150.0'.format(nreads).encode())
+    for ordinals in [False, True]:
+        for ext in ['', '.bz2']:
+            paths.append(('binary' + (' + ordinals' if ordinals else ''),
+                          os.path.join(args.tmp_dir, 'benchmark.bowtie2out{}.bin{}'.format(int(ordinals), ext))))
+            writer = BinaryBowtie2outWriter(paths[-1][1], markers, 'benchmark', ordinals=ordinals)
+            for i in range(0, args.nhits, 10000):  # the hits are streamed in batches, as by the SAM parser
+                writer.write_hits(reads[i:i + 10000], hits[i:i + 10000])
+            writer.close(nreads, 150.0)
+
+    ctx = mp.get_context('spawn')  # a fresh process for each measure of the peak RSS
+    results = ctx.Queue()
+    print('format\tfile\tMB\tloaded\tseconds\tpeak RSS MB')
+    for fmt, path in paths:
+        for read_ids in ([True, False] if fmt == 'text' else [False]):  # the binary files store no read names
+            p = ctx.Process(target=load_bowtie2out, args=(path, markers, read_ids, results))
+            p.start()
+            elapsed, rss = results.get()
+            p.join()
+            print('{}\t{}\t{:.1f}\t{}\t{:.2f}\t{:.0f}'.format(fmt, os.path.basename(path), os.path.getsize(path) / 1024 ** 2,
+                                                         'read IDs' if read_ids else 'counts', elapsed, rss))
+        os.remove(path)
+
+
+def generate_database(path, nmarkers, nsgbs, seed=1992):
+    """Writes a synthetic database pkl with the structure of the SGB databases"""
+    rnd = random.Random(seed)
+    taxonomy, taxa = {}, []
+    for s in range(nsgbs):
+        # each rank divides the next one, so that every clade has a single parent as in the real taxonomy
+        ranks = (s % 40, s % 120, s % 360, s % 1440, s % 5760, s)
+        clade = 'k__Bacteria|p__P{}|c__C{}|o__O{}|f__F{}|g__G{}|s__S{}|t__SGB{}'.format(*ranks, s)
+        taxonomy[clade] = ('2|{}|{}|{}|{}|{}|{}|'.format(*ranks), rnd.randint(1000000, 6000000))
+        taxa.append(clade)
+    markers = {}
+    for i in range(nmarkers):
+        s = rnd.randrange(nsgbs)
+        markers['UniRef90_{}|1__{}|SGB{}'.format(i, rnd.randint(1, 20), s)] = {
+            'clade': 't__SGB{}'.format(s), 'len': rnd.randint(150, 3000),
+            'ext': ['SGB{}'.format(rnd.randrange(nsgbs)) for _ in range(rnd.choice([0, 0, 1, 3]))],
+            'taxon': taxa[s], 'score': 0}
+    with bz2.BZ2File(path, 'w') as wf:
+        pickle.dump({'taxonomy': taxonomy, 'markers': markers, 'merged_taxon': {}}, wf)
+
+
+def load_database_tree(path, cached, results):
+    """Loads a database from its pkl or its cache and builds its tree in a child process, reporting the
+    seconds of each stage and the peak RSS"""
+    try:
+        from ..metaphlan import TaxTree, peak_rss_mb
+    except ImportError:
+        from metaphlan.metaphlan import TaxTree, peak_rss_mb
+    t0 = time.time()
+    if cached:
+        db = ColumnarDatabase(cache_path(path), read_cache_meta(path))
+    else:
+        with bz2.BZ2File(path, 'r') as a:
+            db = pickle.load(a)
+    markers = list(db['markers'])
+    t1 = time.time()
+    TaxTree(db, set())
+    results.put((t1 - t0, time.time() - t1, peak_rss_mb(), len(markers)))
+
+
+def benchmark_database_cache(args):
+    """Startup time and peak RSS of the database loaded from the bz2 pkl and from its columnar cache"""
+    path = args.database
+    if path is None:
+        path = os.path.join(args.tmp_dir, 'benchmark_database.pkl')
+        info('Generating a database of {} markers and {} SGBs...'.format(args.nmarkers, args.nsgbs))
+        generate_database(path, args.nmarkers, args.nsgbs)
+    t0 = time.time()
+    build_cache(path)
+    info('Cache built in {:.2f} s'.format(time.time() - t0))
+
+    ctx = mp.get_context('spawn')  # a fresh process for each measure of the peak RSS
+    results = ctx.Queue()
+    print('source\tmarkers\tload seconds\ttree seconds\ttotal seconds\tpeak RSS MB')
+    for cached in [False, True]:
+        p = ctx.Process(target=load_database_tree, args=(path, cached, results))
+        p.start()
+        load_time, tree_time, rss, nmarkers = results.get()
+        p.join()
+        print('{}\t{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.0f}'.format('cache' if cached else 'bz2 pkl', nmarkers, load_time,
+                                                          tree_time, load_time + tree_time, rss))
+    if args.database is None:
+        shutil.rmtree(cache_path(path))
+        os.remove(path)
+
+
+def memory_mb():
+    """Returns the resident, the proportional and the unique set sizes of the process in MB: the shared pages are
+    split between the processes mapping them in the second, and left out of the third"""
+    sizes = {}
+    with open('/proc/self/smaps_rollup') as rf:
+        for line in rf:
+            if line.startswith(('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:')):
+                sizes[line.split(':')[0]] = int(line.split()[1]) / 1024
+    return sizes['Rss'], sizes['Pss'], sizes['Private_Clean'] + sizes['Private_Dirty']
+
+
+def shared_database_worker(path, shared, barrier, results):
+    """Loads a database, reads all its markers and builds its tree as a run does, measuring the unique set size
+    after the loading and the memory while all the workers hold the database and the tree"""
+    try:
+        from .. import metaphlan as mpa
+    except ImportError:
+        from metaphlan import metaphlan as mpa
+    db = load_database(path, shared=shared)
+    total_len = sum(m['len'] for _, m in db['markers'].items())
+    db_uss = memory_mb()[2]
+    tree = mpa.TaxTree(db, set())
+    barrier.wait()
+    results.put(memory_mb() + (db_uss, total_len, len(tree.markers2lens)))
+    barrier.wait()
+
+
+def benchmark_shared_database(args):
+    """Aggregate memory of concurrent processes each loading the database or attaching to the shared one (--shm_db)
+    and building its tree. Only the columns of the database are shared, the tree is built in each process: the
+    unique set size (USS) of a process, its private memory, is reported after loading the database and after
+    building the tree"""
+    path = args.database
+    if path is None:
+        path = os.path.join(args.tmp_dir, 'benchmark_database.pkl')
+        info('Generating a database of {} markers and {} SGBs...'.format(args.nmarkers, args.nsgbs))
+        generate_database(path, args.nmarkers, args.nsgbs)
+
+    ctx = mp.get_context('spawn')
+    print('database\tprocesses\tseconds\ttotal RSS MB\ttotal PSS MB\tPSS MB/process\tUSS MB/process (database)'
+          '\tUSS MB/process (database + tree)')
+    for shared in [False, True]:
+        for nproc in args.processes:
+            barrier, results = ctx.Barrier(nproc + 1), ctx.Queue()
+            t0 = time.time()
+            procs = [ctx.Process(target=shared_database_worker, args=(path, shared, barrier, results))
+                     for _ in range(nproc)]
+            for p in procs:
+                p.start()
+            barrier.wait()
+            elapsed = time.time() - t0
+            sizes = [results.get() for _ in procs]
+            barrier.wait()
+            for p in procs:
+                p.join()
+            if len(set(s[4:] for s in sizes)) != 1:
+                raise RuntimeError('The workers read different databases')
+            rss, pss = sum(s[0] for s in sizes), sum(s[1] for s in sizes)
+            print('{}\t{}\t{:.2f}\t{:.0f}\t{:.0f}\t{:.0f}\t{:.0f}\t{:.0f}'.format(
+                'shared' if shared else 'private', nproc, elapsed, rss, pss, pss / nproc,
+                sum(s[3] for s in sizes) / nproc, sum(s[2] for s in sizes) / nproc))
+    if args.database is None:
+        os.remove(path)
+
+
+def benchmark_abundance(args):
+    """Seconds of the profiles computed with the object and the array engines (--abundance_engine) of random
+    samples, checking that both give the same profiles"""
+    try:
+        from .. import metaphlan as mpa
+    except ImportError:
+        from metaphlan import metaphlan as mpa
+    path = args.database
+    if path is None:
+        path = os.path.join(args.tmp_dir, 'benchmark_database.pkl')
+        info('Generating a database of {} markers and {} SGBs...'.format(args.nmarkers, args.nsgbs))
+        generate_database(path, args.nmarkers, args.nsgbs)
+    mpa.SGB_ANALYSIS = not args.mpa3
+    tree = mpa.TaxTree(load_database(path), set())
+    t0 = time.time()
+    tree.use_array_engine()
+    array_tree = tree.array_tree
+    info('Array tree of {} clades and {} markers built in {:.2f} s'.format(
+        len(array_tree.clades), len(array_tree.gather), time.time() - t0))
+
+    rnd = random.Random(1992)
+    clades = sorted(set(tree.markers2clades.values()))
+    print('sample\tstat\tavoid_disqm\tpresent clades\tobjects seconds\tarrays seconds')
+    for sample in range(args.samples):
+        present = set(rnd.sample(clades, max(1, int(len(clades) * args.present))))
+        counts = {m: (rnd.randint(0, 50) if rnd.random() < 0.8 else 0) if c in present else
+                  (rnd.randint(1, 3) if rnd.random() < 0.01 else 0) for m, c in tree.markers2clades.items()}
+        counts = {m: c for m, c in counts.items() if c}
+        for stat in args.stats:
+            for avoid_disqm in [False, True]:
+                profiles, times = [], []
+                for engine in [None, array_tree]:
+                    tree.reset()
+                    tree.array_tree = engine
+                    tree.set_min_cu_len(2000)
+                    tree.set_stat(stat, args.stat_q, 0.33, 150.0, avoid_disqm)
+                    for m, c in counts.items():
+                        tree.add_reads(m, c)
+                    t0 = time.time()
+                    profiles.append(tree.relative_abundances(None))
+                    times.append(time.time() - t0)
+                if profiles[0] != profiles[1]:
+                    raise RuntimeError('The engines computed different profiles for sample {} with --stat {}{}'.format(
+                        sample, stat, ' --avoid_disqm' if avoid_disqm else ''))
+                print('{}\t{}\t{}\t{}\t{:.3f}\t{:.3f}'.format(sample, stat, avoid_disqm, len(present), *times))
+    if args.database is None:
+        os.remove(path)
+
+
+def legacy_full_name(clade, attr):
+    """The lineage of a clade previously rebuilt by TaxClade.get_full_name and get_full_taxids on every call"""
+    fullname = [getattr(clade, attr) or '']
+    cl = clade.father
+    while cl:
+        fullname = [getattr(cl, attr)] + fullname
+        cl = cl.father
+    return "|".join(fullname[1:])
+
+
+def legacy_add_reads(tree, sgb_analysis, marker, n, add_viruses=False, ignore_eukaryotes=False, ignore_bacteria=False,
+                     ignore_archaea=False, ignore_ksgbs=False, ignore_usgbs=False):
+    """TaxTree.add_reads with the filters previously applied to the lineage walked for each marker"""
+    cl = tree.all_clades[tree.markers2clades[marker]]
+    if ignore_bacteria or ignore_archaea or ignore_eukaryotes:
+        cn = legacy_full_name(cl, 'name')
+        if ((ignore_archaea and cn.startswith("k__Archaea")) or (ignore_bacteria and cn.startswith("k__Bacteria")) or
+                (ignore_eukaryotes and cn.startswith("k__Eukaryota"))):
+            return (None, None)
+    if not sgb_analysis and not add_viruses and legacy_full_name(cl, 'name').startswith("k__Vir"):
+        return (None, None)
+    if sgb_analysis and (ignore_ksgbs or ignore_usgbs):
+        cn = legacy_full_name(cl, 'name')
+        if (ignore_ksgbs and not '_SGB' in cn.split('|')[-2]) or (ignore_usgbs and '_SGB' in cn.split('|')[-2]):
+            return (None, None)
+    cl.markers2nreads[marker] = n
+    return (legacy_full_name(cl, 'name'), legacy_full_name(cl, 'tax_id'))
+
+
+def benchmark_add_reads(args):
+    """Seconds of TaxTree.add_reads over all the markers of the database, with the lineages and the filters
+    computed for each marker or cached in the tree"""
+    try:
+        from .. import metaphlan as mpa
+    except ImportError:
+        from metaphlan import metaphlan as mpa
+    path = args.database
+    if path is None:
+        path = os.path.join(args.tmp_dir, 'benchmark_database.pkl')
+        info('Generating a database of {} markers and {} SGBs...'.format(args.nmarkers, args.nsgbs))
+        generate_database(path, args.nmarkers, args.nsgbs)
+    mpa.SGB_ANALYSIS = not args.mpa3
+    t0 = time.time()
+    tree = mpa.TaxTree(load_database(path), set())
+    info('Tree built in {:.2f} s'.format(time.time() - t0))
+    markers = list(tree.markers2lens)
+
+    print('filters\tmarkers\tlegacy seconds\tcached seconds')
+    for filters in [{}, {'ignore_archaea': True, 'ignore_eukaryotes': True}, {'ignore_usgbs': True},
+                    {'add_viruses': True}]:
+        results, times = [], []
+        for legacy in [True, False]:
+            t0 = time.time()
+            if legacy:
+                results.append([legacy_add_reads(tree, mpa.SGB_ANALYSIS, m, 1, **filters) for m in markers])
+            else:
+                results.append([tree.add_reads(m, 1, **filters) for m in markers])
+            times.append(time.time() - t0)
+            tree.reset()
+        if results[0] != results[1]:
+            raise RuntimeError('The cached lineages differ from the legacy ones with {}'.format(filters))
+        print('{}\t{}\t{:.2f}\t{:.2f}'.format(','.join(filters) or 'none', len(markers), *times))
+    if args.database is None:
+        os.remove(path)
+
+
+def legacy_mapping_subsampling(path, subsampling, seed):
+    """The mapping subsampling previously performed by map2bbh, sampling the mapped reads after loading all of them"""
+    try:
+        from ..metaphlan import read_and_split
+    except ImportError:
+        from metaphlan import read_and_split
+    reads2markers = {}
+    with compressed_open(path, 'rb') as rf:
+        for r, c in read_and_split(rf):
+            if r.startswith('#') and 'nreads' in r:
+                n_metagenome_reads = int(c)
+            elif not r.startswith('#'):
+                reads2markers[r] = c
+    reads2markers = dict(sorted(reads2markers.items()))
+    random.seed(int(seed))
+    sgb = {r: m for r, m in reads2markers.items() if ('SGB' in m or 'EUK' in m) and not 'VDB' in m}
+    viral = {r: m for r, m in reads2markers.items() if 'VDB' in m and not ('SGB' in m or 'EUK' in m)}
+    sample = {r: sgb[r] for r in random.sample(list(sgb.keys()), int((len(sgb) * subsampling) / n_metagenome_reads))}
+    sample.update({r: viral[r] for r in random.sample(list(viral.keys()), int((len(viral) * subsampling) / n_metagenome_reads))})
+    return sample
+
+
+def subsample_mapping(path, subsampling, legacy, results):
+    """Subsamples the mapped reads of a bowtie2out file in a child process, reporting the time and the peak RSS"""
+    try:
+        from ..metaphlan import map2bbh, peak_rss_mb
+    except ImportError:
+        from metaphlan.metaphlan import map2bbh, peak_rss_mb
+    t0 = time.time()
+    if legacy:
+        legacy_mapping_subsampling(path, subsampling, '1992')
+    else:
+        map2bbh(path, 5, mapping_subsampling=True, subsampling=subsampling, subsampling_seed='1992', read_ids=True)
+    results.put((time.time() - t0, peak_rss_mb()))
+
+
+def benchmark_mapping_subsampling(args):
+    """Seconds and peak RSS of the mapping subsampling, sampling after loading all the mapped reads or in one pass"""
+    rnd = random.Random(1992)
+    path = os.path.join(args.tmp_dir, 'benchmark.mapsub.bowtie2out.txt')
+    with open(path, 'wb') as wf:
+        for i in range(0, args.nhits, 100000):
+            wf.write(b''.join(b'read%d__1.%d\tUniRef90_%d|1__1|%s%d\n' % (
+                j, j, j % 100000, b'VDB' if rnd.random() < 0.05 else b'SGB', j % 5000)
+                for j in range(i, min(i + 100000, args.nhits))))
+        wf.write('#nreads\t{}\n#avg_read_length\t150.0'.format(args.nreads).encode())
+
+    ctx = mp.get_context('spawn')  # a fresh process for each measure of the peak RSS
+    results = ctx.Queue()
+    print('method\tmapped\tsubsampling\tseconds\tpeak RSS MB')
+    for subsampling in args.subsampling:
+        for legacy in [True, False]:
+            p = ctx.Process(target=subsample_mapping, args=(path, subsampling, legacy, results))
+            p.start()
+            elapsed, rss = results.get()
+            p.join()
+            print('{}\t{}\t{}\t{:.2f}\t{:.0f}'.format('load and sample' if legacy else 'one pass', args.nhits,
+                                                    subsampling, elapsed, rss))
+    os.remove(path)
+
+
+def parse_levels(levels):
+    """Parses the compression levels to test, e.g. gzip:1,6;zstd:1,3,9"""
+    return {c: [int(l) for l in ls.split(',')] for c, ls in (x.split(':') for x in levels.split(';'))}
+
+
+def read_params():
+    """ Reads and parses the command line arguments of the script
+
+    Returns:
+        namespace: The populated namespace with the command line arguments
+    """
+    p = ap.ArgumentParser(description="Micro-benchmarks of the MetaPhlAn hot paths",
+                          formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    p.add_argument('--tmp_dir', type=str, default=tempfile.gettempdir(), help="The folder for the synthetic inputs")
+    sp = p.add_subparsers(dest='benchmark', required=True)
+
+    s = sp.add_parser('feeder', help="Throughput of the reads feeder of the mapping step",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('--legacy_read_fastx', type=str, required=True,
+                   help="The read_fastx.py script of MetaPhlAn 4.1.1 (e.g. git show 4.1.1:metaphlan/utils/read_fastx.py)")
+    s.add_argument('-i', '--input', type=str, default=None, help="An uncompressed FASTQ file, synthetic reads if not specified")
+    s.add_argument('-n', '--nreads', type=int, default=1000000, help="The number of synthetic reads")
+    s.add_argument('-l', '--min_len', type=int, default=70, help="The minimum read length")
+    s.set_defaults(func=benchmark_feeder)
+
+    s = sp.add_parser('decompression', help="Throughput of the serial and parallel decompression of the input files",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-i', '--input', type=str, default=None,
+                   help="Comma separated compressed FASTQ files, synthetic gzip-compressed reads if not specified")
+    s.add_argument('-n', '--nreads', type=int, default=500000, help="The number of synthetic reads per file")
+    s.add_argument('--nfiles', type=int, default=4, help="The number of synthetic files")
+    s.add_argument('-l', '--min_len', type=int, default=70, help="The minimum read length")
+    s.add_argument('-p', '--nproc', type=int, default=4, help="The number of threads of the parallel decompression")
+    s.set_defaults(func=benchmark_decompression)
+
+    s = sp.add_parser('codecs', help="Speed and compression ratio of the codecs of the bowtie2out files",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-i', '--input', type=str, default=None,
+                   help="A bowtie2out file, synthetic mapping results if not specified")
+    s.add_argument('-n', '--nlines', type=int, default=2000000, help="The number of synthetic SAM lines")
+    s.add_argument('--levels', type=parse_levels, default='bz2:9;gzip:1,6;zstd:1,3,9;lz4:0,9',
+                   help="The compression levels to test for each codec")
+    s.add_argument('-p', '--nproc', type=int, default=4, help="The number of threads of the block compression")
+    s.set_defaults(func=benchmark_codecs)
+
+    s = sp.add_parser('bowtie2out', help="Loading time and memory of the text and binary bowtie2out files",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-n', '--nhits', type=int, default=2000000, help="The number of mapped reads")
+    s.add_argument('--nmarkers', type=int, default=100000, help="The number of markers of the synthetic database")
+    s.set_defaults(func=benchmark_bowtie2out)
+
+    s = sp.add_parser('dbcache', help="Startup time and memory of the database loaded from the pkl and from its cache",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-d', '--database', type=str, default=None,
+                   help="A MetaPhlAn database pkl, its cache is built next to it, a synthetic database if not specified")
+    s.add_argument('--nmarkers', type=int, default=1000000, help="The number of markers of the synthetic database")
+    s.add_argument('--nsgbs', type=int, default=30000, help="The number of SGBs of the synthetic database")
+    s.set_defaults(func=benchmark_database_cache)
+
+    s = sp.add_parser('shm', help="Aggregate and private memory of concurrent runs with the database shared in memory "
+                                  "(--shm_db), each building its own tree",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-d', '--database', type=str, default=None,
+                   help="A MetaPhlAn database pkl, a synthetic database if not specified")
+    s.add_argument('--nmarkers', type=int, default=1000000, help="The number of markers of the synthetic database")
+    s.add_argument('--nsgbs', type=int, default=30000, help="The number of SGBs of the synthetic database")
+    s.add_argument('-p', '--processes', type=lambda x: [int(p) for p in x.split(',')], default='1,4,16',
+                   help="Comma separated numbers of concurrent processes")
+    s.set_defaults(func=benchmark_shared_database)
+
+    s = sp.add_parser('abundance', help="Time of the object and array engines of the clade abundances "
+                                        "(--abundance_engine), checking that they give the same profiles",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-d', '--database', type=str, default=None,
+                   help="A MetaPhlAn database pkl, a synthetic database if not specified")
+    s.add_argument('--nmarkers', type=int, default=300000, help="The number of markers of the synthetic database")
+    s.add_argument('--nsgbs', type=int, default=10000, help="The number of SGBs of the synthetic database")
+    s.add_argument('--mpa3', action='store_true', help="Build the tree for the MetaPhlAn 3 algorithm")
+    s.add_argument('-n', '--samples', type=int, default=2, help="The number of random samples")
+    s.add_argument('--present', type=float, default=0.05, help="The fraction of clades present in each sample")
+    s.add_argument('--stats', type=lambda x: x.split(','), default='avg_g,avg_l,tavg_g,tavg_l,wavg_g,wavg_l,med',
+                   help="Comma separated statistics (--stat)")
+    s.add_argument('--stat_q', type=float, default=0.2, help="The quantile of the robust averages")
+    s.set_defaults(func=benchmark_abundance)
+
+    s = sp.add_parser('addreads', help="Time of TaxTree.add_reads over all the markers, with the lineages of the "
+                                       "clades walked for each marker or cached in the tree",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-d', '--database', type=str, default=None,
+                   help="A MetaPhlAn database pkl, a synthetic database if not specified")
+    s.add_argument('--nmarkers', type=int, default=1000000, help="The number of markers of the synthetic database")
+    s.add_argument('--nsgbs', type=int, default=30000, help="The number of SGBs of the synthetic database")
+    s.add_argument('--mpa3', action='store_true', help="Build the tree for the MetaPhlAn 3 algorithm")
+    s.set_defaults(func=benchmark_add_reads)
+
+    s = sp.add_parser('mapsub', help="Time and memory of the subsampling of the mapped reads (--mapping_subsampling)",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-n', '--nhits', type=int, default=2000000, help="The number of mapped reads")
+    s.add_argument('--nreads', type=int, default=20000000, help="The number of reads of the metagenome")
+    s.add_argument('-s', '--subsampling', type=lambda x: [int(s) for s in x.split(',')], default='100000,1000000',
+                   help="Comma separated numbers of reads of the subsampled metagenome")
+    s.set_defaults(func=benchmark_mapping_subsampling)
+
+    s = sp.add_parser('readsub', help="Time of the subsampling of paired reads (--subsampling_paired)",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-n', '--nreads', type=int, default=1000000, help="The number of synthetic reads per mate")
+    s.add_argument('-l', '--min_len', type=int, default=70, help="The minimum read length")
+    s.add_argument('-s', '--subsampling', type=lambda x: [int(s) for s in x.split(',')], default='20000,200000',
+                   help="Comma separated numbers of reads to sample, counting both the mates")
+    s.set_defaults(func=benchmark_read_subsampling)
+
+    s = sp.add_parser('prefilter', help="Recall and speed of the minimizer prefilter of the reads (--prefilter)",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-n', '--nreads', type=int, default=200000, help="The number of synthetic reads")
+    s.add_argument('--on_target', type=float, default=0.05, help="The fraction of reads drawn from the markers")
+    s.add_argument('-d', '--divergence', type=lambda x: [float(d) for d in x.split(',')], default='0,0.02,0.05,0.1',
+                   help="Comma separated fractions of substituted bases of the reads drawn from the markers")
+    s.add_argument('--min_hits', type=lambda x: [int(m) for m in x.split(',')], default='1,2',
+                   help="Comma separated minimum numbers of minimizer hits of the kept reads")
+    s.add_argument('--nmarkers', type=int, default=5000, help="The number of synthetic markers")
+    s.add_argument('--marker_len', type=int, default=1000, help="The average length of the synthetic markers")
+    s.add_argument('-k', type=int, default=DEFAULT_K, help="The k-mer length")
+    s.add_argument('-w', type=int, default=DEFAULT_W, help="The number of consecutive k-mers of a minimizer window")
+    s.add_argument('--bits_per_minimizer', type=int, default=BITS_PER_MINIMIZER, help="The size of the bitset in bits per minimizer")
+    s.add_argument('-l', '--min_len', type=int, default=70, help="The minimum read length")
+    s.add_argument('--bowtie2', action='store_true',
+                   help="Also map the reads fed with and without the prefilter against the synthetic markers")
+    s.add_argument('--bowtie2_exe', type=str, default='bowtie2', help="The BowTie2 executable")
+    s.add_argument('--bowtie2_build_exe', type=str, default='bowtie2-build', help="The bowtie2-build executable")
+    s.add_argument('-p', '--nproc', type=int, default=4, help="The number of BowTie2 threads")
+    s.set_defaults(func=benchmark_prefilter)
+
+    s = sp.add_parser('fanout', help="Mapping throughput with the reads split across several BowTie2 processes (--bt2_shards)",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-x', '--bowtie2db', type=str, required=True, help="The BowTie2 index of the mapping")
+    s.add_argument('-i', '--input', type=str, default=None, help="The input FASTQ file, synthetic reads if not specified")
+    s.add_argument('-n', '--nreads', type=int, default=1000000, help="The number of synthetic reads")
+    s.add_argument('-l', '--min_len', type=int, default=70, help="The minimum read length")
+    s.add_argument('-c', '--cores', type=lambda x: [int(c) for c in x.split(',')], default='8,16,32,64',
+                   help="Comma separated numbers of cores given to the mapping")
+    s.add_argument('-s', '--shards', type=lambda x: [int(c) for c in x.split(',')], default='1,2,4,8',
+                   help="Comma separated numbers of BowTie2 processes splitting the cores")
+    s.add_argument('--bowtie2_exe', type=str, default='bowtie2', help="The BowTie2 executable")
+    s.set_defaults(func=benchmark_fanout)
+
+    s = sp.add_parser('batch', help="Wall time of a cohort profiled with metaphlan --batch against a loop of single runs",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('--bowtie2db', type=str, required=True, help="The folder of the MetaPhlAn database")
+    s.add_argument('-x', '--index', type=str, default=None, help="The MetaPhlAn database, the latest if not specified")
+    s.add_argument('-i', '--input', type=str, nargs='+', default=None,
+                   help="The input file of each sample, synthetic FASTQ samples if not specified")
+    s.add_argument('--input_type', type=str, default='fastq', choices=['fastq', 'fasta', 'bowtie2out'],
+                   help="The type of the input files")
+    s.add_argument('-s', '--nsamples', type=int, default=8, help="The number of synthetic samples")
+    s.add_argument('-n', '--nreads', type=int, default=100000, help="The number of synthetic reads per sample")
+    s.add_argument('-p', '--nproc', type=int, default=4, help="The number of CPUs of each run")
+    s.set_defaults(func=benchmark_batch)
+
+    s = sp.add_parser('outputs', help="Wall time of several analysis types (-t) written by a single run against "
+                                      "one run per type",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('--bowtie2db', type=str, required=True, help="The folder of the MetaPhlAn database")
+    s.add_argument('-x', '--index', type=str, required=True, help="The MetaPhlAn database")
+    s.add_argument('-i', '--input', type=str, default=None,
+                   help="The bowtie2out file of the sample, synthetic mapped reads if not specified")
+    s.add_argument('-n', '--nreads', type=int, default=200000, help="The number of synthetic mapped reads")
+    s.add_argument('--nmarkers', type=int, default=20000, help="The number of markers hit by the synthetic reads")
+    s.add_argument('-t', '--types', type=lambda x: x.split(','),
+                   default='rel_ab,rel_ab_w_read_stats,marker_ab_table,marker_pres_table,reads_map',
+                   help="Comma separated analysis types")
+    s.set_defaults(func=benchmark_outputs)
+
+    s = sp.add_parser('profiler', help="Time of Profiler.profile_sam with the SAM file given as a path and as "
+                                       "binary streams, checking that the profiles are the same",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('--bowtie2db', type=str, required=True, help="The folder of the MetaPhlAn database")
+    s.add_argument('-x', '--index', type=str, required=True, help="The MetaPhlAn database")
+    s.add_argument('-i', '--input', type=str, required=True, help="The SAM file of the sample, optionally compressed")
+    s.add_argument('-n', '--nreads', type=int, required=True, help="The number of reads of the metagenome")
+    s.set_defaults(func=benchmark_profiler)
+
+    s = sp.add_parser('samfilter', help="Throughput of the SAM filter of the mapping results",
+                      formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    s.add_argument('-n', '--nlines', type=int, default=1000000, help="The number of synthetic SAM lines")
+    s.add_argument('--min_mapq_val', type=int, default=5, help="Minimum mapping quality value")
+    s.add_argument('--min_alignment_len', type=int, default=None, help="Minimum alignment length")
+    s.set_defaults(func=benchmark_sam_filter)
+
+    return p.parse_args()
+
+
+def main():
+    args = read_params()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import json
+import struct
+import zlib
+from array import array
+
+import numpy as np
+
+try:
+    from .compression import compressed_open, detect_codec
+    from .threaded_io import QueuedWriter
+except ImportError:
+    from compression import compressed_open, detect_codec
+    from threaded_io import QueuedWriter
+
+
+# Binary bowtie2out layout (little endian):
+#   MAGIC
+#   one record per mapped read, in the order of the mapping:
+#       uint64 read ordinal (optional), (prefix_id << 48) | read index
+#       int32 marker ID, indexed on the order of the markers in the database pkl
+#           followed by the markers missing from the pkl (e.g. the viral markers) listed in the header
+#   the JSON header
+#   uint64 offset of the header, uint64 size of the header, MAGIC
+MAGIC = b'MPABT2\x00\x02'
+FOOTER = struct.Struct('<QQ8s')
+RECORD = np.dtype([('ordinal', '<u8'), ('marker', '<i4')])
+ORDINAL_SHIFT = 48
+
+
+def markers_checksum(markers):
+    """Returns the checksum of the order of the markers of a database"""
+    return zlib.crc32('\n'.join(markers).encode())
+
+
+def read_ordinal(read_id):
+    """Returns the ordinal of a read from the __{prefix_id}.{idx} suffix appended when feeding BowTie2
+
+    Args:
+        read_id (bytes): the read ID
+
+    Returns:
+        int: (prefix_id << 48) | idx, None if the read ID has no suffix
+    """
+    _, sep, suffix = read_id.rpartition(b'__')
+    prefix, _, idx = suffix.rpartition(b'.')
+    if not sep or not idx.isdigit() or not (prefix.isdigit() or not prefix):
+        return None
+    return (int(prefix or 0) << ORDINAL_SHIFT) | int(idx)
+
+
+def is_binary_bowtie2out(inpf):
+    """Whether a peekable binary stream is a binary bowtie2out file"""
+    return inpf.peek(len(MAGIC))[:len(MAGIC)] == MAGIC
+
+
+class BinaryBowtie2outWriter:
+    """Writes the mapped reads as a binary bowtie2out file
+
+    The records of the mapped reads are written as they are added, on a dedicated thread, while the
+    header is written on close, when the number of reads of the metagenome is known.
+
+    Args:
+        path (str): the output file, compressed according to its extension
+        markers (list[str]): the markers of the database, in the order of the database pkl
+        index (str): the name of the database
+        ordinals (bool): whether to store the read ordinals
+        codec (str): the compression codec, 'auto' to infer it from the extension
+        level (int): the compression level
+        marker_ids (dict): the IDs of the encoded markers, to share them between the writers of several samples
+    """
+
+    def __init__(self, path, markers, index, ordinals=False, codec='auto', level=None, marker_ids=None):
+        self.path = path
+        self.marker_ids = marker_ids if marker_ids is not None else {m.encode(): i for i, m in enumerate(markers)}
+        self.n_markers = len(markers)
+        self.checksum = markers_checksum(markers)
+        self.index = index
+        self.ordinals = ordinals
+        self.n_hits = 0
+        self.out = QueuedWriter(compressed_open(path, 'wb', codec, level), 'bowtie2out')
+        self.out.write(MAGIC)
+
+    def write_hits(self, reads, markers):
+        """Adds a batch of mapped reads
+
+        Args:
+            reads (list[bytes]): the read IDs
+            markers (list[bytes]): the marker hit by each read
+        """
+        for m in markers:
+            if m not in self.marker_ids:
+                self.marker_ids[m] = len(self.marker_ids)
+        ids = [self.marker_ids[m] for m in markers]
+        if self.ordinals:
+            ordinals = [read_ordinal(r) for r in reads]
+            records = np.empty(len(ids), dtype=RECORD)
+            records['ordinal'] = [o if o is not None else self.n_hits + i for i, o in enumerate(ordinals)]
+            records['marker'] = ids
+            self.out.write(records.tobytes())
+        else:
+            self.out.write(array('i', ids).tobytes())
+        self.n_hits += len(ids)
+
+    def close(self, nreads, avg_read_length):
+        """Writes the header and closes the file
+
+        Args:
+            nreads (int): the number of reads of the metagenome
+            avg_read_length (float): the average read length
+        """
+        extra_markers = [m.decode() for m, i in sorted(self.marker_ids.items(), key=lambda x: x[1])
+                         if i >= self.n_markers]
+        header = json.dumps({'nreads': int(nreads), 'avg_read_length': avg_read_length, 'index': self.index,
+                             'n_markers': self.n_markers, 'markers_checksum': self.checksum,
+                             'extra_markers': extra_markers, 'n_hits': self.n_hits,
+                             'ordinals': bool(self.ordinals)}).encode()
+        offset = len(MAGIC) + self.n_hits * (RECORD.itemsize if self.ordinals else 4)
+        self.out.write(header)
+        self.out.write(FOOTER.pack(offset, len(header), MAGIC))
+        self.out.close()
+
+    def abort(self):
+        """Closes the file without writing the header, when the mapping failed"""
+        try:
+            self.out.close()
+        except OSError:
+            pass
+
+
+def load_binary_bowtie2out(mapping_f, markers):
+    """Loads a binary bowtie2out file
+
+    Args:
+        mapping_f (str | file): the file path or an opened binary stream
+        markers (list[str]): the markers of the database, in the order of the database pkl
+
+    Returns:
+        (dict, numpy.ndarray, numpy.ndarray, list[str]): the header, the marker IDs, the read ordinals (None if
+            not stored) and the names of the marker IDs
+    """
+    if isinstance(mapping_f, str) and detect_codec(mapping_f) is None:
+        data = np.fromfile(mapping_f, dtype=np.uint8)
+    else:
+        with compressed_open(mapping_f, 'rb') as rf:
+            data = np.frombuffer(rf.read(), dtype=np.uint8)
+
+    offset, size, magic = FOOTER.unpack(data[-FOOTER.size:].tobytes())
+    if magic != MAGIC or data[:len(MAGIC)].tobytes() != MAGIC:
+        raise ValueError('Invalid binary bowtie2out file')
+    header = json.loads(data[offset:offset + size].tobytes())
+    if header['n_markers'] != len(markers) or header['markers_checksum'] != markers_checksum(markers):
+        raise ValueError('The binary bowtie2out file was generated with a different database ({})'.format(
+            header['index']))
+
+    n = header['n_hits']
+    start = len(MAGIC)
+    ordinals = None
+    if header['ordinals']:
+        records = data[start:start + RECORD.itemsize * n].view(RECORD)
+        ordinals, marker_ids = records['ordinal'].copy(), records['marker'].copy()
+        start += RECORD.itemsize * n
+    else:
+        marker_ids = data[start:start + 4 * n].view('<i4')
+    return header, marker_ids, ordinals, list(markers) + header['extra_markers']
@@ -0,0 +1,243 @@
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import bz2
+import gzip
+import importlib
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from .util_fun import error
+except ImportError:
+    from util_fun import error
+
+
+CODECS = ['bz2', 'gzip', 'zstd', 'lz4']
+EXTENSIONS = {'.bz2': 'bz2', '.gz': 'gzip', '.zst': 'zstd', '.lz4': 'lz4'}
+MAGIC = [(b'BZh', 'bz2'), (b'\x1f\x8b', 'gzip'), (b'\x28\xb5\x2f\xfd', 'zstd'), (b'\x04\x22\x4d\x18', 'lz4')]
+DEFAULT_LEVELS = {'bz2': 9, 'gzip': 6, 'zstd': 3, 'lz4': 0}
+MODULES = {'zstd': 'zstandard', 'lz4': 'lz4.frame'}
+# size of the independent blocks of the parallel writer, bz2 blocks are sized as the blocks of the level
+BLOCK_SIZE = 4 * 1024 * 1024
+# maximum input size of a BGZF block, such that the compressed block fits in 64 KB
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def codec_module(codec):
+    """Imports the python package implementing an optional codec
+
+    Args:
+        codec (str): the name of the codec
+
+    Returns:
+        module: the imported package, None if the codec is built in
+    """
+    if codec not in MODULES:
+        return None
+    try:
+        return importlib.import_module(MODULES[codec])
+    except ImportError:
+        error('The {} compression requires the "{}" python package'.format(codec, MODULES[codec].split('.')[0]),
+              exit=True)
+
+
+def available_codecs():
+    """Returns the codecs whose python packages are installed"""
+    available = []
+    for codec in CODECS:
+        if codec in MODULES:
+            try:
+                importlib.import_module(MODULES[codec])
+            except ImportError:
+                continue
+        available.append(codec)
+    return available
+
+
+def codec_from_extension(file_path):
+    """Returns the codec matching the extension of a file, None for uncompressed files"""
+    return EXTENSIONS.get(os.path.splitext(str(file_path))[1])
+
+
+def codec_from_magic(head):
+    """Returns the codec matching the first bytes of a stream, None for uncompressed data"""
+    for magic, codec in MAGIC:
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def detect_codec(file_obj):
+    """Detects the codec of a file or of a binary stream (e.g. sys.stdin.buffer) from its magic bytes
+
+    Args:
+        file_obj (str | file): the file path or the binary stream, peekable or seekable
+
+    Returns:
+        str: the name of the codec, None for uncompressed data
+    """
+    if hasattr(file_obj, 'peek'):
+        return codec_from_magic(file_obj.peek(4)[:4])
+    if hasattr(file_obj, 'read'):
+        if not file_obj.seekable():
+            raise ValueError('The codec of a stream that can be neither peeked nor seeked cannot be detected')
+        position = file_obj.tell()
+        head = file_obj.read(4)
+        file_obj.seek(position)
+        return codec_from_magic(head)
+    with open(file_obj, 'rb') as rf:
+        return codec_from_magic(rf.read(4))
+
+
+def bgzf_compress(data, level):
+    """Compresses some data as a sequence of BGZF blocks, the gzip members with their size in the header"""
+    blocks = []
+    for i in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[i:i + BGZF_BLOCK_SIZE]
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = c.compress(block) + c.flush()
+        blocks.append(struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2,
+                                  len(deflated) + 25))
+        blocks.append(deflated)
+        blocks.append(struct.pack('<II', zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+
+def block_compressor(codec, level):
+    """Returns the function compressing a block into an independently decodable unit of a codec
+
+    The concatenation of the units is a valid file: multi-stream bz2, BGZF, and multi-frame zstd and lz4.
+    """
+    if codec == 'bz2':
+        return lambda data: bz2.compress(data, level)
+    if codec == 'gzip':
+        return lambda data: bgzf_compress(data, level)
+    module = codec_module(codec)
+    if codec == 'zstd':  # the zstd compressors are not thread safe
+        return lambda data: module.ZstdCompressor(level=level).compress(data)
+    return lambda data: module.compress(data, compression_level=level)
+
+
+class ParallelCompressedWriter:
+    """Binary writer compressing independent blocks of the data on a pool of threads
+
+    The compressors release the GIL, so the blocks are compressed concurrently, while they are
+    written in the original order.
+
+    Args:
+        file_obj (str | file): the output file path or binary stream
+        codec (str): the codec
+        level (int): the compression level
+        nthreads (int): the number of compression threads
+    """
+
+    def __init__(self, file_obj, codec, level, nthreads):
+        self.out = open(file_obj, 'wb') if isinstance(file_obj, (str, os.PathLike)) else file_obj
+        self.codec = codec
+        self.compress = block_compressor(codec, level)
+        self.block_size = 100000 * level if codec == 'bz2' else BLOCK_SIZE
+        self.executor = ThreadPoolExecutor(nthreads)
+        self.max_pending = 2 * nthreads
+        self.pending = deque()
+        self.buf = []
+        self.buf_size = 0
+
+    def write(self, data):
+        n = len(data)
+        self.buf.append(data)
+        self.buf_size += n
+        if self.buf_size >= self.block_size:
+            data = b''.join(self.buf)
+            for i in range(0, len(data) - self.block_size + 1, self.block_size):
+                self.submit(data[i:i + self.block_size])
+            rest = data[len(data) - len(data) % self.block_size:]
+            self.buf, self.buf_size = [rest], len(rest)
+        return n
+
+    def submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        while len(self.pending) > self.max_pending:
+            self.out.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            if self.buf_size:
+                self.submit(b''.join(self.buf))
+            while self.pending:
+                self.out.write(self.pending.popleft().result())
+            if self.codec == 'gzip':
+                self.out.write(BGZF_EOF)
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compressed_open(file_obj, mode='rb', codec='auto', level=None, nthreads=1):
+    """Opens a file with any of the supported codecs
+
+    Args:
+        file_obj (str | file): the file path or an already opened binary stream, wrapped in an io.BufferedReader
+            when reading from a stream that cannot be peeked
+        mode (str): the opening mode, binary ('rb', 'wb') or text ('rt', 'wt')
+        codec (str): the codec, 'auto' to detect it from the magic bytes when reading and from
+            the extension when writing, None for uncompressed files
+        level (int): the compression level, None for the default level of the codec
+        nthreads (int): the number of compression threads when writing in binary mode, more than one
+            thread writes independently compressed blocks (gzip files are written in BGZF format)
+
+    Returns:
+        file: the opened file
+    """
+    if mode in ('r', 'w'):
+        mode += 'b'
+    reading = mode.startswith('r')
+    if reading and not isinstance(file_obj, (str, os.PathLike)) and not hasattr(file_obj, 'peek'):
+        # the magic bytes are peeked (e.g. io.BytesIO, raw sockets and pipes)
+        file_obj = io.BufferedReader(file_obj)
+    if codec == 'auto':
+        if reading:
+            codec = detect_codec(file_obj)
+        elif isinstance(file_obj, (str, os.PathLike)):
+            codec = codec_from_extension(file_obj)
+        else:
+            codec = None
+    if codec is not None and codec not in CODECS:
+        error('Unknown compression "{}", choose among {}'.format(codec, ', '.join(CODECS)), exit=True)
+    if level is None and codec is not None:
+        level = DEFAULT_LEVELS[codec]
+    module = codec_module(codec)
+
+    if codec is not None and mode == 'wb' and nthreads > 1:
+        return ParallelCompressedWriter(file_obj, codec, level, nthreads)
+    if codec is None:
+        if isinstance(file_obj, (str, os.PathLike)):
+            return open(file_obj, mode)
+        return file_obj if mode.endswith('b') else io.TextIOWrapper(file_obj)
+    if codec == 'bz2':
+        return bz2.open(file_obj, mode) if reading else bz2.open(file_obj, mode, compresslevel=level)
+    if codec == 'gzip':
+        return gzip.open(file_obj, mode) if reading else gzip.open(file_obj, mode, compresslevel=level)
+    if codec == 'zstd':
+        if mode == 'rb':  # the zstandard reader does not support the line iteration
+            return io.BufferedReader(module.open(file_obj, mode), 1024 * 1024)
+        if reading:
+            return module.open(file_obj, mode)
+        return module.open(file_obj, mode, cctx=module.ZstdCompressor(level=level))
+    if reading:
+        return module.open(file_obj, mode)
+    return module.open(file_obj, mode, compression_level=level)
@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import argparse as ap
+import atexit
+import bz2
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sys
+import time
+from collections.abc import ItemsView, Mapping, ValuesView
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    from .util_fun import info, error
+except ImportError:
+    from util_fun import info, error
+
+
+CACHE_VERSION = 2
+META_FILE = 'meta.json'
+DATABASE_KEYS = ['taxonomy', 'markers', 'merged_taxon']
+MARKER_FIELDS = ['clade', 'len', 'ext', 'taxon', 'score']
+HASH_CHUNK = 16 * 1024 * 1024
+# the folder of the databases shared in memory by the concurrent runs (--shm_db or METAPHLAN_SHM_DB=1)
+SHM_DIR = os.environ.get('METAPHLAN_SHM_DIR', '/dev/shm')
+SHM_ENV = 'METAPHLAN_SHM_DB'
+REFS_FILE = 'refs.lock'
+_attached = {}  # the shared databases attached by this process, with their reference lock
+
+
+def cache_path(mpa_pkl):
+    """Returns the folder of the columnar cache of a database, next to its pkl
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+
+    Returns:
+        str: the path to the cache folder
+    """
+    return os.path.splitext(mpa_pkl)[0] + '.cache'
+
+
+def pkl_checksum(mpa_pkl):
+    """Computes the SHA-256 checksum of the pkl of a database
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+
+    Returns:
+        str: the hexadecimal checksum
+    """
+    h = hashlib.sha256()
+    with open(mpa_pkl, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def encode_strings(strings):
+    """Packs strings in a newline-terminated UTF-8 blob and the offsets of their starts
+
+    Args:
+        strings (list): the strings, without newlines
+
+    Returns:
+        tuple: the blob (uint8 array) and the n + 1 offsets (int64 array)
+    """
+    encoded = [s.encode() for s in strings]
+    if any(b'\n' in s for s in encoded):
+        raise ValueError('The strings of the database cannot contain newlines')
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) + 1 for s in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(s + b'\n' for s in encoded), dtype=np.uint8), offsets
+
+
+class StringColumn:
+    """The strings of a column of the cache, decoded on access"""
+
+    def __init__(self, blob, offsets):
+        self.blob, self.offsets = blob, offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1] - 1].tobytes().decode()
+
+    def tolist(self):
+        """Decodes all the strings"""
+        return self.blob.tobytes().decode().split('\n')[:-1] if len(self) else []
+
+
+class _SequentialItems(ItemsView):
+    def __iter__(self):
+        return self._mapping.iter_items()
+
+
+class _SequentialValues(ValuesView):
+    def __iter__(self):
+        return (v for _, v in self._mapping.iter_items())
+
+
+class _ColumnarTable(Mapping):
+    """A read-only mapping over the columns of the cache, indexed by its first string column on first lookup"""
+
+    def __init__(self, keys):
+        self.keys_column = keys
+        self._index = None
+
+    def _position(self, key):
+        if self._index is None:
+            self._index = {k: i for i, k in enumerate(self.keys_column.tolist())}
+        return self._index[key]
+
+    def __getitem__(self, key):
+        return self.record(self._position(key))
+
+    def __contains__(self, key):
+        try:
+            self._position(key)
+        except (KeyError, TypeError):
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.keys_column.tolist())
+
+    def __len__(self):
+        return len(self.keys_column)
+
+    def items(self):
+        return _SequentialItems(self)
+
+    def values(self):
+        return _SequentialValues(self)
+
+
+class MarkerTable(_ColumnarTable):
+    """The markers of the database as a mapping of the marker names to their clade, len, ext, taxon and score"""
+
+    def __init__(self, columns):
+        super().__init__(columns['marker_names'])
+        self.clade_ids, self.clades = columns['clade_ids'], columns['clades']
+        self.lens = columns['lens']
+        self.ext_offsets, self.ext_ids, self.exts = columns['ext_offsets'], columns['ext_ids'], columns['exts']
+        self.taxon_ids, self.taxa = columns['taxon_ids'], columns['taxa']
+        self.scores, self.int_scores = columns['scores'], columns['int_scores']
+
+    def record(self, i):
+        return {'clade': self.clades[self.clade_ids[i]],
+                'len': self.lens[i].item(),
+                'ext': [self.exts[j] for j in self.ext_ids[self.ext_offsets[i]:self.ext_offsets[i + 1]]],
+                'taxon': self.taxa[self.taxon_ids[i]],
+                'score': int(self.scores[i]) if self.int_scores[i] else self.scores[i].item()}
+
+    def iter_items(self):
+        clades, taxa = self.clades.tolist(), self.taxa.tolist()
+        exts = self.exts.tolist()
+        exts = [exts[j] for j in self.ext_ids.tolist()]
+        ext_offsets = self.ext_offsets.tolist()
+        for i, (name, clade_id, length, taxon_id, score, int_score) in enumerate(zip(
+                self.keys_column.tolist(), self.clade_ids.tolist(), self.lens.tolist(), self.taxon_ids.tolist(),
+                self.scores.tolist(), self.int_scores.tolist())):
+            yield name, {'clade': clades[clade_id],
+                         'len': length,
+                         'ext': exts[ext_offsets[i]:ext_offsets[i + 1]],
+                         'taxon': taxa[taxon_id],
+                         'score': int(score) if int_score else score}
+
+
+class TaxonomyTable(_ColumnarTable):
+    """The taxonomy of the database as a mapping of the clades to their taxids and genome length"""
+
+    def __init__(self, columns):
+        super().__init__(columns['clade_names'])
+        self.taxids, self.has_taxids, self.glens = columns['taxids'], columns['has_taxids'], columns['glens']
+
+    def record(self, i):
+        return (self.taxids[i], self.glens[i].item()) if self.has_taxids[i] else self.glens[i].item()
+
+    def iter_items(self):
+        for clade, taxids, has_taxids, glen in zip(self.keys_column.tolist(), self.taxids.tolist(),
+                                                   self.has_taxids.tolist(), self.glens.tolist()):
+            yield clade, ((taxids, glen) if has_taxids else glen)
+
+
+class ColumnarDatabase(Mapping):
+    """A MetaPhlAn database read from its columnar cache, with the same keys as the pkl
+
+    The columns are memory-mapped when the markers or the taxonomy are first accessed, and the records are built
+    on access, so the database is shared through the page cache by all the runs using it.
+    """
+
+    def __init__(self, path, meta):
+        self.path, self.meta = path, meta
+        self._tables = {}
+
+    def _column(self, name):
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def _strings(self, name):
+        return StringColumn(self._column(name + '.blob'), self._column(name + '.offsets'))
+
+    def __getitem__(self, key):
+        if key not in self._tables:
+            if key == 'markers':
+                columns = {n: self._strings(n) for n in ['marker_names', 'clades', 'exts', 'taxa']}
+                columns.update({n: self._column(n) for n in ['clade_ids', 'lens', 'ext_offsets', 'ext_ids',
+                                                             'taxon_ids', 'scores', 'int_scores']})
+                self._tables[key] = MarkerTable(columns)
+            elif key == 'taxonomy':
+                columns = {n: self._strings(n) for n in ['clade_names', 'taxids']}
+                columns.update({n: self._column(n) for n in ['has_taxids', 'glens']})
+                self._tables[key] = TaxonomyTable(columns)
+            elif key == 'merged_taxon' and key in self.meta['keys']:
+                self._tables[key] = {(clade, taxid): [tuple(m) for m in merged]
+                                     for clade, taxid, merged in self.meta['merged_taxon']}
+            else:
+                raise KeyError(key)
+        return self._tables[key]
+
+    def __iter__(self):
+        return iter(self.meta['keys'])
+
+    def __len__(self):
+        return len(self.meta['keys'])
+
+
+def write_column(path, name, array):
+    np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array))
+
+
+def write_strings(path, name, strings):
+    blob, offsets = encode_strings(strings)
+    write_column(path, name + '.blob', blob)
+    write_column(path, name + '.offsets', offsets)
+
+
+def build_cache(mpa_pkl, output=None, db=None):
+    """Converts the pkl of a database to its columnar cache
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+        output (str): the cache folder, next to the pkl if not specified
+        db (dict): the already loaded pkl, loaded from mpa_pkl if not specified
+
+    Returns:
+        str: the path to the cache folder
+
+    Raises:
+        ValueError: if the database has fields that the cache cannot store
+    """
+    output = output if output else cache_path(mpa_pkl)
+    if db is None:
+        with bz2.BZ2File(mpa_pkl, 'r') as a:
+            db = pickle.load(a)
+    if not set(db).issubset(DATABASE_KEYS) or 'markers' not in db or 'taxonomy' not in db:
+        raise ValueError('Unsupported database keys: {}'.format(', '.join(map(str, db))))
+    markers = db['markers']
+    if any(sorted(m) != sorted(MARKER_FIELDS) for m in markers.values()):
+        raise ValueError('Unsupported marker fields, the cache stores: {}'.format(', '.join(MARKER_FIELDS)))
+
+    tmp = '{}.tmp{}'.format(output, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    try:
+        clade_ids, ext_ids, taxon_ids = {}, {}, {}
+        write_strings(tmp, 'marker_names', list(markers))
+        write_column(tmp, 'clade_ids', np.array([clade_ids.setdefault(m['clade'], len(clade_ids))
+                                                 for m in markers.values()], dtype=np.int32))
+        write_strings(tmp, 'clades', list(clade_ids))
+        write_column(tmp, 'lens', np.array([m['len'] for m in markers.values()], dtype=np.int64))
+        write_column(tmp, 'ext_offsets', np.concatenate([[0], np.cumsum([len(m['ext']) for m in markers.values()],
+                                                                        dtype=np.int64)]).astype(np.int64))
+        write_column(tmp, 'ext_ids', np.array([ext_ids.setdefault(e, len(ext_ids)) for m in markers.values()
+                                               for e in m['ext']], dtype=np.int32))
+        write_strings(tmp, 'exts', list(ext_ids))
+        write_column(tmp, 'taxon_ids', np.array([taxon_ids.setdefault(m['taxon'], len(taxon_ids))
+                                                 for m in markers.values()], dtype=np.int32))
+        write_strings(tmp, 'taxa', list(taxon_ids))
+        scores = np.array([m['score'] for m in markers.values()])
+        if scores.dtype.kind not in 'iuf':
+            raise ValueError('Unsupported marker scores of type {}'.format(scores.dtype))
+        # the scores are stored as floats when the pkl mixes int and float scores, the int ones are flagged to be
+        # returned as int as in the pkl
+        int_scores = np.array([isinstance(m['score'], (int, np.integer)) for m in markers.values()], dtype=bool)
+        write_column(tmp, 'scores', scores)
+        write_column(tmp, 'int_scores', int_scores)
+
+        taxonomy = db['taxonomy']
+        write_strings(tmp, 'clade_names', list(taxonomy))
+        write_strings(tmp, 'taxids', [v[0] if isinstance(v, tuple) else '' for v in taxonomy.values()])
+        write_column(tmp, 'has_taxids', np.array([isinstance(v, tuple) for v in taxonomy.values()], dtype=bool))
+        write_column(tmp, 'glens', np.array([v[1] if isinstance(v, tuple) else v for v in taxonomy.values()],
+                                            dtype=np.int64))
+
+        stat = os.stat(mpa_pkl)
+        meta = {'version': CACHE_VERSION,
+                'pkl_size': stat.st_size,
+                'pkl_mtime_ns': stat.st_mtime_ns,
+                'pkl_sha256': pkl_checksum(mpa_pkl),
+                'keys': list(db),
+                'merged_taxon': [[clade, taxid, merged] for (clade, taxid), merged in
+                                 db.get('merged_taxon', {}).items()]}
+        with open(os.path.join(tmp, META_FILE), 'w') as wf:
+            try:
+                json.dump(meta, wf)
+            except TypeError as e:
+                raise ValueError('Unsupported merged taxa: {}'.format(e))
+        shutil.rmtree(output, ignore_errors=True)
+        os.rename(tmp, output)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return output
+
+
+def read_cache_meta(mpa_pkl, path=None):
+    """Reads the metadata of the columnar cache of a database, checking that it matches the pkl
+
+    The checksum of the pkl is computed only when its size or modification time changed since the cache was built.
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+        path (str): the cache folder, next to the pkl if not specified
+
+    Returns:
+        dict: the metadata of the cache, None if there is no cache or it is outdated
+    """
+    path = path if path else cache_path(mpa_pkl)
+    try:
+        with open(os.path.join(path, META_FILE)) as rf:
+            meta = json.load(rf)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(mpa_pkl)
+    if meta.get('version') != CACHE_VERSION or meta.get('pkl_size') != stat.st_size:
+        return None
+    if meta.get('pkl_mtime_ns') != stat.st_mtime_ns and meta.get('pkl_sha256') != pkl_checksum(mpa_pkl):
+        return None
+    return meta
+
+
+def load_database(mpa_pkl, shared=None):
+    """Loads a MetaPhlAn database from its columnar cache if up to date, or from its pkl
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+        shared (bool): whether to attach the database shared in memory by the concurrent runs, by default when the
+            METAPHLAN_SHM_DB environment variable is set to 1
+
+    Returns:
+        Mapping: the database, with the taxonomy, markers and merged_taxon keys
+    """
+    if shared is None:
+        shared = os.environ.get(SHM_ENV) == '1'
+    if shared:
+        db = attach_shared_cache(mpa_pkl)
+        if db is not None:
+            return db
+    path = cache_path(mpa_pkl)
+    if os.path.isdir(path):
+        meta = read_cache_meta(mpa_pkl, path)
+        if meta is not None:
+            return ColumnarDatabase(path, meta)
+        sys.stderr.write('WARNING: The database cache {} does not match {}, loading the pkl. Rebuild it with '
+                         'database_cache.py -d {}\n'.format(path, mpa_pkl, mpa_pkl))
+    with bz2.BZ2File(mpa_pkl, 'r') as a:
+        return pickle.load(a)
+
+
+def shared_cache_path(mpa_pkl):
+    """Returns the folder of the database shared in memory, named after the pkl, its size and modification time
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+
+    Returns:
+        str: the path to the shared folder
+    """
+    stat = os.stat(mpa_pkl)
+    key = hashlib.sha256('{}\t{}\t{}\t{}'.format(os.path.realpath(mpa_pkl), stat.st_size, stat.st_mtime_ns,
+                                                 CACHE_VERSION).encode()).hexdigest()[:16]
+    return os.path.join(SHM_DIR, 'metaphlan-{}-{}-{}'.format(os.getuid(), os.path.basename(cache_path(mpa_pkl)), key))
+
+
+def publish_shared_cache(mpa_pkl, path):
+    """Writes the columns of a database to the shared folder, copying its cache when up to date
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+        path (str): the shared folder
+    """
+    if read_cache_meta(mpa_pkl) is not None:
+        tmp = '{}.tmp{}'.format(path, os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            shutil.copytree(cache_path(mpa_pkl), tmp)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(tmp, path)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+    else:
+        build_cache(mpa_pkl, path)
+
+
+@contextmanager
+def shared_cache_mutex(path):
+    """Holds the lock file serializing the publication, the attachment and the teardown of a shared folder
+
+    The lock file is removed by the last run detaching, so the lock is retried when the file locked is no longer
+    the one at its path.
+
+    Args:
+        path (str): the shared folder
+    """
+    while True:
+        mutex = open(path + '.lock', 'a')
+        fcntl.flock(mutex, fcntl.LOCK_EX)
+        try:
+            current = os.stat(path + '.lock')
+        except FileNotFoundError:
+            current = None
+        locked = os.fstat(mutex.fileno())
+        if current is not None and (current.st_dev, current.st_ino) == (locked.st_dev, locked.st_ino):
+            break
+        mutex.close()
+    try:
+        yield mutex
+    finally:
+        mutex.close()
+
+
+def attach_shared_cache(mpa_pkl):
+    """Attaches the database shared in memory by the concurrent runs, publishing it if this is the first run
+
+    The runs attached hold a shared lock on the references file of the folder until they exit. The publication,
+    the attachment and the teardown are serialized by a lock file next to the folder, the last run to detach
+    removes the folder and the lock file. A run that crashes releases its reference, the folder is removed by the
+    next run detaching. Only the columns are shared, the objects built from them (e.g. the TaxTree) are private to
+    each run.
+
+    Args:
+        mpa_pkl (str): the path to the pkl of the database
+
+    Returns:
+        ColumnarDatabase: the shared database, None if it cannot be shared
+    """
+    if not os.path.isdir(SHM_DIR):
+        sys.stderr.write('WARNING: The folder {} of the shared databases does not exist, '
+                         'loading the database in this process\n'.format(SHM_DIR))
+        return None
+    path = shared_cache_path(mpa_pkl)
+    if path not in _attached:
+        with shared_cache_mutex(path):
+            try:
+                meta = read_cache_meta(mpa_pkl, path)
+                if meta is None:
+                    publish_shared_cache(mpa_pkl, path)
+                    meta = read_cache_meta(mpa_pkl, path)
+                refs = open(os.path.join(path, REFS_FILE), 'a')
+                fcntl.flock(refs, fcntl.LOCK_SH)
+            except ValueError as e:
+                sys.stderr.write('WARNING: The database cannot be shared ({}), loading it in this process\n'.format(e))
+                return None
+        if not _attached:
+            atexit.register(detach_shared_caches, os.getpid())
+        _attached[path] = (refs, meta)
+    return ColumnarDatabase(path, _attached[path][1])
+
+
+def detach_shared_caches(pid=None):
+    """Releases the references of this process to the shared databases, removing the ones no longer attached
+
+    Args:
+        pid (int): the process that attached the databases, the forked children do not release their references
+    """
+    if pid is not None and pid != os.getpid():
+        return
+    for path, (refs, _) in list(_attached.items()):
+        with shared_cache_mutex(path):
+            try:
+                fcntl.flock(refs, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                shutil.rmtree(path, ignore_errors=True)
+                os.remove(path + '.lock')
+            except BlockingIOError:
+                pass  # still attached by other runs
+            finally:
+                refs.close()
+        del _attached[path]
+
+
+def read_params():
+    """ Reads and parses the command line arguments of the script
+
+    Returns:
+        namespace: The populated namespace with the command line arguments
+    """
+    p = ap.ArgumentParser(description="Converts a MetaPhlAn database pkl to the columnar cache loaded instead of it",
+                          formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-d', '--database', type=str, default=None,
+                   help="The MetaPhlAn database pkl, the cache is written next to it")
+    p.add_argument('--check', action='store_true', help="Only check whether the cache is up to date")
+    return p.parse_args()
+
+
+def check_params(args):
+    """Checks the mandatory command line arguments of the script
+
+    Args:
+        args (namespace): the arguments to check
+    """
+    if not args.database:
+        error('-d (or --database) must be specified', exit=True)
+    if not os.path.exists(args.database):
+        error('The file {} does not exist'.format(args.database), exit=True)
+
+
+def main():
+    t0 = time.time()
+    args = read_params()
+    check_params(args)
+    if args.check:
+        if read_cache_meta(args.database) is None:
+            error('The cache {} is missing or outdated'.format(cache_path(args.database)), exit=True)
+        info('The cache {} is up to date'.format(cache_path(args.database)))
+        return
+    try:
+        path = build_cache(args.database)
+    except ValueError as e:
+        error(str(e), exit=True)
+    info('Cache written to {}'.format(path))
+    info('Done in {:.2f} s'.format(time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,6 @@ __date__ = '11 Mar 2024'
 
 
 import os
-import pickle
 import bz2
 
 import pandas as pd
@@ -23,9 +22,13 @@ class MetaphlanDatabaseController:
     def load_database(self, verbose=True):
         """Loads the MetaPhlAn PKL database"""
         if self.database_pkl is None:
+            try:
+                from .database_cache import load_database
+            except ImportError:
+                from database_cache import load_database
             if verbose:
                 info('Loading MetaPhlAn {} database...'.format(self.get_database_name()))
-            self.database_pkl = pickle.load(bz2.BZ2File(self.database))
+            self.database_pkl = load_database(self.database)
             if verbose:
                 info('Done.')
 
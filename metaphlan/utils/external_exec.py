@@ -15,8 +15,10 @@ import tempfile
 import subprocess as sb
 try:
     from .util_fun import info, error
+    from .compression import compressed_open
 except ImportError:
     from util_fun import info, error
+    from compression import compressed_open
 
 
 def execute(cmd):
@@ -97,16 +99,11 @@ def compress_bz2(input_file):
     
 
 def decompress_bz2(input_file, output_dir):
-    """Decompresses BZ2 files"""
+    """Decompresses BZ2 files, or files compressed with any of the codecs detected by compressed_open"""
     n, _ = os.path.splitext(os.path.basename(input_file))
-    params = {
-        "program_name": "bzip2",
-        "input": "-cdk",
-        "command_line": "#program_name# #input# > #output#"
-    }
     decompressed_file = os.path.join(output_dir, n)
-    execute(compose_command(params, input_file=input_file,
-            output_file=decompressed_file))
+    with compressed_open(input_file, 'rb') as rf, open(decompressed_file, 'wb') as wf:
+        shutil.copyfileobj(rf, wf, 1024 * 1024)
     if decompressed_file.endswith('_sam'):
         os.rename(decompressed_file, decompressed_file[:-4] + '.sam')
         decompressed_file = decompressed_file[:-4] + '.sam'
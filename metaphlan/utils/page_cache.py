@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+from glob import glob
+
+try:
+    from .database_cache import cache_path, shared_cache_path
+except ImportError:
+    from database_cache import cache_path, shared_cache_path
+
+
+# size of the reads used to fault the files into the page cache
+READ_CHUNK = 16 * 1024 * 1024
+PROT_READ = 0x1
+MAP_SHARED = 0x1
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.mmap.restype = ctypes.c_void_p
+    _libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    _libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    _libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+except (OSError, AttributeError):
+    _libc = None
+
+
+def database_files(bowtie2db, mpa_pkl):
+    """Lists the files of a MetaPhlAn database loaded by each run
+
+    Args:
+        bowtie2db (str): the prefix of the BowTie2 index
+        mpa_pkl (str): the path to the pkl of the database
+
+    Returns:
+        list: the paths to the BowTie2 index files, the pkl, the prefilter, the columnar cache and the copy
+            shared in memory (--shm_db) of the database, the last three if they exist
+    """
+    files = sorted(glob('{}.*.bt2'.format(bowtie2db)) + glob('{}.*.bt2l'.format(bowtie2db)))
+    files.append(mpa_pkl)
+    if os.path.isfile(bowtie2db + '.prefilter'):
+        files.append(bowtie2db + '.prefilter')
+    folders = [cache_path(mpa_pkl)] + ([shared_cache_path(mpa_pkl)] if os.path.isfile(mpa_pkl) else [])
+    for folder in folders:
+        if os.path.isdir(folder):
+            files += sorted(f for f in glob(os.path.join(folder, '*')) if os.path.isfile(f))
+    return files
+
+
+def resident_pages(path):
+    """Counts the pages of a file in the page cache with mincore(2)
+
+    Args:
+        path (str): the path to the file
+
+    Returns:
+        tuple: the number of resident pages and the number of pages of the file, the resident pages are None
+            when mincore is not available
+    """
+    size = os.path.getsize(path)
+    npages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    if _libc is None or size == 0:
+        return (None if size else 0), npages
+    with open(path, 'rb') as f:
+        addr = _libc.mmap(None, size, PROT_READ, MAP_SHARED, f.fileno(), 0)
+    if addr in (None, MAP_FAILED):
+        return None, npages
+    try:
+        vec = (ctypes.c_ubyte * npages)()
+        if _libc.mincore(addr, size, vec) != 0:
+            return None, npages
+        return sum(v & 1 for v in vec), npages
+    finally:
+        _libc.munmap(addr, size)
+
+
+def warm_file(path):
+    """Faults a file into the page cache, asking the kernel to read ahead and reading it sequentially
+
+    Args:
+        path (str): the path to the file
+
+    Returns:
+        int: the number of bytes read
+    """
+    nbytes = 0
+    buf = bytearray(READ_CHUNK)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            nbytes += n
+    return nbytes
+
+
+def format_residency(resident, npages):
+    """Formats the page cache residency of a file
+
+    Args:
+        resident (int): the number of resident pages, None if unknown
+        npages (int): the number of pages of the file
+
+    Returns:
+        str: the resident size and percentage
+    """
+    if resident is None:
+        return 'unknown residency'
+    return '{:.1f} MB resident ({:.1f}%)'.format(resident * mmap.PAGESIZE / 2 ** 20,
+                                                 100 * resident / npages if npages else 100)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import argparse as ap
+import os
+import struct
+import time
+
+import numpy as np
+
+try:
+    from .util_fun import info, error
+    from .external_exec import generate_markers_fasta
+    from .read_fastx import fasta_chunks, fopen
+    from .subsampling import splitmix64_array
+except ImportError:
+    from util_fun import info, error
+    from external_exec import generate_markers_fasta
+    from read_fastx import fasta_chunks, fopen
+    from subsampling import splitmix64_array
+
+
+# Prefilter layout (little endian): the HEADER padded to HEADER_SIZE bytes followed by the uint64 words of a bitset
+# of 2 ** log2_bits bits, where the bit of a minimizer is the low bits of the SplitMix64 mix of its hash
+MAGIC = b'MPAPF\x00\x00\x01'
+HEADER = struct.Struct('<8sIIIIQQQ')  # magic, k, w, log2_bits, reserved, sequences, minimizers, set bits
+HEADER_SIZE = 64
+INVALID = 4  # the code of the non-ACGT bases
+BASE_CODES = np.full(256, INVALID, dtype=np.uint8)
+for code, bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    BASE_CODES[list(bases)] = code
+NO_MINIMIZER = np.uint64((1 << 64) - 1)  # the hash of the k-mers with non-ACGT bases, never a minimizer
+# maximum number of bases (including the padding) of the sequences processed at once
+BATCH_CELLS = 1 << 19
+DEFAULT_K = 19
+DEFAULT_W = 16
+# bits of the bitset per minimizer of the markers, the fraction of set bits is about 1 / BITS_PER_MINIMIZER
+BITS_PER_MINIMIZER = 32
+# with 1 hit about 40% of the unrelated reads still pass through the false positives of the bitset
+DEFAULT_MIN_HITS = 2
+
+
+def prefilter_path(bowtie2db):
+    """Returns the path of the prefilter of a database, next to its pkl and BowTie2 index"""
+    return bowtie2db + '.prefilter'
+
+
+def pack_sequences(seqs):
+    """Returns the 2-bit codes of a list of sequences, padded to the longest one with INVALID
+
+    Args:
+        seqs (list[bytes]): the sequences
+
+    Returns:
+        numpy.ndarray: a (sequences, length) uint8 array
+    """
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    codes = np.full((len(seqs), int(lengths.max())), INVALID, dtype=np.uint8)
+    codes[np.arange(codes.shape[1]) < lengths[:, None]] = BASE_CODES[np.frombuffer(b''.join(seqs), dtype=np.uint8)]
+    return codes
+
+
+def kmer_hashes(codes, k):
+    """Returns the hashes of the canonical k-mers of each row, NO_MINIMIZER for the k-mers with non-ACGT bases
+
+    The k-mer codes of both strands are built by doubling the length of the packed substrings,
+    so that only O(log k) array operations are needed.
+
+    Args:
+        codes (numpy.ndarray): the 2-bit codes of the sequences, as returned by pack_sequences()
+        k (int): the k-mer length, at most 32
+
+    Returns:
+        numpy.ndarray: a (sequences, length - k + 1) uint64 array
+    """
+    n, length = codes.shape
+    width = length - k + 1
+    invalid = np.zeros((n, length + 1), dtype=np.int32)
+    np.cumsum(codes == INVALID, axis=1, out=invalid[:, 1:])
+    forward = np.where(codes == INVALID, 0, codes).astype(np.uint64)
+    reverse = np.uint64(3) - forward  # the complement, its k-mers are read backwards
+    fw, rc, done = None, None, 0
+    span = 1
+    while True:
+        if k & span:  # append the substrings of this length after the ones already combined
+            f, r = forward[:, done:done + width], reverse[:, done:done + width]
+            if fw is None:
+                fw, rc = f, r
+            else:
+                fw = (fw << np.uint64(2 * span)) | f
+                rc = rc | (r << np.uint64(2 * done))
+            done += span
+        if span * 2 > k:
+            break
+        forward = (forward[:, :-span] << np.uint64(2 * span)) | forward[:, span:]
+        reverse = reverse[:, :-span] | (reverse[:, span:] << np.uint64(2 * span))
+        span *= 2
+    hashes = splitmix64_array(np.minimum(fw, rc))
+    hashes[invalid[:, k:] - invalid[:, :width] > 0] = NO_MINIMIZER
+    return hashes
+
+
+def window_minima(hashes, w):
+    """Returns the minimum hash of each window of w consecutive k-mers, computed by doubling the window length"""
+    minima, span = hashes, 1
+    while span * 2 <= w:
+        minima = np.minimum(minima[:, :-span], minima[:, span:])
+        span *= 2
+    return np.minimum(minima[:, :hashes.shape[1] - w + 1], minima[:, w - span:])
+
+
+def length_batches(lengths, max_cells=BATCH_CELLS):
+    """Yields the indexes of groups of sequences of similar length whose padded arrays have at most max_cells bases"""
+    order = np.argsort(lengths, kind='stable')
+    sorted_lengths = lengths[order]
+    start = 0
+    while start < len(order):
+        end = min(len(order), start + max(1, max_cells // max(1, int(sorted_lengths[start]))))
+        while end - start > 1 and (end - start) * int(sorted_lengths[end - 1]) > max_cells:
+            end = start + max(1, max_cells // int(sorted_lengths[end - 1]))
+        yield order[start:end]
+        start = end
+
+
+def minimizers(seqs, k, w):
+    """Returns the distinct consecutive minimizers of a group of sequences
+
+    Args:
+        seqs (list[bytes]): the sequences, at least k + w - 1 bases long
+        k (int): the k-mer length
+        w (int): the number of k-mers of a window
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray): the index of the sequence of each minimizer and the minimizer hashes
+    """
+    minima = window_minima(kmer_hashes(pack_sequences(seqs), k), w)
+    new = np.ones(minima.shape, dtype=bool)
+    new[:, 1:] = minima[:, 1:] != minima[:, :-1]
+    rows, cols = np.nonzero(new & (minima != NO_MINIMIZER))
+    return rows, minima[rows, cols]
+
+
+def minimizer_bits(minima, log2_bits):
+    """Returns the positions in the bitset of a set of minimizers"""
+    return splitmix64_array(minima) & np.uint64((1 << log2_bits) - 1)
+
+
+def build_prefilter(fasta, output, k=DEFAULT_K, w=DEFAULT_W, bits_per_minimizer=BITS_PER_MINIMIZER):
+    """Builds the prefilter of the minimizers of the marker sequences
+
+    The size of the bitset is the power of two closest to bits_per_minimizer times the minimizers
+    expected from the size of the FASTA file.
+
+    Args:
+        fasta (str): the FASTA file of the markers, optionally compressed
+        output (str): the prefilter file
+        k (int): the k-mer length, at most 32
+        w (int): the number of k-mers of a window
+        bits_per_minimizer (int): the bits of the bitset per expected minimizer
+
+    Returns:
+        dict: the number of sequences and minimizers, and the fraction of set bits
+    """
+    if not 0 < k <= 32 or w < 1:
+        raise ValueError('Invalid minimizer parameters k={} and w={}'.format(k, w))
+    expected = max(1, os.path.getsize(fasta) * 2 // (w + 1))
+    log2_bits = max(16, int(round(np.log2(expected * bits_per_minimizer))))
+    bitset = np.zeros(1 << (log2_bits - 6), dtype=np.uint64)
+    nseqs, nminimizers = 0, 0
+    with fopen(fasta) as rf:
+        for records in fasta_chunks(rf):
+            if records and records[0][:1] == b'>':
+                records[0] = records[0][1:]
+            seqs = [r.partition(b'\n')[2].replace(b'\n', b'').replace(b'\r', b'') for r in records]
+            seqs = [s for s in seqs if len(s) >= k + w - 1]
+            nseqs += len(seqs)
+            if not seqs:
+                continue
+            lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+            for batch in length_batches(lengths):
+                _, minima = minimizers([seqs[i] for i in batch], k, w)
+                nminimizers += len(minima)
+                bits = minimizer_bits(minima, log2_bits)
+                np.bitwise_or.at(bitset, (bits >> np.uint64(6)).astype(np.int64),
+                                 np.uint64(1) << (bits & np.uint64(63)))
+    set_bits = sum(int(np.unpackbits(bitset[i:i + (1 << 20)].view(np.uint8)).sum())
+                   for i in range(0, len(bitset), 1 << 20))
+    # the prefilter can be built at the same time by the first runs of the database, each renaming a complete file
+    tmp_output = '{}.tmp{}'.format(output, os.getpid())
+    try:
+        with open(tmp_output, 'wb') as wf:
+            wf.write(HEADER.pack(MAGIC, k, w, log2_bits, 0, nseqs, nminimizers, set_bits).ljust(HEADER_SIZE, b'\x00'))
+            wf.write(bitset.astype('<u8').tobytes())
+        os.replace(tmp_output, output)
+    finally:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+    return {'sequences': nseqs, 'minimizers': nminimizers, 'fill': set_bits / (1 << log2_bits)}
+
+
+class Prefilter:
+    """Memory-mapped minimizer prefilter of the reads to map
+
+    A read is kept if at least min_hits of its distinct minimizers are in the bitset of the minimizers
+    of the markers. Reads mapping to a marker share its minimizers unless they diverge from the marker
+    every few bases, while a read with no marker hit passes only through the false positives of the
+    bitset, whose fraction of set bits is reported by fill. The reads too short to have a minimizer are kept.
+
+    Args:
+        path (str): the prefilter file
+        min_hits (int): the minimum number of minimizer hits of the kept reads
+    """
+
+    def __init__(self, path, min_hits=DEFAULT_MIN_HITS):
+        with open(path, 'rb') as rf:
+            magic, self.k, self.w, self.log2_bits, _, self.nsequences, self.nminimizers, set_bits = \
+                HEADER.unpack(rf.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('Invalid prefilter file {}'.format(path))
+        self.path = path
+        self.min_hits = min_hits
+        self.fill = set_bits / (1 << self.log2_bits)
+        self.bitset = np.memmap(path, dtype='<u8', mode='r', offset=HEADER_SIZE, shape=(1 << (self.log2_bits - 6),))
+        self.nreads = 0
+        self.nkept = 0
+
+    def __reduce__(self):  # the worker processes map the file again instead of copying the bitset
+        return (Prefilter, (self.path, self.min_hits))
+
+    def hits(self, seqs):
+        """Returns the number of distinct minimizers of each sequence found in the bitset"""
+        counts = np.zeros(len(seqs), dtype=np.int64)
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        for batch in length_batches(lengths):
+            batch = batch[lengths[batch] >= self.k + self.w - 1]
+            if not len(batch):
+                continue
+            rows, minima = minimizers([seqs[i] for i in batch], self.k, self.w)
+            bits = minimizer_bits(minima, self.log2_bits)
+            hit = (self.bitset[(bits >> np.uint64(6)).astype(np.int64)] >> (bits & np.uint64(63))) & np.uint64(1)
+            counts[batch] = np.bincount(rows[hit.astype(bool)], minlength=len(batch))
+        return counts
+
+    def __call__(self, seqs):
+        """Returns the positions of the sequences to keep
+
+        Args:
+            seqs (list[bytes]): the read sequences
+
+        Returns:
+            list[int]: the positions of the reads with enough minimizer hits, or too short to be tested
+        """
+        if not seqs:
+            return []
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        keep = np.flatnonzero((self.hits(seqs) >= self.min_hits) | (lengths < self.k + self.w - 1)).tolist()
+        self.nreads += len(seqs)
+        self.nkept += len(keep)
+        return keep
+
+    def add_counts(self, nreads, nkept):
+        """Adds the counts of a copy of the prefilter used by a worker process"""
+        self.nreads += nreads
+        self.nkept += nkept
+
+
+def build_database_prefilter(mpa_pkl, output, tmp_dir=None, k=DEFAULT_K, w=DEFAULT_W,
+                             bits_per_minimizer=BITS_PER_MINIMIZER):
+    """Builds the prefilter of a MetaPhlAn database from the markers exported from its BowTie2 index
+
+    Args:
+        mpa_pkl (str): the database pkl, next to the BowTie2 index with the same name
+        output (str): the prefilter file
+        tmp_dir (str): the folder of the temporary FASTA file of the markers
+    """
+    fasta = generate_markers_fasta(mpa_pkl, tmp_dir if tmp_dir else os.path.dirname(os.path.abspath(output)))
+    try:
+        stats = build_prefilter(fasta, output, k, w, bits_per_minimizer)
+    finally:
+        os.remove(fasta)
+    info('Prefilter of {} markers and {} minimizers written to {} ({:.1%} of the bits set)'.format(
+        stats['sequences'], stats['minimizers'], output, stats['fill']))
+
+
+def read_params():
+    """ Reads and parses the command line arguments of the script
+
+    Returns:
+        namespace: The populated namespace with the command line arguments
+    """
+    p = ap.ArgumentParser(description="Builds the minimizer prefilter of the reads mapped by MetaPhlAn (--prefilter)",
+                          formatter_class=ap.ArgumentDefaultsHelpFormatter)
+    p.add_argument('-d', '--database', type=str, default=None,
+                   help="The MetaPhlAn database pkl, the prefilter is written next to it")
+    p.add_argument('-f', '--fasta', type=str, default=None,
+                   help="The FASTA file of the markers, exported from the BowTie2 index of the database if not specified")
+    p.add_argument('-o', '--output', type=str, default=None, help="The prefilter file")
+    p.add_argument('-k', type=int, default=DEFAULT_K, help="The k-mer length")
+    p.add_argument('-w', type=int, default=DEFAULT_W, help="The number of consecutive k-mers of a minimizer window")
+    p.add_argument('--bits_per_minimizer', type=int, default=BITS_PER_MINIMIZER,
+                   help="The size of the bitset in bits per minimizer of the markers")
+    p.add_argument('--tmp_dir', type=str, default=None, help="The folder for the temporary files")
+    return p.parse_args()
+
+
+def check_params(args):
+    """Checks the mandatory command line arguments of the script
+
+    Args:
+        args (namespace): the arguments to check
+    """
+    if not args.database and not args.fasta:
+        error('-d (or --database) or -f (or --fasta) must be specified', exit=True)
+    if args.database and not os.path.exists(args.database):
+        error('The file {} does not exist'.format(args.database), exit=True)
+    if args.fasta and not os.path.exists(args.fasta):
+        error('The file {} does not exist'.format(args.fasta), exit=True)
+    if args.fasta and not args.output:
+        error('-o (or --output) must be specified with -f (or --fasta)', exit=True)
+
+
+def main():
+    t0 = time.time()
+    args = read_params()
+    check_params(args)
+    if args.fasta:
+        stats = build_prefilter(args.fasta, args.output, args.k, args.w, args.bits_per_minimizer)
+        info('Prefilter of {} markers and {} minimizers written to {} ({:.1%} of the bits set)'.format(
+            stats['sequences'], stats['minimizers'], args.output, stats['fill']))
+    else:
+        output = args.output if args.output else prefilter_path(os.path.splitext(args.database)[0])
+        build_database_prefilter(args.database, output, args.tmp_dir, args.k, args.w, args.bits_per_minimizer)
+    info('Done in {:.2f} s'.format(time.time() - t0))
+
+
+if __name__ == '__main__':
+    main()
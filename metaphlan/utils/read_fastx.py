@@ -3,142 +3,589 @@
 
 import sys
 import os
+import re
 import bz2
 import gzip
+import zlib
 import glob
-from Bio.SeqIO.QualityIO import FastqGeneralIterator
-from Bio.SeqIO.FastaIO import SimpleFastaParser
-try:
-    import StringIO as uio
-except ImportError:
-    import io as uio
+import struct
+import threading
+import queue
+import copy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
-p2 = float(sys.version_info[0]) < 3.0
-
-
-def clean_read_id(l, forced=False):
-    if (l[0] == '@') or (l[0] == '>') or forced:
-        return l.split(' ')[0]
-
-    return l
+# size of the raw buffers read from the input files, records are parsed buffer-wise
+CHUNK_SIZE = 4 * 1024 * 1024
+# minimum size of the compressed segments decompressed by a single thread
+SEGMENT_SIZE = 1024 * 1024
+BZ2_STREAM_HEADER = re.compile(rb'BZh[1-9]1AY&SY')
 
 
 def fastx(l):
     if l:
-        if l[0] == '@':
+        if l[:1] == b'@':
             return 'fastq'
 
-        if l[0] == '>':
+        if l[:1] == b'>':
             return 'fasta'
 
-    sys.stderr.write("\nError, input data has to be in fastq or fasta format\n\n")
-    sys.exit(-1)
-
+    raise ValueError("\nError, input data has to be in fastq or fasta format\n\n")
 
-def print_record(description, sequence, qual, fmt):
-    if fmt == 'fastq':
-        return '@{}\n{}\n+\n{}\n'.format(description, sequence, qual)
 
-    if fmt == 'fasta':
-        return '>{}\n{}\n'.format(description, sequence)
+def bgzf_segments(fd):
+    """Splits a BGZF stream at the boundaries of its blocks
 
-
-def fopen(fn):
+    Yields:
+        bytes: groups of complete gzip members of at least SEGMENT_SIZE bytes
+    """
+    segment = []
+    size = 0
+    while True:
+        header = fd.read(12)
+        if not header:
+            break
+        if len(header) < 12 or header[:2] != b'\x1f\x8b' or not header[3] & 4:
+            raise ValueError('Error: invalid BGZF block in the input file.\n')
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = fd.read(xlen)
+        pos, bsize = 0, None
+        while pos + 4 <= len(extra):
+            slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == b'BC' and slen == 2:
+                bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+            pos += 4 + slen
+        if bsize is None:
+            raise ValueError('Error: invalid BGZF block in the input file.\n')
+        segment += [header, extra, fd.read(bsize + 1 - 12 - xlen)]
+        size += bsize + 1
+        if size >= SEGMENT_SIZE:
+            yield b''.join(segment)
+            segment, size = [], 0
+    if segment:
+        yield b''.join(segment)
+
+
+def bgzf_decompress(data):
+    """Decompresses a group of complete gzip members"""
+    blocks = []
+    while data:
+        d = zlib.decompressobj(31)
+        blocks.append(d.decompress(data))
+        if not d.eof:
+            raise ValueError('Error: truncated BGZF block in the input file.\n')
+        data = d.unused_data
+    return b''.join(blocks)
+
+
+def bz2_segments(fd):
+    """Splits a multi-stream bz2 file (e.g. compressed by pbzip2) at the headers of its streams
+
+    Yields:
+        bytes: groups of complete bz2 streams of at least SEGMENT_SIZE bytes
+    """
+    leftover = b''
+    while True:
+        buf = fd.read(CHUNK_SIZE)
+        if not buf:
+            break
+        buf = leftover + buf
+        start = 0
+        for m in BZ2_STREAM_HEADER.finditer(buf, SEGMENT_SIZE):
+            if m.start() - start >= SEGMENT_SIZE:
+                yield buf[start:m.start()]
+                start = m.start()
+        leftover = buf[start:]
+    if leftover:
+        yield leftover
+
+
+class ParallelDecompressor:
+    """Binary reader decompressing the independent blocks of a compressed file on a pool of threads
+
+    zlib and bz2 release the GIL, so the blocks are actually decompressed concurrently,
+    while they are returned in the original order.
+
+    Args:
+        fd (file): the compressed binary stream
+        segments (callable): splits the compressed stream into independently decompressable segments
+        decompress (callable): decompresses a segment
+        nthreads (int): the number of decompression threads
+    """
+
+    def __init__(self, fd, segments, decompress, nthreads):
+        self.fd = fd
+        self.executor = ThreadPoolExecutor(nthreads)
+        self.blocks = self.decompressed(segments(fd), decompress, 2 * nthreads)
+        self.buf = b''
+
+    def decompressed(self, segments, decompress, lookahead):
+        pending = deque()
+        for segment in segments:
+            pending.append(self.executor.submit(decompress, segment))
+            if len(pending) > lookahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def read(self, size=-1):
+        parts, length = [self.buf], len(self.buf)
+        while size < 0 or length < size:
+            block = next(self.blocks, None)
+            if block is None:
+                break
+            parts.append(block)
+            length += len(block)
+        data = b''.join(parts)
+        if size < 0:
+            self.buf = b''
+            return data
+        self.buf = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_bgzf(head):
+    """Whether the first bytes of a file are the header of a BGZF block"""
+    return (head[:4] == b'\x1f\x8b\x08\x04' and len(head) >= 18 and
+            struct.unpack('<H', head[10:12])[0] >= 6 and head[12:14] == b'BC')
+
+
+def fopen(fn, nthreads=1):
     fileName, fileExtension = os.path.splitext(fn)
+    nthreads = min(nthreads, os.cpu_count() or 1)
+
+    if nthreads > 1 and fileExtension in ('.bz2', '.gz'):
+        with open(fn, 'rb') as f:
+            head = f.read(CHUNK_SIZE)
+        if is_bgzf(head):
+            return ParallelDecompressor(open(fn, 'rb'), bgzf_segments, bgzf_decompress, nthreads)
+        if head[:3] == b'BZh' and BZ2_STREAM_HEADER.search(head, 4) is not None:  # multi-stream bz2
+            return ParallelDecompressor(open(fn, 'rb'), bz2_segments, bz2.decompress, nthreads)
 
     if fileExtension == '.bz2':
-        return (bz2.open(fn, "rt") if not p2 else bz2.BZ2File(fn, "r"))
+        return bz2.open(fn, "rb")
 
     if fileExtension == '.gz':
-        return gzip.open(fn, "rt")
+        return gzip.open(fn, "rb")
 
-    return open(fn)
+    return open(fn, "rb")
 
 
-def read_and_write_raw_int(fd, min_len=None, prefix_id=""):
-    fmt = None
-    avg_read_length = 0
-    nreads = 0
-    discarded = 0
-    idx = 1
-    #if min_len:
-    r = []
+def read_id_suffix(prefix_id, sample=None):
+    """Returns the prefix of the ordinal appended to the read IDs of a file (e.g. __1.{idx}), the reads of
+    multiplexed samples are tagged with the ordinal of their sample (e.g. __{sample}:1.{idx})"""
+    tag = '{}:'.format(sample) if sample is not None else ''
+    return "__{}{}{}".format(tag, prefix_id, '.' if prefix_id else '').encode()
 
-    # reading the first read (and save it, if from stdin will be lost otherwise) to get the format
-    while True:
-        l = fd.readline()
 
-        if not fmt:
-            fmt = fastx(l)
-            parser = FastqGeneralIterator if fmt == 'fastq' else SimpleFastaParser
-            readn = 4 if fmt == 'fastq' else 2
+def split_sample_tag(read_id):
+    """Splits the sample tag from a multiplexed read ID
 
-        r.append(l)
+    Args:
+        read_id (bytes): the read ID tagged by read_id_suffix
 
-        if len(r) == readn:
-            break
+    Returns:
+        (int, bytes): the ordinal of the sample and the read ID without the tag
+    """
+    i = read_id.rindex(b'__') + 2
+    j = read_id.index(b':', i)
+    return int(read_id[i:j]), read_id[:i] + read_id[j + 1:]
 
-    # check the first read from above
-    for record in parser(uio.StringIO("".join(r))):
-        if readn == 4:
-            description, sequence, qual = record
-        else:
-            qual = None
-            description, sequence = record
 
-        if len(sequence) >= min_len:
-            description = clean_read_id(description, forced=True)
-            avg_read_length = len(sequence) + avg_read_length
-            _ = sys.stdout.write(print_record(description + "__{}{}1".format(prefix_id, '.' if prefix_id else ''), sequence, qual, fmt))
-        else:
-            discarded = discarded + 1
+def fastq_chunks(fd, chunk_size=CHUNK_SIZE):
+    """Splits a FASTQ stream into lists of complete lines, four per record
 
-    # parse and check all the remaining reads
-    for idx, record in enumerate(parser(fd), 2):
-        if readn == 4:
-            description, sequence, qual = record
-        else:
-            qual = None
-            description, sequence = record
-
-        if len(sequence) >= min_len:
-            avg_read_length = len(sequence) + avg_read_length
-            description = clean_read_id(description, forced=True)
-            _ = sys.stdout.write(
-                    print_record(description + "__{}{}{}".format(prefix_id, '.' if prefix_id else '', idx), sequence, qual, fmt))
-        else:
-            discarded = discarded + 1
-    # else:
-    #     for idx, l in enumerate(fd,1):
-    #         avg_read_length = len(l) + avg_read_length
-    #         _ = sys.stdout.write(ignore_spaces(l))
+    Args:
+        fd (file): the input binary stream
+        chunk_size (int): the size of the raw buffers
 
-    if not idx:
-        sys.stderr.write('Error: no reads found.\n')
-        sys.exit(1)
+    Yields:
+        list[bytes]: the lines of the complete records contained in each buffer
+    """
+    leftover = b''
+    while True:
+        buf = fd.read(chunk_size)
+        if not buf:
+            break
+        lines = (leftover + buf).split(b'\n')
+        nlines = (len(lines) - 1) // 4 * 4
+        leftover = b'\n'.join(lines[nlines:])
+        del lines[nlines:]
+        if lines:
+            yield lines
+
+    lines = leftover.split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()
+    if len(lines) % 4:
+        raise ValueError('Error: truncated FASTQ record at the end of the input.\n')
+    if lines:
+        yield lines
+
+
+def fasta_chunks(fd, chunk_size=CHUNK_SIZE):
+    """Splits a FASTA stream into lists of complete records without the leading '>'
+
+    Args:
+        fd (file): the input binary stream
+        chunk_size (int): the size of the raw buffers
+
+    Yields:
+        list[bytes]: the complete records contained in each buffer
+    """
+    leftover = b''
+    while True:
+        buf = fd.read(chunk_size)
+        if not buf:
+            break
+        buf = leftover + buf
+        last = buf.rfind(b'\n>')
+        if last < 0:
+            leftover = buf
+            continue
+        leftover = buf[last + 1:]
+        yield buf[:last].split(b'\n>')
+
+    if leftover:
+        yield [leftover]
+
+
+def write_fastq(lines, out, min_len, suffix, idx, prefilter=None):
+    """Filters and writes a list of FASTQ lines renaming the reads
+
+    Args:
+        prefilter (callable): when specified, returns the positions of the sequences to write
+
+    Returns:
+        (int, int, int): the number of records read and kept, and the total length of the kept reads
+    """
+    if b'\r' in lines[0]:
+        lines = [l.rstrip(b'\r') for l in lines]
+    heads, seqs = lines[0::4], lines[1::4]
+    # misplaced lines propagate to the end of the chunk
+    if heads[0][:1] != b'@' or heads[-1][:1] != b'@':
+        raise ValueError('Error: records in FASTQ format should start with "@", check the input file.\n')
+    n = len(heads)
+    if min(map(len, seqs)) < min_len:
+        keep = [i for i, s in enumerate(seqs) if len(s) >= min_len]
+        ordinals = [idx + 1 + i for i in keep]
+        heads, seqs, quals = [heads[i] for i in keep], [seqs[i] for i in keep], [lines[4 * i + 3] for i in keep]
+    else:
+        ordinals, quals = range(idx + 1, idx + 1 + n), lines[3::4]
+    kept, length = len(seqs), sum(map(len, seqs))
+    if prefilter is not None:
+        hits = prefilter(seqs)
+        if len(hits) < len(seqs):
+            heads, seqs, quals = [heads[i] for i in hits], [seqs[i] for i in hits], [quals[i] for i in hits]
+            ordinals = [ordinals[i] for i in hits]
+
+    records = [b'+'] * (4 * len(seqs))
+    records[0::4] = [b'%s%s%d' % (h.rstrip().split(b' ', 1)[0], suffix, i) for h, i in zip(heads, ordinals)]
+    records[1::4] = seqs
+    records[3::4] = quals
+    records.append(b'')
+    out.write(b'\n'.join(records))
+    return n, kept, length
+
+
+def write_fasta(records, out, min_len, suffix, idx, prefilter=None):
+    """Filters and writes a list of FASTA records renaming the reads
+
+    Args:
+        prefilter (callable): when specified, returns the positions of the sequences to write
+
+    Returns:
+        (int, int, int): the number of records read and kept, and the total length of the kept reads
+    """
+    if records and records[0][:1] == b'>':
+        records[0] = records[0][1:]
+    kept, ordinals, length = [], [], 0
+    for r in records:
+        idx += 1
+        h, _, s = r.partition(b'\n')
+        s = s.replace(b'\n', b'').replace(b'\r', b'').replace(b' ', b'')
+        if len(s) >= min_len:
+            length += len(s)
+            kept.append((h, s))
+            ordinals.append(idx)
+    nkept = len(kept)
+    if prefilter is not None:
+        hits = prefilter([s for _, s in kept])
+        kept, ordinals = [kept[i] for i in hits], [ordinals[i] for i in hits]
+    out.write(b''.join([b'>%s%s%d\n%s\n' % (h.rstrip().split(b' ', 1)[0], suffix, i, s)
+                        for (h, s), i in zip(kept, ordinals)]))
+    return len(records), nkept, length
+
+
+def read_and_write_raw_int(fd, out, min_len=0, prefix_id="", prefilter=None, sample=None):
+    """Parses the reads of an input stream and writes them with the renamed read IDs
+
+    Args:
+        fd (file): the input binary stream
+        out (file): the output binary stream
+        min_len (int): the minimum length of the reads to keep
+        prefix_id (str): the ordinal of the input file
+        prefilter (Prefilter): when specified, only the reads sharing minimizers with the markers are written
+        sample (int): when specified, the ordinal of the sample tagging the read IDs
+
+    Returns:
+        (int, int): the number of reads written and their total length
+    """
+    first = fd.read(1)
+    fmt = fastx(first)
+    fd = ChainedReader(first, fd)
+    chunks, write_chunk = (fastq_chunks, write_fastq) if fmt == 'fastq' else (fasta_chunks, write_fasta)
+    suffix = read_id_suffix(prefix_id, sample)
+    idx, nreads, avg_read_length = 0, 0, 0
+
+    for chunk in chunks(fd):
+        n, kept, length = write_chunk(chunk, out, min_len, suffix, idx, prefilter)
+        idx += n
+        nreads += kept
+        avg_read_length += length
 
-    nreads = idx - discarded
+    if not idx:
+        raise ValueError('Error: no reads found.\n')
 
     if not nreads:
-        sys.stderr.write('Error: no reads longer than {} bp found.\n'.format(min_len))
-        sys.exit(1)
+        raise ValueError('Error: no reads longer than {} bp found.\n'.format(min_len))
 
     return (nreads, avg_read_length)
 
 
-def read_and_write_raw(fd, opened=False, min_len=None, prefix_id=""):
+def read_and_write_raw(fd, out, opened=False, min_len=0, prefix_id="", nthreads=1, prefilter=None, sample=None):
     if opened:  # fd is stdin
-        nreads, avg_read_length = read_and_write_raw_int(fd, min_len=min_len, prefix_id=prefix_id)
+        nreads, avg_read_length = read_and_write_raw_int(fd, out, min_len=min_len, prefix_id=prefix_id,
+                                                         prefilter=prefilter, sample=sample)
     else:
-        with fopen(fd) as inf:
-            nreads, avg_read_length = read_and_write_raw_int(inf, min_len=min_len, prefix_id=prefix_id)
+        with fopen(fd, nthreads) as inf:
+            nreads, avg_read_length = read_and_write_raw_int(inf, out, min_len=min_len, prefix_id=prefix_id,
+                                                             prefilter=prefilter, sample=sample)
 
     return (nreads, avg_read_length)
 
 
+class ChainedReader:
+    """Binary reader returning some already consumed bytes before the rest of the stream"""
+
+    def __init__(self, head, fd):
+        self.head, self.fd = head, fd
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.fd.read(size)
+        head, self.head = self.head, b''
+        return head + self.fd.read(size - len(head) if size > 0 else size)
+
+
+def get_input_files(args):
+    """Expands the comma separated input files and folders"""
+    files = []
+    for a in args:
+        for f in a.split(','):
+            if os.path.isdir(f):
+                files += list(glob.iglob(os.path.join(f, "*fastq*")))
+            else:
+                files += [f]
+    return files
+
+
+class QueueSink:
+    """Binary output stream sending the written chunks through a queue, until the consumer stops"""
+
+    def __init__(self, chunks, stopped):
+        self.chunks = chunks
+        self.stopped = stopped
+
+    def write(self, data):
+        if self.stopped.is_set():
+            raise ValueError('The output of the parsed reads was closed')
+        self.chunks.put(data)
+
+
+def queue_read_and_write(f, chunks, stopped, min_len, prefix_id, nthreads, prefilter=None, sample=None):
+    """Parses an input file on a worker thread, a None chunk signals the end of the file
+
+    Returns:
+        (int, int): the number of reads written and their total length
+    """
+    try:
+        return read_and_write_raw(f, QueueSink(chunks, stopped), opened=False, min_len=min_len, prefix_id=prefix_id,
+                                  nthreads=nthreads, prefilter=prefilter, sample=sample)
+    finally:
+        chunks.put(None)
+
+
+def parallel_read_and_write(files, out, min_len=0, nproc=2, prefilter=None, sample=None):
+    """Parses several input files concurrently on a pool of threads
+
+    The decompressors release the GIL, so the files are decompressed concurrently. Threads are used
+    rather than processes since the feeder runs next to the writer and SAM threads, whose locks a
+    forked process could inherit while held. The chunks of the different files are written as soon
+    as they are parsed, so the reads of the files are interleaved while keeping the IDs assigned by
+    the serial parsing.
+
+    Returns:
+        list[(int, int)]: the number of reads written and their total length for each file
+    """
+    nworkers = min(nproc, len(files))
+    chunks, stopped = queue.Queue(2 * nworkers), threading.Event()
+    # a copy of the prefilter per file, whose counts are added at the end
+    prefilters = [copy.copy(prefilter) if prefilter is not None else None for _ in files]
+    with ThreadPoolExecutor(nworkers) as executor:
+        results = [executor.submit(queue_read_and_write, f, chunks, stopped, min_len, prefix_id,
+                                   max(1, nproc // nworkers), p, sample)
+                   for (prefix_id, f), p in zip(enumerate(files, 1), prefilters)]
+        done = 0
+        try:
+            while done < len(files):
+                chunk = chunks.get()
+                if chunk is None:
+                    done += 1
+                else:
+                    out.write(chunk)
+        except BaseException:
+            # the workers stop at their next chunk
+            stopped.set()
+            while done < len(files):
+                if chunks.get() is None:
+                    done += 1
+            raise
+        stats = [r.result() for r in results]
+    for p in prefilters:
+        if p is not None:
+            prefilter.add_counts(p.nreads, p.nkept)
+    return stats
+
+
+def read_and_write(inputs, out, min_len=0, nproc=1, prefilter=None, sample=None):
+    """Parses and writes all the input reads
+
+    Args:
+        inputs (list): the input files, reads from stdin when empty
+        out (file): the output binary stream
+        min_len (int): the minimum length of the reads to keep
+        nproc (int): the number of threads decompressing and parsing the input files
+        prefilter (Prefilter): when specified, only the reads sharing minimizers with the markers are written
+        sample (int): when specified, the ordinal of the sample tagging the read IDs
+
+    Returns:
+        (int, float): the number of reads kept and their average length
+    """
+    if len(inputs) == 0:
+        nreads, avg_read_length = read_and_write_raw(sys.stdin.buffer, out, opened=True, min_len=min_len,
+                                                     prefilter=prefilter, sample=sample)
+    else:
+        files = get_input_files(inputs)
+        if nproc > 1 and len(files) > 1:
+            stats = parallel_read_and_write(files, out, min_len=min_len, nproc=nproc, prefilter=prefilter,
+                                            sample=sample)
+        else:
+            stats = [read_and_write_raw(f, out, opened=False, min_len=min_len, prefix_id=prefix_id, nthreads=nproc,
+                                        prefilter=prefilter, sample=sample)
+                     for prefix_id, f in enumerate(files, 1)]
+        nreads = sum(n for n, _ in stats)
+        avg_read_length = sum(l for _, l in stats)
+
+    avg_read_length /= nreads
+    return (nreads, avg_read_length)
+
+
+class FastxFeeder(threading.Thread):
+    """Thread parsing the input reads and streaming them into an output stream (e.g. the stdin of BowTie2)
+
+    Args:
+        inputs (str): the comma separated input files, None to read from stdin
+        out (file): the output binary stream, closed when all the reads have been written
+        min_len (int): the minimum length of the reads to keep
+        nproc (int): the number of threads decompressing and parsing the input files
+        subsampler (ReadSubsampler): when specified, the reads are subsampled from its inputs instead
+        prefilter (Prefilter): when specified, only the reads sharing minimizers with the markers are written
+    """
+
+    def __init__(self, inputs, out, min_len=0, nproc=1, subsampler=None, prefilter=None):
+        super().__init__(daemon=True)
+        self.inputs = [inputs] if inputs else []
+        self.out = out
+        self.min_len = min_len
+        self.nproc = nproc
+        self.subsampler = subsampler
+        self.prefilter = prefilter
+        self.nreads = None
+        self.avg_read_length = None
+        self.exception = None
+
+    def run(self):
+        try:
+            if self.subsampler is not None:
+                self.nreads, self.avg_read_length = self.subsampler.feed(self.out, min_len=self.min_len,
+                                                                         prefilter=self.prefilter)
+            else:
+                self.nreads, self.avg_read_length = read_and_write(self.inputs, self.out, min_len=self.min_len,
+                                                                   nproc=self.nproc, prefilter=self.prefilter)
+        except Exception as e:
+            self.exception = e
+        finally:
+            try:
+                self.out.close()
+            except OSError:
+                pass
+
+
+class MultiplexedFeeder(FastxFeeder):
+    """Thread streaming the reads of several samples one after the other into a single output stream, tagging
+    the read IDs with the ordinal of their sample
+
+    The samples are independent: a sample that cannot be read is recorded in errors and the next ones are
+    still fed.
+
+    Args:
+        samples (list): the comma separated input files of each sample
+        out (file): the output binary stream, closed when all the reads have been written
+        min_len (int): the minimum length of the reads to keep
+        nproc (int): the number of threads decompressing and parsing the input files
+        prefilter (Prefilter): when specified, only the reads sharing minimizers with the markers are written
+    """
+
+    def __init__(self, samples, out, min_len=0, nproc=1, prefilter=None):
+        super().__init__(None, out, min_len=min_len, nproc=nproc, prefilter=prefilter)
+        self.samples = samples
+        self.stats = [None] * len(samples)
+        self.errors = [None] * len(samples)
+
+    def run(self):
+        try:
+            for sample, inputs in enumerate(self.samples):
+                try:
+                    self.stats[sample] = read_and_write([inputs], self.out, min_len=self.min_len, nproc=self.nproc,
+                                                        prefilter=self.prefilter, sample=sample)
+                except BrokenPipeError:
+                    raise
+                except (ValueError, OSError) as e:
+                    self.errors[sample] = e
+        except Exception as e:
+            self.exception = e
+        finally:
+            try:
+                self.out.close()
+            except OSError:
+                pass
+
+
 def main():
     min_len = 0
+    nproc = 1
     args = []
     nreads = None
     avg_read_length = None
@@ -151,30 +598,21 @@ def main():
 
             if min_len == 'next':
                 min_len = int(l)
+            elif nproc == 'next':
+                nproc = int(l)
             elif l in ['-l', '--min_len']:
                 min_len = 'next'
+            elif l in ['-p', '--nproc']:
+                nproc = 'next'
             else:
                 args.append(l)
 
-    if len(args) == 0:
-        nreads, avg_read_length = read_and_write_raw(sys.stdin, opened=True, min_len=min_len)
-    else:
-        files = []
-        avg_read_length, nreads = 0, 0
-
-        for a in args:
-            for f in a.split(','):
-                if os.path.isdir(f):
-                    files += list(glob.iglob(os.path.join(f, "*fastq*")))
-                else:
-                    files += [f]
-
-        for prefix_id, f in enumerate(files, 1):
-            f_nreads, f_avg_read_length = read_and_write_raw(f, opened=False, min_len=min_len, prefix_id=prefix_id)
-            nreads += f_nreads
-            avg_read_length += f_avg_read_length
-
-    avg_read_length /= nreads
+    try:
+        nreads, avg_read_length = read_and_write(args, sys.stdout.buffer, min_len=min_len, nproc=nproc)
+        sys.stdout.flush()
+    except ValueError as e:
+        sys.stderr.write(str(e))
+        sys.exit(1)
 
     if nreads and avg_read_length:
         sys.stderr.write('{}\t{}'.format(nreads, avg_read_length))
@@ -184,4 +622,3 @@ def main():
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,69 @@
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import re
+
+
+class SamFilter:
+    """Byte-level filter of the SAM lines produced by mapping the reads against the MetaPhlAn markers
+
+    Args:
+        min_mapq_val (int): the minimum mapping quality of the kept alignments
+        min_alignment_len (int): the minimum length of the longest match of the kept alignments, None to disable the filter
+    """
+
+    CIGAR_MATCHES = re.compile(rb'(\d+)M')
+    SECONDARY = 0x100
+    REVERSE = 0x10
+
+    def __init__(self, min_mapq_val, min_alignment_len=None):
+        self.min_mapq_val = min_mapq_val
+        self.min_alignment_len = min_alignment_len
+        self.markers = {}
+
+    def marker(self, reference):
+        """Returns the marker name of a SAM reference and whether its hits skip the MAPQ filter
+
+        Args:
+            reference (bytes): the reference field of the SAM line
+
+        Returns:
+            (bytes, bool): the marker name and whether the marker is viral or a GeneID marker
+        """
+        m = self.markers.get(reference)
+        if m is None:
+            m = (reference.split(b'/')[0], b'GeneID:' in reference or b'VDB' in reference)
+            self.markers[reference] = m
+        return m
+
+    def longest_match(self, cigar):
+        """Returns the length of the longest match of a CIGAR string"""
+        if cigar[-1:] == b'M' and cigar[:-1].isdigit():  # end-to-end alignment without indels
+            return int(cigar[:-1])
+        return max(map(int, self.CIGAR_MATCHES.findall(cigar)), default=0)
+
+    def filter(self, line):
+        """Filters a SAM line
+
+        Args:
+            line (bytes): the SAM line
+
+        Returns:
+            list[bytes]: the first six fields of the line (plus the rest of the line) if the alignment
+                passes the filters, None otherwise
+        """
+        if line[:1] == b'@':  # header
+            return None
+        o = line.split(b'\t', 6)
+        if o[2][-1:] == b'*':  # unmapped
+            return None
+        if int(o[1]) & self.SECONDARY:
+            return None
+        if int(o[4]) <= self.min_mapq_val and not self.marker(o[2])[1]:
+            return None
+        if self.min_alignment_len is not None and self.longest_match(o[5]) < self.min_alignment_len:
+            return None
+        return o
@@ -11,7 +11,6 @@ __date__ = '11 Mar 2024'
 
 
 import argparse as ap
-import bz2
 import os
 import subprocess as sp
 import tempfile
@@ -29,12 +28,18 @@ try:
     from .parallelisation import execute_pool
     from .database_controller import MetaphlanDatabaseController
     from .consensus_markers import ConsensusMarker, ConsensusMarkers
+    from .compression import EXTENSIONS, compressed_open
 except ImportError:
     from external_exec import samtools_sam_to_bam, samtools_sort_bam_v1, decompress_bz2
     from util_fun import info, error, warning
     from parallelisation import execute_pool
     from database_controller import MetaphlanDatabaseController
     from consensus_markers import ConsensusMarker, ConsensusMarkers
+    from compression import EXTENSIONS, compressed_open
+
+
+# compressed SAM files, by the extension of the compression
+COMPRESSED_FORMATS = [e[1:] for e in EXTENSIONS]
 
 
 class SampleToMarkers:
@@ -94,7 +99,7 @@ class SampleToMarkers:
 
     def convert_inputs(self):
         """Convert input sample files to sorted BAMs"""
-        if self.input_format.lower() == "bz2":
+        if self.input_format.lower() in COMPRESSED_FORMATS:
             info("\tDecompressing samples...")
             self.input, self.input_format = self.decompress_from_bz2()
             info("\tDone.")
@@ -262,12 +267,11 @@ class SampleToMarkers:
             str: the path to the output file
         """
         output_file = os.path.join(tmp_dir, input_file.split('/')[-1])
-        if input_format.lower() == "bz2":
-            ifn = bz2.open(input_file, 'rb')
-            output_file = output_file.replace('.bz2', '')
+        if input_format.lower() in COMPRESSED_FORMATS:
+            output_file = os.path.splitext(output_file)[0]
         else:
             assert input_format.lower() == "sam"
-            ifn = open(input_file, 'rb')
+        ifn = compressed_open(input_file, 'rb')
 
         def filter_mapping_line(line_fields_, markers_subset):
             marker_ = line_fields_[2]
@@ -293,7 +297,8 @@ class SampleToMarkers:
 
         selected_markers = set((m for m, c in marker_to_reads.items() if c >= min_reads_aligning))
 
-        ifn.seek(0)  # second pass of the file
+        ifn.close()  # second pass of the file, not all the codecs support seeking backwards
+        ifn = compressed_open(input_file, 'rb')
         with open(output_file, 'wb') as ofn:
             for line in ifn:
                 line_fields = line.rstrip(b'\n').split(b'\t')
@@ -326,7 +331,7 @@ class SampleToMarkers:
         info("Creating temporary directory...")
         self.tmp_dir = tempfile.mkdtemp(dir=self.tmp_dir)
         info("Done.")
-        if self.input_format in ['sam', 'bz2']:
+        if self.input_format in ['sam'] + COMPRESSED_FORMATS:
             info("Filtering SAM files...")
             self.filter_sam_files()
             info("Done.")
@@ -378,7 +383,7 @@ def read_params():
                    help="The input MetaPhlAn " + __version__ + " database (path to the pkl file)")
     p.add_argument('--clades', type=str, nargs='+', default=[],
                    help="Restricts the reconstruction of the markers to the specified clades")
-    p.add_argument('-f', '--input_format', type=str, default="bz2", help="The input samples format {bam, sam, bz2}")
+    p.add_argument('-f', '--input_format', type=str, default="bz2", help="The input samples format {bam, sam, bz2, gz, zst, lz4}")
     p.add_argument('--sorted', action='store_true', default=False, help="Whether the BAM input files are sorted")
     p.add_argument('--min_reads_aligning', type=int, default=SampleToMarkers.DEFAULTS.min_reads_aligning,
                    help="The minimum number of reads to cover a marker")
@@ -419,8 +424,8 @@ def check_params(args):
         error('The directory {} does not exist'.format(args.tmp), exit=True)
     if args.database != 'latest' and not os.path.exists(args.database):
         error('The database does not exist', exit=True)
-    if args.input_format.lower() not in ['bam', 'sam', 'bz2']:
-        error('The input format must be SAM, BAM, or compressed in BZ2 format', exit=True)
+    if args.input_format.lower() not in ['bam', 'sam'] + COMPRESSED_FORMATS:
+        error('The input format must be SAM, BAM, or SAM compressed in BZ2, GZ, ZST or LZ4 format', exit=True)
     if args.input_format.lower() == "bam" and len(args.clades) > 0:
         error('The --clades option cannot be used with inputs in BAM format', exit=True)
 
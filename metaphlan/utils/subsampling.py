@@ -0,0 +1,424 @@
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import math
+import mmap
+import os
+import random
+import sys
+import tempfile
+
+import numpy as np
+
+try:
+    from .compression import compressed_open
+    from .read_fastx import fastq_chunks, fopen, read_id_suffix, write_fastq
+except ImportError:
+    from compression import compressed_open
+    from read_fastx import fastq_chunks, fopen, read_id_suffix, write_fastq
+
+
+MASK64 = (1 << 64) - 1
+# the priorities of the reads are 63-bit, so that all the thresholds, up to 2 ** 63, fit in 64 bits
+PRIORITY_RANGE = 1 << 63
+# number of standard deviations added to the sampling rate when choosing the reads to keep as candidates
+SLACK = 6
+# number of reads buffered before computing their priorities
+BATCH_SIZE = 1 << 16
+# number of sampled records read back from the spill file and written at once
+SPILL_BATCH_SIZE = 1 << 14
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def seed_value(seed):
+    """Returns the 64-bit value of a subsampling seed, a random one if the seed is 'random'"""
+    if str(seed).lower() == 'random':
+        return int.from_bytes(os.urandom(8), 'little')
+    return int(splitmix64_array(np.array([int(seed) & MASK64], dtype=np.uint64))[0])
+
+
+def splitmix64_array(x):
+    """Returns the SplitMix64 mix of an array of 64-bit integers"""
+    x = x.astype(np.uint64) + np.uint64(0x9e3779b97f4a7c15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def priorities(keys, seed):
+    """Returns the 63-bit priorities of the reads from their keys and the seed value"""
+    return splitmix64_array(keys ^ np.uint64(seed)) >> np.uint64(1)
+
+
+def read_keys(read_ids):
+    """Returns the 64-bit FNV-1a hashes of the read IDs, computed column-wise on the IDs padded to the same length
+
+    Args:
+        read_ids (list[bytes]): the read IDs
+
+    Returns:
+        numpy.ndarray: the keys of the reads
+    """
+    columns = np.array(read_ids).view(np.uint8).reshape(len(read_ids), -1)
+    keys = np.full(len(read_ids), FNV_OFFSET, dtype=np.uint64)
+    for c in columns.T:
+        keys = np.where(c != 0, (keys ^ c) * FNV_PRIME, keys)  # the padding does not change the hash
+    return keys
+
+
+class MappingSubsampler:
+    """Subsamples the mapped reads in a single pass over the mapping results
+
+    Each read gets a pseudo-random priority from the hash of its ID and the seed, and the sample of a class of
+    markers is made of its reads with the lowest priorities, i.e. a uniform random sample reproducible
+    for a given seed. The size of the sample of a class is proportional to the reads mapped to the
+    class, known only at the end, so the reads are kept as candidates while their priority is below
+    the expected sampling rate plus a margin of SLACK standard deviations. The rate is bounded by the
+    ratio between the subsampling and the mapped reads seen so far when the number of reads of the
+    metagenome is not known in advance, hence the candidates are at most a few times the sample size.
+
+    Args:
+        subsampling (int): the number of reads of the subsampled metagenome
+        seed (str): the subsampling seed, 'random' for a random seed
+        classify (callable): returns the class of a marker, whose reads are sampled proportionally,
+            or None if its reads are not sampled
+        n_metagenome_reads (int): the number of reads of the metagenome, None if not known in advance
+    """
+
+    def __init__(self, subsampling, seed, classify, n_metagenome_reads=None):
+        self.subsampling = subsampling
+        self.seed = seed_value(seed)
+        self.classify = classify
+        self.n_metagenome_reads = n_metagenome_reads
+        self.labels = []
+        self.marker_classes = {}
+        self.counts = []
+        self.candidates = []  # chunks of (priorities, read IDs, markers) arrays for each class
+        self.n_candidates = []
+        self.n_mapped = 0
+        self.batch = []
+
+    def class_index(self, marker):
+        """Returns the index of the class of a marker"""
+        cls = self.classify(marker.decode())
+        if cls not in self.labels:
+            self.labels.append(cls)
+            self.counts.append(0)
+            self.candidates.append([])
+            self.n_candidates.append(0)
+        self.marker_classes[marker] = i = self.labels.index(cls)
+        return i
+
+    def threshold(self, i):
+        """Returns the current priority threshold of the candidates of a class, which only decreases as reads are added"""
+        n = self.subsampling if self.n_metagenome_reads is None else self.n_metagenome_reads
+        rate = self.subsampling / max(n, self.n_mapped, 1)
+        if self.labels[i] is not None:
+            rate += SLACK / math.sqrt(max(self.counts[i], 1))
+        elif self.subsampling < max(n, self.n_mapped):  # the unclassified reads are only kept when not subsampling
+            rate = 0
+        return min(PRIORITY_RANGE, int(rate * PRIORITY_RANGE))
+
+    def add(self, read_id, marker):
+        """Adds a mapped read
+
+        Args:
+            read_id (bytes): the read ID
+            marker (bytes): the marker hit by the read
+        """
+        self.batch.append((read_id, marker))
+        if len(self.batch) >= BATCH_SIZE:
+            self.add_hits(*zip(*self.batch))
+            self.batch = []
+
+    def add_hits(self, read_ids, markers):
+        """Adds a batch of mapped reads
+
+        Args:
+            read_ids (list[bytes]): the read IDs
+            markers (list[bytes]): the marker hit by each read
+        """
+        if not read_ids:
+            return
+        marker_classes = self.marker_classes
+        classes = np.array([marker_classes[m] if m in marker_classes else self.class_index(m) for m in markers],
+                           dtype=np.int64)
+        self.n_mapped += len(read_ids)
+        for i, c in enumerate(np.bincount(classes, minlength=len(self.labels)).tolist()):
+            self.counts[i] += c
+        thresholds = np.array([self.threshold(i) for i in range(len(self.labels))], dtype=np.uint64)
+        p = priorities(read_keys(read_ids), self.seed)
+        keep = p < thresholds[classes]
+        if keep.any():
+            read_ids, markers = np.array(read_ids, dtype=object), np.array(markers, dtype=object)
+            for i in np.unique(classes[keep]).tolist():
+                selected = keep & (classes == i)
+                self.candidates[i].append((p[selected], read_ids[selected], markers[selected]))
+                self.n_candidates[i] += int(selected.sum())
+        for i, t in enumerate(thresholds.tolist()):
+            if self.n_candidates[i] > 2 * (t / PRIORITY_RANGE) * self.counts[i] + BATCH_SIZE:
+                self.candidates[i] = [tuple(a[c[0] < t] for a in c) for c in self.candidates[i]]
+                self.n_candidates[i] = sum(len(c[0]) for c in self.candidates[i])
+
+    def flush(self):
+        """Adds the buffered reads"""
+        if self.batch:
+            self.add_hits(*zip(*self.batch))
+            self.batch = []
+
+    def sample(self, n_metagenome_reads):
+        """Returns the subsampled reads
+
+        Args:
+            n_metagenome_reads (int): the number of reads of the metagenome
+
+        Returns:
+            dict: the marker hit by each read of the sample, all the mapped reads if the subsampling
+                is not lower than the reads of the metagenome
+        """
+        self.flush()
+        reads2markers = {}
+        for cls, count, candidates in zip(self.labels, self.counts, self.candidates):
+            if not candidates or (cls is None and self.subsampling < n_metagenome_reads):
+                continue
+            p, read_ids, markers = (np.concatenate(a) for a in zip(*candidates))
+            if self.subsampling < n_metagenome_reads:
+                n_sampled = int((count * self.subsampling) / n_metagenome_reads)
+                if len(p) < n_sampled:
+                    sys.stderr.write('WARNING: Only {} reads could be sampled out of the {} expected for {}\n'.format(
+                        len(p), n_sampled, cls))
+                selected = np.argsort(p, kind='stable')[:n_sampled]
+                read_ids, markers = read_ids[selected], markers[selected]
+            reads2markers.update(zip((r.decode() for r in read_ids), (m.decode() for m in markers)))
+        return reads2markers
+
+
+def subsample_arrays(reads, marker_ids, marker_names, subsampling, seed, classify, n_metagenome_reads):
+    """Subsamples the mapped reads loaded from a binary bowtie2out file, with the priorities of MappingSubsampler
+    computed from the read ordinals instead of the read IDs
+
+    Args:
+        reads (numpy.ndarray): the read ordinals, or the positions of the reads when not stored
+        marker_ids (numpy.ndarray): the marker ID hit by each read
+        marker_names (list[str]): the names of the marker IDs
+        subsampling (int): the number of reads of the subsampled metagenome
+        seed (str): the subsampling seed, 'random' for a random seed
+        classify (callable): returns the class of a marker, or None if its reads are not sampled
+        n_metagenome_reads (int): the number of reads of the metagenome
+
+    Returns:
+        numpy.ndarray: the sorted positions of the subsampled reads
+    """
+    classes = [classify(m) for m in marker_names]
+    labels = sorted(set(c for c in classes if c is not None))
+    marker_class = np.array([labels.index(c) if c is not None else -1 for c in classes], dtype=np.int32)
+    read_class = marker_class[marker_ids]
+    p = priorities(reads.astype(np.uint64), seed_value(seed))
+    selected = []
+    for c in range(len(labels)):
+        idx = np.flatnonzero(read_class == c)
+        n_sampled = int((len(idx) * subsampling) / n_metagenome_reads)
+        selected.append(idx[np.argsort(p[idx], kind='stable')[:n_sampled]])
+    return np.sort(np.concatenate(selected)) if selected else np.zeros(0, dtype=np.int64)
+
+
+def uniform(rnd):
+    """Returns a random number in the open interval (0, 1)"""
+    u = rnd.random()
+    while u == 0.0:
+        u = rnd.random()
+    return u
+
+
+class Reservoir:
+    """Slots of a reservoir sample of k items of a stream of unknown length, chosen with the Algorithm L of Li (1994)
+
+    The number of items skipped before the next one entering the reservoir is drawn directly, so
+    the random generator is only called for the items actually selected.
+
+    Args:
+        k (int): the size of the sample
+        rnd (random.Random): the random generator
+    """
+
+    def __init__(self, k, rnd):
+        self.k = k
+        self.rnd = rnd
+        self.n = 0  # the items seen
+        self.w = math.exp(math.log(uniform(rnd)) / k)
+        self.next = 0  # the index of the next item entering the reservoir
+
+    def offer(self, count):
+        """Offers the next items of the stream
+
+        Args:
+            count (int): the number of items
+
+        Yields:
+            (int, int): the position of the selected items among the offered ones and their reservoir slot
+        """
+        end = self.n + count
+        while self.next < end:
+            i = self.next
+            if i < self.k:
+                slot = i
+            else:
+                slot = self.rnd.randrange(self.k)
+                self.w *= math.exp(math.log(uniform(self.rnd)) / self.k)
+            self.next = i + 1
+            if self.next >= self.k:
+                self.next += int(math.log(uniform(self.rnd)) / math.log(1 - self.w))
+            yield i - self.n, slot
+        self.n = end
+
+
+class ReadSubsampler:
+    """Subsamples the reads of FASTQ files in a single pass and feeds the sample to the mapping
+
+    The records entering the reservoir are appended to a spill file, so that only their offsets are
+    kept in memory; the spill holds about k * (1 + ln(n / k)) records, the final sample is read back
+    in the original order of the reads. The mates of paired reads are read in lockstep and sampled
+    together.
+
+    Args:
+        inputs (list[str]): the FASTQ files, the forward and reverse reads if paired
+        subsampling (int): the number of reads to sample, counting both the mates if paired
+        seed (str): the subsampling seed, 'random' for a random seed
+        paired (bool): whether the inputs are the forward and reverse reads
+        tmp_dir (str): the folder of the spill file
+        output (str): the output file of the sample, with the R1 and R2 suffixes if paired, None to not save it
+        nthreads (int): the number of decompression threads
+    """
+
+    def __init__(self, inputs, subsampling, seed, paired, tmp_dir=None, output=None, nthreads=1):
+        self.inputs = inputs
+        self.paired = paired
+        self.k = subsampling // 2 if paired else subsampling
+        self.rnd = random.Random() if str(seed).lower() == 'random' else random.Random(int(seed))
+        self.tmp_dir = tmp_dir
+        self.outputs = None
+        if output is not None:
+            if paired:
+                r, ext = os.path.splitext(output)
+                self.outputs = ['.'.join([r, 'R1' + ext]), '.'.join([r, 'R2' + ext])]
+            else:
+                self.outputs = [output]
+        self.nthreads = nthreads
+        self.n_metagenome_reads = None
+
+    def records(self, files, nthreads):
+        """Yields the lines of the records of a sequence of FASTQ files in chunks"""
+        for f in files:
+            with fopen(f, nthreads) as inf:
+                for lines in fastq_chunks(inf):
+                    if b'\r' in lines[0]:
+                        lines = [l.rstrip(b'\r') for l in lines]
+                    if lines[0][:1] != b'@' or lines[-4][:1] != b'@':
+                        raise ValueError('Error: records in FASTQ format should start with "@", check the input file.\n')
+                    yield lines
+
+    def paired_records(self, nthreads):
+        """Yields the lines of the forward and reverse records in chunks with the same number of records"""
+        forward, reverse = self.records(self.inputs[:1], nthreads), self.records(self.inputs[1:], nthreads)
+        buf1, buf2 = [], []
+        while True:
+            if len(buf1) <= len(buf2):
+                chunk = next(forward, None)
+                if chunk is not None:
+                    buf1 += chunk
+            else:
+                chunk = next(reverse, None)
+                if chunk is not None:
+                    buf2 += chunk
+            n = min(len(buf1), len(buf2))
+            if n:
+                yield buf1[:n], buf2[:n]
+                del buf1[:n], buf2[:n]
+            elif chunk is None:
+                break
+        if buf1 or buf2 or next(forward, None) is not None or next(reverse, None) is not None:
+            raise ValueError("Error: The specified reads file are not the same length! Make sure the forward and "
+                             "reverse reads are files are not damaged and reads are in the same order. Exiting ...\n\n")
+
+    def sample(self, spill):
+        """Selects the sample in a single pass over the input, appending the selected records to the spill file
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): the spill offsets and sizes of the sampled records (both the mates
+                if paired) in the input order
+        """
+        reservoir = Reservoir(self.k, self.rnd)
+        # grown while the reservoir is filled, the subsampling may exceed the reads of the input
+        offsets = np.zeros(min(self.k, BATCH_SIZE), dtype=np.int64)
+        sizes = np.zeros(len(offsets), dtype=np.int64)
+        offset = 0
+        if self.paired:
+            chunks = self.paired_records(max(1, self.nthreads // 2))
+        else:
+            chunks = ((lines, None) for lines in self.records(self.inputs, self.nthreads))
+        for lines1, lines2 in chunks:
+            for i, slot in reservoir.offer(len(lines1) // 4):
+                record = b'\n'.join(lines1[4 * i:4 * i + 4]) + b'\n'
+                if lines2 is not None:
+                    record += b'\n'.join(lines2[4 * i:4 * i + 4]) + b'\n'
+                spill.write(record)
+                if slot == len(offsets):
+                    offsets, sizes = (np.resize(a, min(self.k, 2 * len(a))) for a in (offsets, sizes))
+                offsets[slot], sizes[slot] = offset, len(record)
+                offset += len(record)
+        spill.flush()
+        self.n_metagenome_reads = reservoir.n * (2 if self.paired else 1)
+        n = min(self.k, reservoir.n)
+        order = np.argsort(offsets[:n], kind='stable')  # the spill is appended in the input order
+        return offsets[:n][order], sizes[:n][order]
+
+    def feed(self, out, min_len=0, prefilter=None):
+        """Subsamples the reads and writes the sample, with the renamed read IDs, to an output stream
+
+        Args:
+            out (file): the output binary stream
+            min_len (int): the minimum length of the reads to keep
+            prefilter (Prefilter): when specified, only the reads sharing minimizers with the markers are written
+
+        Returns:
+            (int, float): the number of reads written and their average length
+        """
+        nmates = 2 if self.paired else 1
+        with tempfile.TemporaryFile(dir=self.tmp_dir) as spill:
+            offsets, sizes = self.sample(spill)
+            if not len(offsets):
+                raise ValueError('Error: no reads found.\n')
+            outputs = []
+            if self.k * nmates >= self.n_metagenome_reads:
+                sys.stderr.write("WARNING: The specified subsampling ({}) is equal or higher than the original number "
+                                 "of reads ({}). Subsampling will be skipped.\n".format(self.k * nmates,
+                                                                                       self.n_metagenome_reads))
+            elif self.outputs:
+                outputs = [compressed_open(o, 'wb') for o in self.outputs]
+            suffixes = [read_id_suffix(i) for i in range(1, nmates + 1)]
+            idx, nreads, length = 0, 0, 0
+            with mmap.mmap(spill.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for start in range(0, len(offsets), SPILL_BATCH_SIZE):
+                    mates = [[] for _ in suffixes]
+                    for o, s in zip(offsets[start:start + SPILL_BATCH_SIZE].tolist(),
+                                    sizes[start:start + SPILL_BATCH_SIZE].tolist()):
+                        lines = mm[o:o + s].split(b'\n')
+                        for m, lines_m in enumerate(mates):
+                            lines_m += lines[4 * m:4 * m + 4]
+                    for lines_m, suffix, out_m in zip(mates, suffixes, outputs or [None] * nmates):
+                        _, kept, kept_length = write_fastq(lines_m, out, min_len, suffix, idx, prefilter)
+                        nreads += kept
+                        length += kept_length
+                        if out_m is not None:
+                            out_m.write(b'\n'.join(lines_m) + b'\n')
+                    idx += len(mates[0]) // 4
+            for out_m in outputs:
+                out_m.close()
+
+        if not nreads:
+            raise ValueError('Error: no reads longer than {} bp found.\n'.format(min_len))
+        return nreads, length / nreads
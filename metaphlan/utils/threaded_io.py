@@ -0,0 +1,172 @@
+__author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
+              'Francesco Beghini (francesco.beghini@unitn.it)')
+__version__ = '4.1.1'
+__date__ = '11 Mar 2024'
+
+
+import queue
+import threading
+import time
+
+
+class QueuedWriter(threading.Thread):
+    """Writes the data of a producer to a file on a dedicated thread, fed by a bounded queue
+
+    The producer is only blocked when the queue is full, so a slow output (e.g. a single-threaded
+    compressor) does not stall the stage producing the data until the queue has been filled.
+
+    Args:
+        out (file): the output file, closed when the writer is closed
+        name (str): the name of the stage, used to report the statistics
+        maxsize (int): the maximum number of pending writes
+    """
+
+    def __init__(self, out, name, maxsize=64):
+        super().__init__(name=name, daemon=True)
+        self.out = out
+        self.queue = queue.Queue(maxsize)
+        self.exception = None
+        self.blocked = 0.0  # time the producer waited for a free slot in the queue
+        self.idle = 0.0  # time the writer waited for data
+        self.busy = 0.0  # time spent writing
+        self.start()
+
+    def write(self, data):
+        """Queues some data to be written"""
+        if self.exception is not None:
+            raise self.exception
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            t0 = time.perf_counter()
+            self.queue.put(data)
+            self.blocked += time.perf_counter() - t0
+
+    def run(self):
+        while True:
+            t0 = time.perf_counter()
+            data = self.queue.get()
+            t1 = time.perf_counter()
+            self.idle += t1 - t0
+            if data is None:
+                break
+            if self.exception is None:  # keep draining the queue after a failure not to block the producer
+                try:
+                    self.out.write(data)
+                except Exception as e:
+                    self.exception = e
+            self.busy += time.perf_counter() - t1
+        try:
+            self.out.close()
+        except Exception as e:
+            self.exception = self.exception or e
+
+    def close(self):
+        """Writes the pending data and closes the output file"""
+        self.queue.put(None)
+        self.join()
+        if self.exception is not None:
+            raise self.exception
+
+    def stats(self):
+        """Returns a summary of the time spent by the stage"""
+        return '{}: producer blocked {:.2f} s, writer idle {:.2f} s, writing {:.2f} s'.format(
+            self.name, self.blocked, self.idle, self.busy)
+
+
+class RoundRobinWriter:
+    """Distributes the writes of a producer over several output files in turn
+
+    Each write is forwarded whole, so writes made of complete records (e.g. the parsed chunks of reads)
+    split the records across the outputs.
+
+    Args:
+        outs (list): the output files, closed when the writer is closed
+    """
+
+    def __init__(self, outs):
+        self.outs = outs
+        self.next = 0
+
+    def write(self, data):
+        self.outs[self.next].write(data)
+        self.next = (self.next + 1) % len(self.outs)
+
+    def close(self):
+        exception = None
+        for out in self.outs:
+            try:
+                out.close()
+            except OSError as e:
+                exception = exception or e
+        if exception is not None:
+            raise exception
+
+
+class MergedLineReader:
+    """Reads batches of lines from several files on dedicated threads, returning them in order of arrival
+
+    The header lines at the beginning of the files after the first one are dropped, and the lines of the
+    other files are held back until the header of the first one has been returned, so that merging the
+    outputs of several processes writing the same header (e.g. SAM) gives a single well-formed stream.
+
+    Args:
+        ins (list): the input binary files, closed at their end
+        header_prefix (bytes): the prefix of the header lines, None if the files have no header
+        batch_size (int): the size hint of the batches of lines read at once
+        maxsize (int): the maximum number of pending batches
+    """
+
+    def __init__(self, ins, header_prefix=None, batch_size=-1, maxsize=64):
+        self.queue = queue.Queue(maxsize)
+        self.header_prefix = header_prefix
+        self.batch_size = batch_size
+        self.header_done = header_prefix is None
+        self.pending = []
+        self.open = len(ins)
+        self.exception = None
+        self.threads = [threading.Thread(target=self.run, args=(i, f), daemon=True) for i, f in enumerate(ins)]
+        for t in self.threads:
+            t.start()
+
+    def run(self, i, f):
+        in_header = self.header_prefix is not None
+        try:
+            while True:
+                lines = f.readlines(self.batch_size)
+                if not lines:
+                    break
+                if in_header:
+                    n = 0
+                    while n < len(lines) and lines[n].startswith(self.header_prefix):
+                        n += 1
+                    in_header = n == len(lines)
+                    if i > 0:
+                        lines = lines[n:]
+                if lines:
+                    self.queue.put((i, lines, not in_header))
+        except Exception as e:
+            self.exception = self.exception or e
+        finally:
+            f.close()
+            self.queue.put((i, None, True))
+
+    def readlines(self, hint=-1):
+        """Returns the next batch of lines of any of the files, an empty list when all the files are over"""
+        while True:
+            if self.header_done and self.pending:
+                return self.pending.pop(0)
+            if not self.open:
+                if self.exception is not None:
+                    raise self.exception
+                return []
+            i, lines, past_header = self.queue.get()
+            if lines is None:
+                self.open -= 1
+            if i == 0 and past_header:
+                self.header_done = True
+            if lines is None:
+                continue
+            if i == 0 or self.header_done:
+                return lines
+            self.pending.append(lines)
@@ -6,8 +6,6 @@ __author__ = ('Aitor Blanco Miguez (aitor.blancomiguez@unitn.it), '
 __version__ = '4.1.1'
 __date__ = '11 Mar 2024'
 
-import bz2
-import gzip
 import os
 import sys
 import time
@@ -86,10 +84,9 @@ def create_folder(path):
 
 
 def openrt(file_path):
-    file_path = str(file_path)
-    if file_path.endswith('.bz2'):
-        return bz2.open(file_path, 'rt')
-    elif file_path.endswith('.gz'):
-        return gzip.open(file_path, 'rt')
-    else:
-        return open(file_path)
+    """Opens a file in text mode, detecting its compression from the magic bytes"""
+    try:
+        from .compression import compressed_open
+    except ImportError:
+        from compression import compressed_open
+    return compressed_open(str(file_path), 'rt')
@@ -32,6 +32,7 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'metaphlan = metaphlan.metaphlan:main',
+            'metaphlan_client.py = metaphlan.server:client_main',
             'strainphlan = metaphlan.strainphlan:main',
             'add_metadata_tree.py = metaphlan.utils.add_metadata_tree:main',
             'extract_markers.py = metaphlan.utils.extract_markers:main',
@@ -43,6 +44,7 @@ setuptools.setup(
             'strain_transmission.py = metaphlan.utils.strain_transmission:main',
             'sgb_to_gtdb_profile.py = metaphlan.utils.sgb_to_gtdb_profile:main',
             'metaphlan2krona.py = metaphlan.utils.metaphlan2krona:main',
+            'database_cache.py = metaphlan.utils.database_cache:main',
             'run_treeshrink.py = metaphlan.utils.treeshrink.run_treeshrink:main',
             'treeshrink.py = metaphlan.utils.treeshrink.treeshrink:main',
             'create_toy_database.py = metaphlan.utils.create_toy_database:main',